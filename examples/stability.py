@@ -6,9 +6,10 @@ import os.path as path
 import numpy as np
 import matplotlib.pyplot as plt
 
-from stability_evaluation import (RecordingBatchIterator, MeanWaveCalculator,
-                                  RecordingAugmentation,
-                                  SpikeSortingEvaluation)
+from yass.evaluate.stability import (RecordingBatchProcessor,
+                                     MeanWaveCalculator,
+                                     RecordingAugmentation,
+                                     SpikeSortingEvaluation)
 
 
 ROOT = path.join(path.expanduser('~'), 'data/yass')
@@ -21,11 +22,15 @@ path_to_augmented = path.join(ROOT, 'augmented.bin')
 spike_train = np.loadtxt(path_to_spike_train, dtype='int32', delimiter=',')
 spike_train
 
-br = RecordingBatchIterator(path_to_data, path_to_geom, sample_rate=30000,
-                            batch_time_samples=1000000, n_batches=5,
-                            n_chan=200, radius=100, whiten=False)
+# batches are filtered in parallel (with a buffer to avoid edge artifacts)
+# and saved to ej49_data1_set1.filtered.bin
+br = RecordingBatchProcessor(path_to_data, path_to_geom, sample_rate=30000,
+                             batch_time_samples=1000000, n_batches=5,
+                             n_chan=200, radius=100, whiten=False,
+                             processes='max')
 
 mwc = MeanWaveCalculator(br, spike_train)
+mwc.compute_templates(n_batches=5)
 
 
 # plot some of the recovered templates
@@ -56,3 +61,6 @@ ev = SpikeSortingEvaluation(spt_, spt_2, tmp_, tmp_2)
 print(ev.true_positive)
 print(ev.false_positive)
 print(ev.unit_cluster_map)
+
+# remove the filtered recording
+br.close_iterator()
@@ -1,6 +1,7 @@
 import numpy as np
 
 from yass.geometry import order_channels_by_distance
+from yass.templates.util import cross_correlation
 
 
 # TODO: documentation
@@ -23,23 +24,30 @@ def crop_templates(templatesBig, R, neighbors, geom):
 
     # get a template on a main channel and align them
     K_big = np.argmax(amps)
-    templates_mainc = np.zeros((K, templatesBig.shape[1]))
+    n_samples = templatesBig.shape[1]
+    templates_mainc = np.zeros((K, n_samples))
     t_rec = templatesBig[K_big, :, mainC[K_big]]
     t_rec = t_rec/np.sqrt(np.sum(np.square(t_rec)))
+    t_mainc = templatesBig[np.arange(K), :, mainC]
+    t_mainc = t_mainc/np.sqrt(np.sum(np.square(t_mainc), 1))[:, np.newaxis]
+
+    # correlation at every lag, templates are zero padded on both sides
+    t_padded = np.pad(t_mainc, ((0, 0), (n_samples-1, n_samples-1)),
+                      'constant')
+    shifts = np.argmax(cross_correlation(t_rec[np.newaxis],
+                                         t_padded[:, np.newaxis]),
+                       axis=1) - n_samples + 1
+
     for k in range(K):
-        t1 = templatesBig[k, :, mainC[k]]
-        t1 = t1/np.sqrt(np.sum(np.square(t1)))
-        shift = align_templates(t1, t_rec)
+        t1 = t_mainc[k]
+        shift = shifts[k]
         if shift > 0:
-            templates_mainc[k, :(templatesBig.shape[1]-shift)] = t1[shift:]
-            templatesBig[k, :(templatesBig.shape[1]-shift)
-                         ] = templatesBig[k, shift:]
+            templates_mainc[k, :(n_samples-shift)] = t1[shift:]
+            templatesBig[k, :(n_samples-shift)] = templatesBig[k, shift:]
 
         elif shift < 0:
-            templates_mainc[k, (-shift):] = t1[:(templatesBig.shape[1]+shift)]
-            templatesBig[k, (-shift):] = templatesBig[k,
-                                                      :(templatesBig.shape[1]
-                                                        + shift)]
+            templates_mainc[k, (-shift):] = t1[:(n_samples+shift)]
+            templatesBig[k, (-shift):] = templatesBig[k, :(n_samples+shift)]
 
         else:
             templates_mainc[k] = t1
@@ -60,19 +68,3 @@ def crop_templates(templatesBig, R, neighbors, geom):
         templatesBig2[k, :, :ch_idx.shape[0]] = templatesBig[k][:, ch_idx]
 
     return templatesBig2
-
-
-# TODO: documentation
-# TODO: comment code, it's not clear what it does
-def align_templates(t1, t2):
-    """[Description]
-
-    Parameters
-    ----------
-
-    Returns
-    -------
-    """
-    temp = np.convolve(t1, np.flip(t2, 0), 'full')
-    shift = np.argmax(temp)
-    return shift - t1.shape[0] + 1
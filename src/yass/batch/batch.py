@@ -10,7 +10,8 @@ try:
 except ImportError:
     from pathlib import Path
 
-from multiprocess import Pool, Manager
+import multiprocess
+from multiprocess import Pool, Manager, cpu_count
 import yaml
 from tqdm import tqdm
 
@@ -414,6 +415,15 @@ class BatchProcessor(object):
             'previous_batch' which contains the computation for the last
             batch, it is set to None in the first batch
 
+        processes: int or str, optional
+            Number of processes, batches are processed in parallel if
+            larger than 1, 'max' uses all cores in the machine
+            (pass_batch_results is not supported). In 'memory' mode,
+            processes are started with spawn (so they are safe to use
+            after tensorflow runs), function and kwargs are sent once to
+            every process and only the results are sent back, batches are
+            processed serially in Python 2. Defaults to 1
+
         **kwargs
             kwargs to pass to function
 
@@ -458,6 +468,8 @@ class BatchProcessor(object):
         self.logger.info('Applying function {}...'
                          .format(function_path(function)))
 
+        processes = cpu_count() if processes == 'max' else processes
+
         if (mode == 'disk' and if_file_exists == 'skip' and
                 os.path.exists(output_path)):
             # load params...
@@ -493,7 +505,11 @@ class BatchProcessor(object):
                                      human_readable_time(elapsed)))
             return res
         else:
-            fn = self._multi_channel_apply_memory
+            if processes == 1:
+                fn = self._multi_channel_apply_memory
+            else:
+                fn = partial(self._multi_channel_apply_memory_parallel,
+                             processes=processes)
 
             start = time.time()
             res = fn(function, cleanup_function, from_time, to_time, channels,
@@ -577,6 +593,7 @@ class BatchProcessor(object):
                          n_channels=_n_channels,
                          data_order=_data_order,
                          loader=_loader,
+                         buffer_size=_buffer_size,
                          return_data_index=True)
 
         m = Manager()
@@ -664,3 +681,99 @@ class BatchProcessor(object):
                 results.append(res)
 
         return res if pass_batch_results else results
+
+    def _multi_channel_apply_memory_parallel(self, function,
+                                             cleanup_function, from_time,
+                                             to_time, channels, cast_dtype,
+                                             pass_batch_info,
+                                             pass_batch_results, processes,
+                                             **kwargs):
+
+        self.logger.debug('Starting parallel operation...')
+
+        if pass_batch_results:
+            raise NotImplementedError("pass_batch_results is not "
+                                      "implemented on parallel 'memory' "
+                                      "mode")
+
+        # workers are started in new processes instead of forking, forking
+        # a process that already has a tensorflow session (or uses CUDA)
+        # is not safe. Python 2 can only fork, batches run serially there
+        get_context = getattr(multiprocess, 'get_context', None)
+
+        if get_context is None:
+            self.logger.warning('Parallel memory mode needs Python 3, '
+                                'running batches serially')
+            return self._multi_channel_apply_memory(
+                function, cleanup_function, from_time, to_time, channels,
+                cast_dtype, pass_batch_info, pass_batch_results, **kwargs)
+
+        # need to convert to a list, oherwise cannot be pickled
+        data = list(self.multi_channel(from_time, to_time, channels,
+                    return_data=False))
+        n_batches = self.indexer.n_batches(from_time, to_time, channels)
+
+        self.logger.info('Data will be splitted in %s batches', n_batches)
+
+        # create local variables to avoid pickling problems
+        _path_to_recordings = copy(self.path_to_recordings)
+        _dtype = copy(self.dtype)
+        _n_channels = copy(self.n_channels)
+        _data_order = copy(self.data_order)
+        _loader = copy(self.loader)
+        _buffer_size = copy(self.buffer_size)
+
+        reader = partial(RecordingsReader,
+                         path_to_recordings=_path_to_recordings,
+                         dtype=_dtype,
+                         n_channels=_n_channels,
+                         data_order=_data_order,
+                         loader=_loader,
+                         buffer_size=_buffer_size,
+                         return_data_index=True)
+
+        # run jobs, function and its arguments are sent once to every
+        # worker and every task only gets the batch index, every process
+        # reads its own batch and results come back in order
+        self.logger.debug('Creating processes pool...')
+
+        p = get_context('spawn').Pool(
+            processes, initializer=_init_memory_worker,
+            initargs=(function, reader, pass_batch_info, cast_dtype, kwargs,
+                      cleanup_function, _buffer_size))
+        iterator = p.imap(_run_memory_worker, enumerate(data))
+
+        if self.show_progress_bar:
+            iterator = tqdm(iterator, total=n_batches)
+
+        results = list(iterator)
+
+        p.close()
+        p.join()
+
+        return results
+
+
+# arguments shared by all the batches a worker runs in parallel 'memory'
+# mode, set once when the worker starts
+_memory_worker = {}
+
+
+def _init_memory_worker(function, reader, pass_batch_info, cast_dtype,
+                        kwargs, cleanup_function, buffer_size):
+    _memory_worker.update(function=function, reader=reader,
+                          pass_batch_info=pass_batch_info,
+                          cast_dtype=cast_dtype, kwargs=kwargs,
+                          cleanup_function=cleanup_function,
+                          buffer_size=buffer_size)
+
+
+def _run_memory_worker(element):
+    return util.batch_runner(element, _memory_worker['function'],
+                             _memory_worker['reader'],
+                             _memory_worker['pass_batch_info'],
+                             _memory_worker['cast_dtype'],
+                             _memory_worker['kwargs'],
+                             _memory_worker['cleanup_function'],
+                             _memory_worker['buffer_size'],
+                             save_chunks=False)
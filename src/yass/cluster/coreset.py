@@ -1,9 +1,15 @@
+from functools import partial
+
 import numpy as np
+import multiprocess
 from scipy.stats import chi2
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from yass.cluster.partition import ChannelPartition
 
 
-def coreset(scores, spike_index, coreset_k, coreset_th):
+def coreset(scores, spike_index, coreset_k, coreset_th, max_depth=10,
+            processes=1, partition=None):
     """
     Coreset based on hierarchical K-means
 
@@ -21,50 +27,101 @@ def coreset(scores, spike_index, coreset_k, coreset_th):
     coreset_th: float
        maximum distance allowed within each cluster
 
+    max_depth: int, optional
+        maximum depth of the hierarchy, see coreset_alg
+
+    processes: str or int, optional
+        Number of processes to use, channels are processed in parallel. If
+        'max', it uses all cores in the machine. Defaults to 1
+
+    partition: ChannelPartition, optional
+        spikes grouped by main channel, computed from spike_index if None
+
     Returns
     -------
     groups: list (n_channels)
         coreset represented as group id.
         groups[c] is the group id of spikes in scores[c]
     """
+    processes = multiprocess.cpu_count() if processes == 'max' else processes
 
-    # initialize list
-    n_channels = np.max(spike_index[:, 1]) + 1
-    groups = [None]*n_channels
+    if partition is None:
+        partition = ChannelPartition.from_spike_index(spike_index)
 
-    for channel in range(n_channels):
+    # only the scores of every channel are sent to the workers
+    coreset_one = partial(coreset_channel, coreset_k=coreset_k,
+                          coreset_th=coreset_th, max_depth=max_depth)
 
-        idx_data = np.where(spike_index[:, 1] == channel)[0]
-        scores_channel = scores[idx_data]
+    if processes == 1:
+        groups = [coreset_one(scores[partition.indices(channel)])
+                  for channel in range(partition.n_channels)]
+    else:
+        p = multiprocess.Pool(processes)
+        groups = p.map(coreset_one,
+                       [scores[partition.indices(channel)]
+                        for channel in range(partition.n_channels)])
+        p.close()
+        p.join()
 
-        # get data relevant to this channel
-        n_data, n_features, n_neigh = scores_channel.shape
-        # exclude empty channels
-        valid_channel = np.sum(np.abs(scores_channel),
-                               axis=(0, 1)) > 0
-        scores_channel = scores_channel[:, :, valid_channel]
+    return groups
 
-        if n_data > 0:
-            score_temp = np.reshape(scores_channel, [n_data, -1])
-            # calculate threshold
-            th = 1.5*np.sqrt(chi2.ppf(coreset_th, 1) *
-                             score_temp.shape[1])
 
-            # run hierarchical K-means
-            group = coreset_alg(score_temp,
-                                th, coreset_k).astype('int32') - 1
-            groups[channel] = group
+def coreset_channel(scores_channel, coreset_th, coreset_k, max_depth=10):
+    """
+    Coreset of the spikes in a single channel
 
-        else:
-            groups[channel] = np.zeros(0, 'int32')
+    Parameters
+    ----------
+    scores_channel: np.array(n_data, n_features, n_neigh)
+        scores of the spikes whose main channel is this channel
 
-    return groups
+    coreset_th: float
+       maximum distance allowed within each cluster
+
+    coreset_k: int
+        number of clusters for running K-means
+
+    max_depth: int, optional
+        maximum depth of the hierarchy, see coreset_alg
+
+    Returns
+    -------
+    group_channel: np.array(n_data)
+        group id of each spike, starting from 0
+    """
+    # get data relevant to this channel
+    n_data, n_features, n_neigh = scores_channel.shape
+    # exclude empty channels
+    valid_channel = np.sum(np.abs(scores_channel), axis=(0, 1)) > 0
+    scores_channel = scores_channel[:, :, valid_channel]
+
+    if n_data > 0:
+        score_temp = np.reshape(scores_channel, [n_data, -1])
+        # calculate threshold
+        th = 1.5*np.sqrt(chi2.ppf(coreset_th, 1) * score_temp.shape[1])
+
+        # run hierarchical K-means
+        return coreset_alg(score_temp, th, coreset_k,
+                           max_depth).astype('int32') - 1
+
+    else:
+        return np.zeros(0, 'int32')
 
 
-def coreset_alg(data, th, K):
+def coreset_alg(data, th, K, max_depth=10, batch_size=1024, max_iter=10):
     """
     run hierarchical K-means
 
+    Clusters are split with mini-batch K-means until every point is within
+    th of its cluster center. Splits are kept in a work queue of index
+    arrays into data, so no recursion is needed and data is only sliced to
+    fit each K-means.
+
+    Clusters at max_depth are not split any further, so the number of
+    groups is at most min(n_data, K**max_depth) and every level of the
+    hierarchy fits K-means on at most n_data points: runtime is
+    O(max_depth * n_data * K * n_dimensions * max_iter)
+
     Parameters
     ----------
     data: np.array (n_data, n_dimensions)
@@ -76,31 +133,72 @@ def coreset_alg(data, th, K):
     K: int
        number of clusters for each K-means
 
+    max_depth: int, optional
+        maximum number of times a cluster is split
+
+    batch_size: int, optional
+        mini-batch size for K-means, clusters with at most batch_size
+        points run regular K-means
+
+    max_iter: int, optional
+        maximum number of K-means iterations
+
     Returns
     -------
     label_new: np.array (n_data)
-       cluster id
+       cluster id, starting from 1
     """
-    if data.shape[0] > K:
-        # run K-means
-        result = KMeans(n_clusters=K, init='k-means++',
-                        n_init=1, max_iter=10).fit(data)
-        # calculate distance to the center
-        distances = result.transform(data)
-
-        # get label
-        labels = result.labels_
-        label_new = np.zeros(data.shape[0])
-        for k in range(K):
-            idx = labels == k
-            # if distance to the center is bigger than th,
-            # run again. otherwise, just add it
-            if np.max(distances[idx, k]) > th:
-                label_temp = coreset_alg(data[idx], th, K)
-                label_new[idx] = label_temp + np.max(label_new)
+    label_new = np.zeros(data.shape[0], 'int32')
+    n_groups = 0
+
+    # (index into data, depth), last in first out so groups are numbered
+    # in depth-first order
+    queue = [(np.arange(data.shape[0]), 0)]
+
+    while queue:
+        idx, depth = queue.pop()
+
+        if idx.shape[0] <= K:
+            # every point is its own group
+            label_new[idx] = np.arange(n_groups + 1,
+                                       n_groups + idx.shape[0] + 1)
+            n_groups += idx.shape[0]
+
+        elif depth >= max_depth:
+            n_groups += 1
+            label_new[idx] = n_groups
+
+        else:
+            # run K-means (a single batch is the whole cluster for small
+            # ones), distance to the centers
+            if idx.shape[0] > batch_size:
+                kmeans = MiniBatchKMeans(n_clusters=K, init='k-means++',
+                                         n_init=1, max_iter=max_iter,
+                                         batch_size=batch_size)
             else:
-                label_new[idx] = 1 + np.max(label_new)
-    else:
-        label_new = np.array(range(1, data.shape[0]+1))
+                kmeans = KMeans(n_clusters=K, init='k-means++',
+                                n_init=1, max_iter=max_iter)
+
+            distances = kmeans.fit_transform(data[idx])
+            labels = np.argmin(distances, 1)
+            distances = distances[np.arange(idx.shape[0]), labels]
+
+            children = []
+            for k in range(K):
+                in_k = labels == k
+
+                # skip empty clusters
+                if not np.any(in_k):
+                    continue
+
+                # if distance to the center is bigger than th,
+                # split again. otherwise, just add it
+                if np.max(distances[in_k]) > th:
+                    children.append((idx[in_k], depth + 1))
+                else:
+                    n_groups += 1
+                    label_new[idx[in_k]] = n_groups
+
+            queue.extend(children[::-1])
 
     return label_new
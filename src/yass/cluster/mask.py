@@ -1,8 +1,10 @@
 from scipy.stats import chi2
 import numpy as np
 
+from yass.cluster.partition import ChannelPartition
 
-def getmask(scores, spike_index, groups, mask_th):
+
+def getmask(scores, spike_index, groups, mask_th, partition=None):
     """
     Get mask of each data
 
@@ -18,6 +20,9 @@ def getmask(scores, spike_index, groups, mask_th):
     mask_th: np.array (2)
        a strong and weak threshold for mask
 
+    partition: ChannelPartition, optional
+        spikes grouped by main channel, computed from spike_index if None
+
     Returns
     -------
     masks: list (n_channels)
@@ -25,52 +30,68 @@ def getmask(scores, spike_index, groups, mask_th):
         masks[c] is the mask of spikes in scores[c]
     """
 
-    # initialize
-    n_channels = np.max(spike_index[:, 1]) + 1
-    masks = [None]*n_channels
-
-    for channel in range(n_channels):
-
-        idx_data = np.where(spike_index[:, 1] == channel)[0]
+    if partition is None:
+        partition = ChannelPartition.from_spike_index(spike_index)
 
-        # get score and group for this channel
-        score_channel = scores[idx_data]
-        group_channel = groups[channel]
-
-        if score_channel.shape[0] > 0:
-            # get shape and threshold
-            n_data, n_features, n_neigh = score_channel.shape
-            th = 1.5*(chi2.ppf(mask_th, 1)*n_features)
+    # initialize
+    masks = [None]*partition.n_channels
 
-            # number of coresets
-            n_group = np.max(group_channel) + 1
+    for channel, idx_data in partition:
 
-            # get average score per group
-            score_group = np.zeros((n_group, n_features, n_neigh))
-            n_per_group = np.zeros(n_group)
-            for j in range(n_data):
-                score_group[group_channel[j]] += score_channel[j]
-                n_per_group[group_channel[j]] += 1
+        masks[channel] = getmask_channel(scores[idx_data], groups[channel],
+                                         mask_th)
 
-            for j in range(n_group):
-                score_group[j] = score_group[j]/n_per_group[j]
+    return masks
 
-            # get energy (l2 norm of score)
-            energy_group = np.sum(np.square(score_group), axis=1)
 
-            # determine mask using energy
-            mask_group = np.minimum(np.maximum(
-                (energy_group - np.min(th))/(np.max(th)-np.min(th)), 0), 1)
+def getmask_channel(score_channel, group_channel, mask_th):
+    """
+    Get mask of the data in a single channel, this can be called directly
+    on every channel of a channel-sorted spike store
 
-            # mask is redistributed per data
-            # since it was calculated per group
-            mask_channel = np.zeros((n_data, n_neigh))
-            for j in range(n_data):
-                mask_channel[j] = mask_group[group_channel[j]]
+    Parameters
+    ----------
+    score_channel: np.array(n_data, n_features, n_neigh)
+        scores of the spikes whose main channel is this channel
 
-            masks[channel] = mask_channel
+    group_channel: np.array(n_data)
+        coreset group id of each spike
 
-        else:
-            masks[channel] = np.zeros(0)
+    mask_th: np.array (2)
+       a strong and weak threshold for mask
 
-    return masks
+    Returns
+    -------
+    mask_channel: np.array(n_data, n_neigh)
+        mask for each data in score_channel
+    """
+    if score_channel.shape[0] == 0:
+        return np.zeros(0)
+
+    # get shape and threshold
+    n_data, n_features, n_neigh = score_channel.shape
+    th = 1.5*(chi2.ppf(mask_th, 1)*n_features)
+
+    # number of coresets
+    n_group = np.max(group_channel) + 1
+
+    # get average score per group, every (group, feature, neighbor) entry
+    # is a bin
+    n_dim = n_features*n_neigh
+    bins = (group_channel[:, np.newaxis]*n_dim + np.arange(n_dim)).ravel()
+    score_group = np.bincount(bins, weights=score_channel.ravel(),
+                              minlength=n_group*n_dim)
+    score_group = score_group.reshape(n_group, n_features, n_neigh)
+    n_per_group = np.bincount(group_channel, minlength=n_group)
+    score_group /= n_per_group[:, np.newaxis, np.newaxis]
+
+    # get energy (l2 norm of score)
+    energy_group = np.sum(np.square(score_group), axis=1)
+
+    # determine mask using energy
+    mask_group = np.minimum(np.maximum(
+        (energy_group - np.min(th))/(np.max(th)-np.min(th)), 0), 1)
+
+    # mask is redistributed per data
+    # since it was calculated per group
+    return mask_group[group_channel]
@@ -0,0 +1,104 @@
+import numpy as np
+
+
+class ChannelPartition(object):
+    """
+    Spikes grouped by main channel, computed once and shared by the
+    clustering stages
+
+    Spikes are sorted by main channel (stable sort, so within a channel
+    they keep their original order) and offsets mark where each channel
+    starts, the same layout as a CSR matrix. Getting the spikes of a channel
+    is a slice instead of a np.where over all spikes
+
+    Parameters
+    ----------
+    channels: np.array (n_data)
+        Main channel for every spike, spike_index[:, 1]
+
+    n_channels: int, optional
+        Number of channels, defaults to np.max(channels) + 1
+
+    Examples
+    --------
+    >>> partition = ChannelPartition.from_spike_index(spike_index)
+    >>> idx_data = partition.indices(channel)
+    >>> # same as np.where(spike_index[:, 1] == channel)[0]
+    """
+
+    def __init__(self, channels, n_channels=None):
+        channels = np.asarray(channels)
+
+        if n_channels is None:
+            n_channels = np.max(channels) + 1 if channels.size else 0
+
+        self.n_channels = n_channels
+        self.order = np.argsort(channels, kind='mergesort')
+        self.offsets = np.searchsorted(channels[self.order],
+                                       np.arange(n_channels + 1))
+
+    @classmethod
+    def from_spike_index(cls, spike_index, n_channels=None):
+        """Build a partition from a spike_index (n_data, 2) array
+        """
+        return cls(spike_index[:, 1], n_channels)
+
+    @classmethod
+    def _from_arrays(cls, order, offsets):
+        partition = cls.__new__(cls)
+        partition.n_channels = offsets.shape[0] - 1
+        partition.order = order
+        partition.offsets = offsets
+        return partition
+
+    @property
+    def n_data(self):
+        """Number of spikes
+        """
+        return self.order.shape[0]
+
+    @property
+    def sizes(self):
+        """Number of spikes per channel
+        """
+        return np.diff(self.offsets)
+
+    def indices(self, channel):
+        """Indexes of the spikes whose main channel is channel, in
+        ascending order
+        """
+        return self.order[self.offsets[channel]:self.offsets[channel + 1]]
+
+    def select(self, keep):
+        """Partition of the spikes that remain after filtering, without
+        sorting again
+
+        Parameters
+        ----------
+        keep: np.array (n_data)
+            Boolean array, True for the spikes to keep (same as indexing
+            spike_index[keep])
+
+        Returns
+        -------
+        ChannelPartition
+            Partition for spike_index[keep]
+        """
+        keep = np.asarray(keep, 'bool')
+
+        # new index of every kept spike, the mapping preserves order so
+        # spikes stay sorted within each channel
+        new_index = np.cumsum(keep) - 1
+
+        kept = keep[self.order]
+        order = new_index[self.order[kept]]
+        offsets = np.append(0, np.cumsum(kept))[self.offsets]
+
+        return ChannelPartition._from_arrays(order, offsets)
+
+    def __len__(self):
+        return self.n_channels
+
+    def __iter__(self):
+        for channel in range(self.n_channels):
+            yield channel, self.indices(channel)
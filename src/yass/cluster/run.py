@@ -5,12 +5,13 @@ import numpy as np
 
 from yass import read_config
 from yass.util import file_loader, check_for_files, LoadFile
+from yass.cluster.partition import ChannelPartition
 from yass.cluster.subsample import random_subsample
 from yass.cluster.triage import triage
 from yass.cluster.coreset import coreset
 from yass.cluster.mask import getmask
 from yass.cluster.util import (run_cluster, run_cluster_location,
-                               calculate_sparse_rhat)
+                               calculate_sparse_rhat, merge_clusters)
 from yass.mfm import get_core_data
 
 
@@ -56,6 +57,13 @@ def run(scores, spike_index, output_directory='tmp/',
     -------
     spike_train: (TODO add documentation)
 
+    tmp_loc: np.array (n_templates)
+        Channel where each cluster was found
+
+    vbParam: yass.mfm.vbPar
+        Cluster parameters, vbParam.rhat is a scipy.sparse.coo_matrix
+        (n_spikes, n_templates) with the soft assignments of all spikes
+
     Examples
     --------
 
@@ -77,19 +85,43 @@ def run(scores, spike_index, output_directory='tmp/',
     scores_all = np.copy(scores)
     spike_index_all = np.copy(spike_index)
 
+    # group spikes by main channel once, every stage uses this instead of
+    # looking for the spikes of each channel
+    partition_all = ChannelPartition.from_spike_index(spike_index_all)
+    partition = partition_all
+
+    # clusters from a previous sort to warm start from
+    prior_vbParam, prior_tmp_loc = None, None
+
+    if CONFIG.cluster.warm_start is not None:
+        path_to_prior = join(CONFIG.data.root_folder,
+                             CONFIG.cluster.warm_start)
+        logger.info('Warm starting from clusters in {}'
+                    .format(path_to_prior))
+        prior_vbParam = file_loader(join(path_to_prior, 'vbPar.pickle'))
+        prior_tmp_loc = file_loader(join(path_to_prior, 'tmp_loc.npy'))
+
     ##########
     # Triage #
     ##########
 
     _b = datetime.datetime.now()
-    logger.info("Randomly subsampling...")
-    scores, spike_index = random_subsample(scores, spike_index,
-                                           CONFIG.cluster.max_n_spikes)
+    if CONFIG.cluster.stochastic.enabled:
+        # big channels are clustered with mini-batches, keep all spikes
+        logger.info("Stochastic VB enabled, skipping random subsampling...")
+    else:
+        logger.info("Randomly subsampling...")
+        scores, spike_index, partition = random_subsample(
+            scores, spike_index, CONFIG.cluster.max_n_spikes, partition)
     logger.info("Triaging...")
-    scores, spike_index = triage(scores, spike_index,
-                                 CONFIG.cluster.triage.nearest_neighbors,
-                                 CONFIG.cluster.triage.percent,
-                                 CONFIG.cluster.method == 'location')
+    scores, spike_index, partition = triage(
+        scores, spike_index,
+        CONFIG.cluster.triage.nearest_neighbors,
+        CONFIG.cluster.triage.percent,
+        CONFIG.cluster.method == 'location',
+        CONFIG.cluster.triage.method,
+        CONFIG.resources.processes,
+        partition)
     Time['t'] += (datetime.datetime.now()-_b).total_seconds()
 
     if CONFIG.cluster.method == 'location':
@@ -99,7 +131,8 @@ def run(scores, spike_index, output_directory='tmp/',
         _b = datetime.datetime.now()
         logger.info("Clustering...")
         vbParam, tmp_loc, scores, spike_index = run_cluster_location(
-            scores, spike_index, CONFIG.cluster.min_spikes, CONFIG)
+            scores, spike_index, CONFIG.cluster.min_spikes, CONFIG,
+            partition, prior_vbParam, prior_tmp_loc)
         Time['s'] += (datetime.datetime.now()-_b).total_seconds()
 
     else:
@@ -111,7 +144,10 @@ def run(scores, spike_index, output_directory='tmp/',
         groups = coreset(scores,
                          spike_index,
                          CONFIG.cluster.coreset.clusters,
-                         CONFIG.cluster.coreset.threshold)
+                         CONFIG.cluster.coreset.threshold,
+                         CONFIG.cluster.coreset.max_depth,
+                         CONFIG.resources.processes,
+                         partition)
         Time['c'] += (datetime.datetime.now() - _b).total_seconds()
 
         ###########
@@ -120,7 +156,7 @@ def run(scores, spike_index, output_directory='tmp/',
         _b = datetime.datetime.now()
         logger.info("Masking...")
         masks = getmask(scores, spike_index, groups,
-                        CONFIG.cluster.masking_threshold)
+                        CONFIG.cluster.masking_threshold, partition)
         Time['m'] += (datetime.datetime.now() - _b).total_seconds()
 
         ##############
@@ -130,15 +166,29 @@ def run(scores, spike_index, output_directory='tmp/',
         logger.info("Clustering...")
         vbParam, tmp_loc, scores, spike_index = run_cluster(
             scores, masks, groups, spike_index,
-            CONFIG.cluster.min_spikes, CONFIG)
+            CONFIG.cluster.min_spikes, CONFIG, partition, prior_vbParam,
+            prior_tmp_loc)
         Time['s'] += (datetime.datetime.now()-_b).total_seconds()
 
     vbParam.rhat = calculate_sparse_rhat(vbParam, tmp_loc, scores_all,
                                          spike_index_all,
-                                         CONFIG.neigh_channels)
+                                         CONFIG.neigh_channels,
+                                         partition_all)
+
+    if CONFIG.cluster.merge.enabled:
+        _b = datetime.datetime.now()
+        logger.info("Merging...")
+        vbParam, tmp_loc = merge_clusters(vbParam, tmp_loc, scores_all,
+                                          CONFIG.neigh_channels, CONFIG,
+                                          CONFIG.cluster.merge.max_distance)
+        Time['s'] += (datetime.datetime.now()-_b).total_seconds()
     idx_keep = get_core_data(vbParam, scores_all, np.inf, 2)
-    spike_train = vbParam.rhat[idx_keep]
-    spike_train[:, 0] = spike_index_all[spike_train[:, 0].astype('int32'), 0]
+
+    # spike time, cluster id and probability for the kept entries
+    rhat = vbParam.rhat
+    spike_train = np.column_stack((spike_index_all[rhat.row[idx_keep], 0],
+                                   rhat.col[idx_keep],
+                                   rhat.data[idx_keep]))
 
     # report timing
     currentTime = datetime.datetime.now()
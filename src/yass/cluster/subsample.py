@@ -1,7 +1,9 @@
 import numpy as np
 
+from yass.cluster.partition import ChannelPartition
 
-def random_subsample(scores, spike_index, n_sample):
+
+def random_subsample(scores, spike_index, n_sample, partition=None):
     """
     Triage based random subsampling
 
@@ -18,6 +20,9 @@ def random_subsample(scores, spike_index, n_sample):
     n_sample: int
         maximum number of samples to keep
 
+    partition: ChannelPartition, optional
+        spikes grouped by main channel, computed from spike_index if None
+
     Returns
     -------
     scores: list (n_channels)
@@ -25,12 +30,15 @@ def random_subsample(scores, spike_index, n_sample):
 
     spike_index: list (n_channels)
         spike_index after traige
+
+    partition: ChannelPartition
+        partition for the subsampled spikes
     """
-    n_channels = np.max(spike_index[:, 1]) + 1
+    if partition is None:
+        partition = ChannelPartition.from_spike_index(spike_index)
 
     idx_keep = np.zeros(spike_index.shape[0], 'bool')
-    for channel in range(n_channels):
-        idx_data = np.where(spike_index[:, 1] == channel)[0]
+    for channel, idx_data in partition:
         n_data = idx_data.shape[0]
 
         if n_data > n_sample:
@@ -44,4 +52,4 @@ def random_subsample(scores, spike_index, n_sample):
     scores = scores[idx_keep]
     spike_index = spike_index[idx_keep]
 
-    return scores, spike_index
+    return scores, spike_index, partition.select(idx_keep)
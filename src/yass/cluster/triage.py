@@ -1,9 +1,15 @@
+from functools import partial
+
 import numpy as np
+import multiprocess
 from scipy.spatial import cKDTree
 
+from yass.cluster.partition import ChannelPartition
+
 
 def triage(scores, spike_index, triage_k,
-           triage_percent, location_feature):
+           triage_percent, location_feature, method='kdtree',
+           processes=1, partition=None):
     """
     Triage based on KNN distance.
     It removes triage_percent*100% of data
@@ -25,6 +31,24 @@ def triage(scores, spike_index, triage_k,
        percentage of data to be triaged.
        It is a number between 0 and 1.
 
+    location_feature: bool
+        Whether scores contain location features (cluster.method is
+        'location')
+
+    method: str, optional
+        kNN engine. 'kdtree' builds a cKDTree per feature set, 'brute'
+        computes exact distances with blocked matrix products (faster than
+        'kdtree' for high dimensional features) and 'approx' uses a random
+        projection forest (approximate neighbors, fastest for large
+        channels). Defaults to 'kdtree'
+
+    processes: str or int, optional
+        Number of processes to use, channels are triaged in parallel. If
+        'max', it uses all cores in the machine. Defaults to 1
+
+    partition: ChannelPartition, optional
+        spikes grouped by main channel, computed from spike_index if None
+
     Returns
     -------
     scores: list (n_channels)
@@ -32,50 +56,229 @@ def triage(scores, spike_index, triage_k,
 
     spike_index: list (n_channels)
         spike_index after traige
+
+    partition: ChannelPartition
+        partition for the spikes kept
     """
-    # relevant info
-    n_channels = np.max(spike_index[:, 1]) + 1
-    th = (1 - triage_percent)*100
+    if method not in KNN_METHODS:
+        raise ValueError('method must be one of {}, got "{}"'
+                         .format(sorted(KNN_METHODS), method))
+
+    processes = multiprocess.cpu_count() if processes == 'max' else processes
+
+    if partition is None:
+        partition = ChannelPartition.from_spike_index(spike_index)
+
+    idx_data_all = [idx_data for _, idx_data in partition
+                    if idx_data.shape[0] > triage_k + 1]
+
+    # only the scores of every channel are sent to the workers
+    triage_one = partial(_triage_channel, triage_k=triage_k,
+                         triage_percent=triage_percent,
+                         location_feature=location_feature, method=method)
+
+    if processes == 1:
+        triaged = [triage_one(scores[idx_data]) for idx_data in idx_data_all]
+    else:
+        p = multiprocess.Pool(processes)
+        triaged = p.map(triage_one,
+                        [scores[idx_data] for idx_data in idx_data_all])
+        p.close()
+        p.join()
 
     idx_triage = np.zeros(scores.shape[0], 'bool')
-    for channel in range(n_channels):
-        idx_data = np.where(spike_index[:, 1] == channel)[0]
-        scores_channel = scores[idx_data]
-        nc = scores_channel.shape[0]
-
-        if nc > triage_k + 1:
-            if location_feature:
-                scores_channel = scores_channel[:, :, 0]
-                th = (1 - triage_percent/2)*100
-
-                # get distance to nearest neighbors
-                tree = cKDTree(scores_channel[:, :2])
-                dist, ind = tree.query(scores_channel[:, :2], k=triage_k + 1)
-                dist = np.sum(dist, 1)
-                # triage far ones
-                idx_triage[idx_data[dist > np.percentile(dist, th)]] = 1
-
-                # get distance to nearest neighbors
-                tree = cKDTree(scores_channel[:, 2:])
-                dist, ind = tree.query(scores_channel[:, 2:], k=triage_k + 1)
-                dist = np.sum(dist, 1)
-                # triage far ones
-                idx_triage[idx_data[dist > np.percentile(dist, th)]] = 1
-
-            else:
-                n_neigh = scores_channel.shape[2]
-                th = (1 - triage_percent/n_neigh)*100
-
-                for c in range(n_neigh):
-                    tree = cKDTree(scores_channel[:, :, c])
-                    dist, ind = tree.query(scores_channel[:, :, c],
-                                           k=triage_k + 1)
-                    dist = np.sum(dist, 1)
-                    # triage far ones
-                    idx_triage[idx_data[dist > np.percentile(dist, th)]] = 1
-
-    idx_triage = np.where(idx_triage)[0]
-    scores = np.delete(scores, idx_triage, 0)
-    spike_index = np.delete(spike_index, idx_triage, 0)
-
-    return scores, spike_index
+    for idx_data, triaged_channel in zip(idx_data_all, triaged):
+        idx_triage[idx_data[triaged_channel]] = 1
+
+    idx_keep = np.logical_not(idx_triage)
+    scores = scores[idx_keep]
+    spike_index = spike_index[idx_keep]
+
+    return scores, spike_index, partition.select(idx_keep)
+
+
+def _triage_channel(scores_channel, triage_k, triage_percent,
+                    location_feature, method):
+    """Triage the scores of a single channel, returns a boolean array,
+    True for the spikes to remove
+    """
+    knn = KNN_METHODS[method]
+    triaged = np.zeros(scores_channel.shape[0], 'bool')
+
+    if location_feature:
+        scores_channel = scores_channel[:, :, 0]
+        th = (1 - triage_percent/2)*100
+        features = [scores_channel[:, :2], scores_channel[:, 2:]]
+
+    else:
+        n_neigh = scores_channel.shape[2]
+        th = (1 - triage_percent/n_neigh)*100
+        features = [scores_channel[:, :, c] for c in range(n_neigh)]
+
+    for x in features:
+        # get distance to nearest neighbors
+        dist = np.sum(knn(x, triage_k + 1), 1)
+        # triage far ones
+        triaged[dist > np.percentile(dist, th)] = 1
+
+    return triaged
+
+
+def knn_kdtree(x, k):
+    """Distance from every point in x to its k nearest neighbors (itself
+    included) using a cKDTree
+
+    Parameters
+    ----------
+    x: numpy.ndarray (n_data, n_features)
+        Data
+
+    k: int
+        Number of neighbors
+
+    Returns
+    -------
+    numpy.ndarray (n_data, k)
+        Sorted distances to the k nearest neighbors
+    """
+    dist, _ = cKDTree(x).query(x, k=k)
+    return dist.reshape(x.shape[0], k)
+
+
+def knn_brute(x, k, batch_size=1024):
+    """Exact distance from every point in x to its k nearest neighbors
+    (itself included), distances are computed with one matrix product per
+    block of batch_size points, so memory is O(batch_size * n_data)
+
+    Parameters
+    ----------
+    x: numpy.ndarray (n_data, n_features)
+        Data
+
+    k: int
+        Number of neighbors
+
+    batch_size: int, optional
+        Number of query points per block
+
+    Returns
+    -------
+    numpy.ndarray (n_data, k)
+        Sorted distances to the k nearest neighbors
+    """
+    dist, _ = _knn_block(x, x, k, batch_size)
+    return dist
+
+
+def knn_approx(x, k, n_trees=5, leaf_size=None, random_state=0):
+    """Approximate distance from every point in x to its k nearest
+    neighbors (itself included) using a random projection forest.
+
+    Each tree recursively splits the data in two halves at the median of a
+    random projection, exact neighbors are computed within every leaf and
+    the candidates found by all trees are merged
+
+    Parameters
+    ----------
+    x: numpy.ndarray (n_data, n_features)
+        Data
+
+    k: int
+        Number of neighbors
+
+    n_trees: int, optional
+        Number of trees, more trees give better neighbors at a linear cost
+
+    leaf_size: int, optional
+        Minimum number of points per leaf, defaults to max(4 * k, 64)
+
+    random_state: int, optional
+        Seed for the random projections
+
+    Returns
+    -------
+    numpy.ndarray (n_data, k)
+        Sorted distances to the (approximate) k nearest neighbors, the
+        true distances are upper bounds for these
+    """
+    n_data = x.shape[0]
+    leaf_size = max(4 * k, 64) if leaf_size is None else max(leaf_size, k)
+
+    if n_data <= 2 * leaf_size:
+        return knn_brute(x, k)
+
+    rng = np.random.RandomState(random_state)
+    depth = int(np.floor(np.log2(n_data / float(leaf_size))))
+    position = np.arange(n_data)
+
+    dist_all, ind_all = [], []
+
+    for _ in range(n_trees):
+        # split every node in halves, one level at a time
+        leaf = np.zeros(n_data, 'int64')
+        for level in range(depth):
+            directions = rng.randn(2**level, x.shape[1])
+            proj = np.einsum('ij,ij->i', x, directions[leaf])
+            order = np.lexsort((proj, leaf))
+            sizes = np.bincount(leaf, minlength=2**level)
+            starts = np.cumsum(sizes) - sizes
+            rank = np.empty(n_data, 'int64')
+            rank[order] = position - starts[leaf[order]]
+            leaf = 2*leaf + (rank >= sizes[leaf]//2)
+
+        # exact neighbors within each leaf
+        dist = np.empty((n_data, k))
+        ind = np.empty((n_data, k), 'int64')
+        order = np.argsort(leaf, kind='mergesort')
+        bounds = np.cumsum(np.bincount(leaf, minlength=2**depth))
+        for start, end in zip(np.append(0, bounds[:-1]), bounds):
+            idx = order[start:end]
+            dist[idx], ind_leaf = _knn_block(x[idx], x[idx], k)
+            ind[idx] = idx[ind_leaf]
+
+        dist_all.append(dist)
+        ind_all.append(ind)
+
+    # merge candidates from all trees, dropping duplicates
+    dist = np.hstack(dist_all)
+    ind = np.hstack(ind_all)
+    order = np.argsort(ind, axis=1, kind='mergesort')
+    ind = np.take_along_axis(ind, order, 1)
+    dist = np.take_along_axis(dist, order, 1)
+    dist[:, 1:][ind[:, 1:] == ind[:, :-1]] = np.inf
+
+    return np.sort(np.partition(dist, k - 1, axis=1)[:, :k], axis=1)
+
+
+def _knn_block(query, x, k, batch_size=1024):
+    """Exact k nearest neighbors in x for every point in query, returns
+    sorted distances and indexes (n_query, k), k must be at most the number
+    of points in x
+    """
+    sq_x = np.sum(np.square(x), 1)
+
+    dist = np.empty((query.shape[0], k))
+    ind = np.empty((query.shape[0], k), 'int64')
+
+    for start in range(0, query.shape[0], batch_size):
+        q = query[start:start + batch_size]
+        sq_dist = (np.sum(np.square(q), 1)[:, np.newaxis] + sq_x
+                   - 2 * np.matmul(q, x.T))
+
+        if k < x.shape[0]:
+            ind_block = np.argpartition(sq_dist, k - 1, axis=1)[:, :k]
+        else:
+            ind_block = np.tile(np.arange(x.shape[0]), (q.shape[0], 1))
+
+        sq_dist = np.take_along_axis(sq_dist, ind_block, 1)
+        order = np.argsort(sq_dist, axis=1)
+
+        dist[start:start + batch_size] = np.sqrt(np.maximum(
+            np.take_along_axis(sq_dist, order, 1), 0))
+        ind[start:start + batch_size] = np.take_along_axis(ind_block,
+                                                           order, 1)
+
+    return dist, ind
+
+
+KNN_METHODS = {'kdtree': knn_kdtree, 'brute': knn_brute, 'approx': knn_approx}
@@ -1,12 +1,16 @@
+import heapq
 import numpy as np
 import logging
 
 from yass import mfm
-from scipy.sparse import lil_matrix
+from scipy.sparse import coo_matrix, csc_matrix
+
+from yass.cluster.partition import ChannelPartition
 
 
 def run_cluster(scores, masks, groups, spike_index,
-                min_spikes, CONFIG):
+                min_spikes, CONFIG, partition=None, prior_vbParam=None,
+                prior_tmp_loc=None):
     """
     run clustering algorithm using MFM
 
@@ -31,6 +35,16 @@ def run_cluster(scores, masks, groups, spike_index,
     CONFIG: class
        configuration class
 
+    partition: ChannelPartition, optional
+        spikes grouped by main channel, computed from spike_index if None
+
+    prior_vbParam: mfm.vbPar, optional
+        clusters from a previous sort, used to warm start the clustering
+        of each channel (see mfm.split_merge_warm)
+
+    prior_tmp_loc: np.array (n_prior_templates), optional
+        channel where each cluster in prior_vbParam was found
+
     Returns
     -------
     spike_train: np.array (n_data, 2)
@@ -46,18 +60,19 @@ def run_cluster(scores, masks, groups, spike_index,
 
     logger = logging.getLogger(__name__)
 
-    n_channels = np.max(spike_index[:, 1]) + 1
+    if partition is None:
+        partition = ChannelPartition.from_spike_index(spike_index)
+
     global_score = None
     global_vbParam = None
     global_spike_index = None
     global_tmp_loc = None
 
     # run clustering algorithm per main channel
-    for channel in range(n_channels):
+    for channel, idx_data in partition:
 
         logger.info('Processing channel {}'.format(channel))
 
-        idx_data = np.where(spike_index[:, 1] == channel)[0]
         score_channel = scores[idx_data]
         mask_channel = masks[channel]
         group_channel = groups[channel]
@@ -68,7 +83,9 @@ def run_cluster(scores, masks, groups, spike_index,
             # run clustering
             vbParam = mfm.spikesort(score_channel,
                                     mask_channel,
-                                    group_channel, CONFIG)
+                                    group_channel, CONFIG,
+                                    prior_clusters(prior_vbParam,
+                                                   prior_tmp_loc, channel))
 
             # make rhat more sparse
             vbParam.rhat[vbParam.rhat < 0.1] = 0
@@ -90,7 +107,9 @@ def run_cluster(scores, masks, groups, spike_index,
     return global_vbParam, global_tmp_loc, global_score, global_spike_index
 
 
-def run_cluster_location(scores, spike_index, min_spikes, CONFIG):
+def run_cluster_location(scores, spike_index, min_spikes, CONFIG,
+                         partition=None, prior_vbParam=None,
+                         prior_tmp_loc=None):
     """
     run clustering algorithm using MFM and location features
 
@@ -107,6 +126,16 @@ def run_cluster_location(scores, spike_index, min_spikes, CONFIG):
     CONFIG: class
         configuration class
 
+    partition: ChannelPartition, optional
+        spikes grouped by main channel, computed from spike_index if None
+
+    prior_vbParam: mfm.vbPar, optional
+        clusters from a previous sort, used to warm start the clustering
+        of each channel (see mfm.split_merge_warm)
+
+    prior_tmp_loc: np.array (n_prior_templates), optional
+        channel where each cluster in prior_vbParam was found
+
     Returns
     -------
     spike_train: np.array (n_data, 2)
@@ -115,18 +144,19 @@ def run_cluster_location(scores, spike_index, min_spikes, CONFIG):
     """
     logger = logging.getLogger(__name__)
 
-    n_channels = np.max(spike_index[:, 1]) + 1
+    if partition is None:
+        partition = ChannelPartition.from_spike_index(spike_index)
+
     global_score = None
     global_vbParam = None
     global_spike_index = None
     global_tmp_loc = None
 
     # run clustering algorithm per main channel
-    for channel in range(n_channels):
+    for channel, idx_data in partition:
 
         logger.info('Processing channel {}'.format(channel))
 
-        idx_data = np.where(spike_index[:, 1] == channel)[0]
         score_channel = scores[idx_data]
         spike_index_channel = spike_index[idx_data]
         n_data = score_channel.shape[0]
@@ -138,7 +168,9 @@ def run_cluster_location(scores, spike_index, min_spikes, CONFIG):
             group = np.arange(n_data)
             vbParam = mfm.spikesort(np.copy(score_channel),
                                     mask,
-                                    group, CONFIG)
+                                    group, CONFIG,
+                                    prior_clusters(prior_vbParam,
+                                                   prior_tmp_loc, channel))
 
             # make rhat more sparse
             vbParam.rhat[vbParam.rhat < 0.1] = 0
@@ -161,182 +193,329 @@ def run_cluster_location(scores, spike_index, min_spikes, CONFIG):
 
 
 def calculate_sparse_rhat(vbParam, tmp_loc, scores,
-                          spike_index, neighbors):
+                          spike_index, neighbors, partition=None):
+    """
+    Soft assignment of every spike to the clusters found in its main
+    channel
+
+    Parameters
+    ----------
+    vbParam: mfm.vbPar
+        cluster parameters for all channels
+
+    tmp_loc: np.array (n_templates)
+        channel where each cluster was found
+
+    scores: np.array (n_data, n_features, n_channels)
+        scores for all spikes
+
+    spike_index: np.array (n_data, 2)
+        spike times and main channels
+
+    neighbors: np.array (n_channels, n_channels)
+        neighboring channels
+
+    partition: ChannelPartition, optional
+        spikes grouped by main channel, computed from spike_index if None
+
+    Returns
+    -------
+    rhat: scipy.sparse.coo_matrix (n_data, n_templates)
+        rhat[n, k] is the probability of spike n belonging to cluster k,
+        entries are sorted by channel and then by spike
+    """
+    if partition is None:
+        partition = ChannelPartition.from_spike_index(spike_index)
 
     # vbParam.rhat calculation
-    n_channels = np.max(spike_index[:, 1]) + 1
     n_templates = tmp_loc.shape[0]
 
-    rhat = lil_matrix((scores.shape[0], n_templates))
-    rhat = None
-    for channel in range(n_channels):
-
-        idx_data = np.where(spike_index[:, 1] == channel)[0]
-        score = scores[idx_data]
-        n_data = score.shape[0]
+    # clusters found in each channel
+    cluster_partition = ChannelPartition(tmp_loc, partition.n_channels)
 
-        ch_idx = [channel]
-        cluster_idx = np.zeros(n_templates, 'bool')
-        for c in ch_idx:
-            cluster_idx[tmp_loc == c] = 1
-        cluster_idx = np.where(cluster_idx)[0]
+    rows, cols, vals = [], [], []
+    for channel, idx_data in partition:
 
-        if n_data > 0 and cluster_idx.shape[0] > 0:
+        cluster_idx = cluster_partition.indices(channel)
 
-            local_vbParam = mfm.vbPar(None)
-            local_vbParam.muhat = vbParam.muhat[:, cluster_idx]
-            local_vbParam.Vhat = vbParam.Vhat[:, :, cluster_idx]
-            local_vbParam.invVhat = vbParam.invVhat[:, :, cluster_idx]
-            local_vbParam.nuhat = vbParam.nuhat[cluster_idx]
-            local_vbParam.lambdahat = vbParam.lambdahat[cluster_idx]
-            local_vbParam.ahat = vbParam.ahat[cluster_idx]
+        if idx_data.shape[0] > 0 and cluster_idx.shape[0] > 0:
 
-            mask = np.ones([n_data, 1])
-            group = np.arange(n_data)
-            masked_data = mfm.maskData(score, mask, group)
+            local_vbParam = select_clusters(vbParam, cluster_idx)
 
-            local_vbParam.update_local(masked_data)
+            # with a mask of ones and one group per spike, the group means
+            # are the scores
+            local_vbParam.update_local_meanY(scores[idx_data])
             local_vbParam.rhat[local_vbParam.rhat < 0.1] = 0
             local_vbParam.rhat = local_vbParam.rhat / \
                 np.sum(local_vbParam.rhat, axis=1, keepdims=True)
 
             row_idx, col_idx = np.where(local_vbParam.rhat > 0)
-            val = local_vbParam.rhat[row_idx, col_idx]
-            row_idx = idx_data[row_idx]
-            col_idx = cluster_idx[col_idx]
-            rhat_local = np.hstack((row_idx[:, np.newaxis],
-                                    col_idx[:, np.newaxis],
-                                    val[:, np.newaxis]))
-            if rhat is None:
-                rhat = rhat_local
-            else:
-                rhat = np.vstack((rhat, rhat_local))
-
-    return rhat
-
-
-def calculate_maha_clusters(vbParam):
-    diff = np.transpose(vbParam.muhat, [1, 2, 0]) - \
-        vbParam.muhat[..., 0].T
-    clustered_prec = np.transpose(vbParam.Vhat[:, :, :, 0] *
-                                  vbParam.nuhat, [2, 0, 1])
-    maha = np.squeeze(np.matmul(diff[:, :, np.newaxis],
-                                np.matmul(clustered_prec[:, np.newaxis],
-                                          diff[..., np.newaxis])),
-                      axis=[2, 3])
+            vals.append(local_vbParam.rhat[row_idx, col_idx])
+            rows.append(idx_data[row_idx])
+            cols.append(cluster_idx[col_idx])
+
+    if rows:
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        vals = np.concatenate(vals)
+    else:
+        rows = cols = np.zeros(0, 'int64')
+        vals = np.zeros(0)
+
+    return coo_matrix((vals, (rows, cols)),
+                      shape=(scores.shape[0], n_templates))
+
+
+def select_clusters(vbParam, cluster_idx):
+    """
+    Global parameters (no rhat) of a subset of clusters
+
+    Parameters
+    ----------
+    vbParam: mfm.vbPar
+        cluster parameters
+
+    cluster_idx: np.array
+        clusters to select
+
+    Returns
+    -------
+    mfm.vbPar
+    """
+    local_vbParam = mfm.vbPar(None)
+    local_vbParam.muhat = vbParam.muhat[:, cluster_idx]
+    local_vbParam.Vhat = vbParam.Vhat[:, :, cluster_idx]
+    local_vbParam.invVhat = vbParam.invVhat[:, :, cluster_idx]
+    local_vbParam.nuhat = vbParam.nuhat[cluster_idx]
+    local_vbParam.lambdahat = vbParam.lambdahat[cluster_idx]
+    local_vbParam.ahat = vbParam.ahat[cluster_idx]
+
+    return local_vbParam
+
+
+def prior_clusters(prior_vbParam, prior_tmp_loc, channel):
+    """
+    Clusters found in channel in a previous sort, None if there is no
+    previous sort or it has no clusters in this channel
+    """
+    if prior_vbParam is None:
+        return None
+
+    cluster_idx = np.where(prior_tmp_loc == channel)[0]
+
+    if cluster_idx.shape[0] == 0:
+        return None
+
+    return select_clusters(prior_vbParam, cluster_idx)
+
+
+def calculate_maha_clusters(vbParam, pairs=None):
+    """
+    Mahalanobis distance between cluster means, using the precision of the
+    first cluster (summed over channels)
+
+    Parameters
+    ----------
+    vbParam: mfm.vbPar
+        cluster parameters
+
+    pairs: tuple (np.array, np.array), optional
+        only compute the distance for these (i, j) pairs
+
+    Returns
+    -------
+    maha: np.array
+        (K, K) matrix with maha[i, j] the distance from cluster i to j
+        (inf in the diagonal), or one distance per pair if pairs is given
+    """
+    # K x nchannel x nfeature x nfeature and K x nchannel x nfeature
+    prec = np.transpose(vbParam.Vhat * vbParam.nuhat[
+        np.newaxis, np.newaxis, :, np.newaxis], [2, 3, 0, 1])
+    muhat = np.transpose(vbParam.muhat, [1, 2, 0])
+
+    if pairs is not None:
+        i, j = pairs
+        diff = muhat[i] - muhat[j]
+        return np.einsum('pci,pcij,pcj->p', diff, prec[i], diff)
+
+    diff = muhat[:, np.newaxis] - muhat[np.newaxis]
+    maha = np.einsum('klci,kcij,klcj->kl', diff, prec, diff)
     maha[np.diag_indices(maha.shape[0])] = np.inf
 
     return maha
 
 
-def merge_move_patches(cluster, neigh_clusters, scores, vbParam, maha, cfg):
-
-    while len(neigh_clusters) > 0:
-        i = neigh_clusters[-1]
-        # indices = np.logical_or(clusterid == cluster, clusterid == i)
-        indices, temp = vbParam.rhat[:, [cluster, i]].nonzero()
-        indices = np.unique(indices)
-        ka, kb = min(cluster, i), max(cluster, i)
-        local_scores = scores[indices]
-        local_vbParam = mfm.vbPar(
-            vbParam.rhat[:, [cluster, i]].toarray()[indices])
-        local_vbParam.muhat = vbParam.muhat[:, [cluster, i]]
-        local_vbParam.Vhat = vbParam.Vhat[:, :, [cluster, i]]
-        local_vbParam.invVhat = vbParam.invVhat[:, :, [cluster, i]]
-        local_vbParam.nuhat = vbParam.nuhat[[cluster, i]]
-        local_vbParam.lambdahat = vbParam.lambdahat[[cluster, i]]
-        local_vbParam.ahat = vbParam.ahat[[cluster, i]]
-        mask = np.ones([local_scores.shape[0], 1])
-        group = np.arange(local_scores.shape[0])
-        local_maskedData = mfm.maskData(local_scores, mask, group)
-        # local_vbParam.update_local(local_maskedData)
-        local_suffStat = mfm.suffStatistics(local_maskedData, local_vbParam)
-
-        ELBO = mfm.ELBO_Class(local_maskedData, local_suffStat,
-                              local_vbParam, cfg)
-        L = np.ones(2)
-        (local_vbParam, local_suffStat,
-         merged, _, _) = mfm.check_merge(local_maskedData,
-                                         local_vbParam,
-                                         local_suffStat, 0, 1,
-                                         cfg, L, ELBO)
-        if merged:
-            print("merging {}, {}".format(cluster, i))
-            vbParam.muhat = np.delete(vbParam.muhat, kb, 1)
-            vbParam.muhat[:, ka] = local_vbParam.muhat[:, 0]
-
-            vbParam.Vhat = np.delete(vbParam.Vhat, kb, 2)
-            vbParam.Vhat[:, :, ka] = local_vbParam.Vhat[:, :, 0]
-
-            vbParam.invVhat = np.delete(vbParam.invVhat, kb, 2)
-            vbParam.invVhat[:, :, ka] = local_vbParam.invVhat[:, :, 0]
-
-            vbParam.nuhat = np.delete(vbParam.nuhat, kb, 0)
-            vbParam.nuhat[ka] = local_vbParam.nuhat[0]
-
-            vbParam.lambdahat = np.delete(vbParam.lambdahat, kb, 0)
-            vbParam.lambdahat[ka] = local_vbParam.lambdahat[0]
-
-            vbParam.ahat = np.delete(vbParam.ahat, kb, 0)
-            vbParam.ahat[ka] = local_vbParam.ahat[0]
-
-            vbParam.rhat[:, ka] = vbParam.rhat[:, ka] + vbParam.rhat[:, kb]
-            n_data_all, n_templates_all = vbParam.rhat.shape
-            to_keep = list(set(np.arange(n_templates_all))-set([kb]))
-            vbParam.rhat = vbParam.rhat[:, to_keep]
-
-            # clusterid[indices] = ka
-            # clusterid[clusterid > kb] = clusterid[clusterid > kb] - 1
-            neigh_clusters.pop()
-
-            maha = np.delete(maha, kb, 1)
-            maha = np.delete(maha, kb, 0)
-
-            diff = vbParam.muhat[:, :, 0] - local_vbParam.muhat[:, :, 0]
-
-            prec = local_vbParam.Vhat[..., 0] * local_vbParam.nuhat[0]
-            maha[ka] = np.squeeze(
-                np.matmul(
-                    diff.T[:, np.newaxis, :],
-                    np.matmul(prec[:, :, 0],
-                              diff.T[..., np.newaxis])))
-
-            prec = np.transpose(vbParam.Vhat[..., 0] * vbParam.nuhat,
-                                [2, 0, 1])
-            maha[:, ka] = np.squeeze(np.matmul(
-                diff.T[:, np.newaxis, :],
-                np.matmul(prec, diff.T[..., np.newaxis])))
-
-            maha[ka, ka] = np.inf
-            neigh_clusters = list(np.where(
-                np.logical_or(maha[ka] < 15, maha.T[ka] < 15))[0])
-            cluster = ka
-
-        if not merged:
-            maha[ka, kb] = maha[kb, ka] = np.inf
-            neigh_clusters.pop()
-
-    return vbParam, maha
-
-
-def try_merge(k1, k2, scores, vbParam, maha, cfg):
-
-    ka, kb = min(k1, k2), max(k1, k2)
-
-    assignment = vbParam.rhat[:, :2].astype('int32')
-
-    idx_ka = assignment[:, 1] == ka
-    idx_kb = assignment[:, 1] == kb
-
-    indices = np.unique(assignment[
-        np.logical_or(idx_ka, idx_kb), 0])
-
-    rhat = np.zeros((scores.shape[0], 2))
-    rhat[assignment[idx_ka, 0], 0] = vbParam.rhat[idx_ka, 2]
-    rhat[assignment[idx_kb, 0], 1] = vbParam.rhat[idx_kb, 2]
-    rhat = rhat[indices]
+def merge_clusters(vbParam, tmp_loc, scores, neighbors, cfg,
+                   max_distance=15):
+    """
+    Merge clusters that are close to each other, only clusters found in
+    neighboring channels are considered
+
+    Distances between candidate pairs are computed once (as a sparse
+    neighbor graph) and pairs are checked in order of distance using a
+    priority queue. After a merge, only the distances involving the merged
+    cluster are updated
+
+    Parameters
+    ----------
+    vbParam: mfm.vbPar
+        cluster parameters, rhat must be a scipy.sparse matrix
+        (n_data, n_templates), see calculate_sparse_rhat
+
+    tmp_loc: np.array (n_templates)
+        channel where each cluster was found
+
+    scores: np.array (n_data, n_features, n_channels)
+        scores for all spikes
+
+    neighbors: np.array (n_channels, n_channels)
+        neighboring channels
+
+    cfg: class
+        configuration class
+
+    max_distance: float, optional
+        pairs are candidates when the mahalanobis distance (in either
+        direction) is below this
+
+    Returns
+    -------
+    vbParam: mfm.vbPar
+        cluster parameters after merging
+
+    tmp_loc: np.array
+        channel for every cluster after merging
+    """
+    logger = logging.getLogger(__name__)
+
+    n_templates = tmp_loc.shape[0]
+
+    # columns of rhat, (spike indexes, probabilities) per cluster
+    rhat = csc_matrix(vbParam.rhat)
+    columns = [(rhat.indices[rhat.indptr[k]:rhat.indptr[k + 1]],
+                rhat.data[rhat.indptr[k]:rhat.indptr[k + 1]])
+               for k in range(n_templates)]
+
+    # neighbor graph: clusters in neighboring channels
+    graph = coo_matrix(neighbors[tmp_loc][:, tmp_loc])
+    i, j = graph.row, graph.col
+    i, j = i[i < j], j[i < j]
+    dist = np.minimum(calculate_maha_clusters(vbParam, (i, j)),
+                      calculate_maha_clusters(vbParam, (j, i)))
+
+    # copy parameters, merged clusters are updated in place
+    vbParam = select_clusters(vbParam, np.arange(n_templates))
+
+    adjacency = [set() for _ in range(n_templates)]
+    for a, b in zip(i, j):
+        adjacency[a].add(b)
+        adjacency[b].add(a)
+
+    # entries are invalidated when one of the clusters changes
+    version = np.zeros(n_templates, 'int64')
+    alive = np.ones(n_templates, 'bool')
+
+    queue = [(d, a, b, 0, 0) for d, a, b in zip(dist, i, j)
+             if d < max_distance]
+    heapq.heapify(queue)
+
+    while queue:
+        d, a, b, version_a, version_b = heapq.heappop(queue)
+
+        if (not alive[a] or not alive[b] or version[a] != version_a or
+                version[b] != version_b):
+            continue
+
+        if not try_merge(a, b, scores, vbParam, columns, cfg):
+            continue
+
+        logger.debug('Merging clusters {} and {}'.format(a, b))
+
+        # b is merged into a
+        alive[b] = False
+        version[a] += 1
+        for c in adjacency[b] - set([a]):
+            adjacency[c].discard(b)
+            adjacency[c].add(a)
+        adjacency[a] = (adjacency[a] | adjacency[b]) - set([a, b])
+        adjacency[b] = set()
+
+        others = np.array(sorted(c for c in adjacency[a] if alive[c]),
+                          'int64')
+        if others.shape[0] > 0:
+            same = np.ones_like(others)*a
+            dist = np.minimum(calculate_maha_clusters(vbParam,
+                                                      (same, others)),
+                              calculate_maha_clusters(vbParam,
+                                                      (others, same)))
+            for c, d in zip(others, dist):
+                if d < max_distance:
+                    heapq.heappush(queue, (d, min(a, c), max(a, c),
+                                           version[min(a, c)],
+                                           version[max(a, c)]))
+
+    # drop merged clusters
+    keep = np.where(alive)[0]
+    new_id = np.cumsum(alive) - 1
+
+    vbParam.muhat = vbParam.muhat[:, keep]
+    vbParam.Vhat = vbParam.Vhat[:, :, keep]
+    vbParam.invVhat = vbParam.invVhat[:, :, keep]
+    vbParam.nuhat = vbParam.nuhat[keep]
+    vbParam.lambdahat = vbParam.lambdahat[keep]
+    vbParam.ahat = vbParam.ahat[keep]
+
+    rows = np.concatenate([columns[k][0] for k in keep])
+    vals = np.concatenate([columns[k][1] for k in keep])
+    cols = np.repeat(new_id[keep], [columns[k][0].shape[0] for k in keep])
+    vbParam.rhat = coo_matrix((vals, (rows, cols)),
+                              shape=(rhat.shape[0], keep.shape[0]))
+
+    logger.info('Merged {} clusters into {}'.format(n_templates,
+                                                    keep.shape[0]))
+
+    return vbParam, tmp_loc[keep]
+
+
+def try_merge(ka, kb, scores, vbParam, columns, cfg):
+    """
+    Check whether merging two clusters increases the ELBO, if so,
+    parameters of ka are replaced by the merged cluster and the soft
+    assignments of kb are added to ka (vbParam and columns are modified in
+    place, kb is left untouched)
+
+    Parameters
+    ----------
+    ka, kb: int
+        clusters to merge
+
+    scores: np.array (n_data, n_features, n_channels)
+        scores for all spikes
+
+    vbParam: mfm.vbPar
+        cluster parameters
+
+    columns: list
+        (spike indexes, probabilities) for every cluster
+
+    cfg: class
+        configuration class
+
+    Returns
+    -------
+    merged: bool
+        Whether the clusters were merged
+    """
+    rows_a, vals_a = columns[ka]
+    rows_b, vals_b = columns[kb]
+
+    # spikes assigned to any of the clusters and their local rhat
+    indices, position = np.unique(np.concatenate((rows_a, rows_b)),
+                                  return_inverse=True)
+    rhat = np.zeros((indices.shape[0], 2))
+    rhat[position[:rows_a.shape[0]], 0] = vals_a
+    rhat[position[rows_a.shape[0]:], 1] = vals_b
 
-    local_scores = scores[indices]
     local_vbParam = mfm.vbPar(rhat)
     local_vbParam.muhat = vbParam.muhat[:, [ka, kb]]
     local_vbParam.Vhat = vbParam.Vhat[:, :, [ka, kb]]
@@ -345,13 +524,14 @@ def try_merge(k1, k2, scores, vbParam, maha, cfg):
     local_vbParam.lambdahat = vbParam.lambdahat[[ka, kb]]
     local_vbParam.ahat = vbParam.ahat[[ka, kb]]
 
+    local_scores = scores[indices]
     mask = np.ones([local_scores.shape[0], 1])
     group = np.arange(local_scores.shape[0])
     local_maskedData = mfm.maskData(local_scores, mask, group)
-    # local_vbParam.update_local(local_maskedData)
     local_suffStat = mfm.suffStatistics(local_maskedData, local_vbParam)
 
-    ELBO = mfm.ELBO_Class(local_maskedData, local_suffStat, local_vbParam, cfg)
+    ELBO = mfm.ELBO_Class(local_maskedData, local_suffStat, local_vbParam,
+                          cfg)
     L = np.ones(2)
     (local_vbParam, local_suffStat,
      merged, _, _) = mfm.check_merge(local_maskedData,
@@ -359,59 +539,16 @@ def try_merge(k1, k2, scores, vbParam, maha, cfg):
                                      local_suffStat, 0, 1,
                                      cfg, L, ELBO)
     if merged:
-        print("merging {}, {}".format(ka, kb))
-
-        vbParam.muhat = np.delete(vbParam.muhat, kb, 1)
         vbParam.muhat[:, ka] = local_vbParam.muhat[:, 0]
-
-        vbParam.Vhat = np.delete(vbParam.Vhat, kb, 2)
         vbParam.Vhat[:, :, ka] = local_vbParam.Vhat[:, :, 0]
-
-        vbParam.invVhat = np.delete(vbParam.invVhat, kb, 2)
         vbParam.invVhat[:, :, ka] = local_vbParam.invVhat[:, :, 0]
-
-        vbParam.nuhat = np.delete(vbParam.nuhat, kb, 0)
         vbParam.nuhat[ka] = local_vbParam.nuhat[0]
-
-        vbParam.lambdahat = np.delete(vbParam.lambdahat, kb, 0)
         vbParam.lambdahat[ka] = local_vbParam.lambdahat[0]
-
-        vbParam.ahat = np.delete(vbParam.ahat, kb, 0)
         vbParam.ahat[ka] = local_vbParam.ahat[0]
 
-        idx_delete = np.where(np.logical_or(idx_ka, idx_kb))[0]
-        vbParam.rhat = np.delete(vbParam.rhat, idx_delete, 0)
-        vbParam.rhat[vbParam.rhat[:, 1] > kb, 1] -= 1
-
-        rhat_temp = np.hstack((indices[:, np.newaxis],
-                               np.ones((indices.size, 1))*ka,
-                               np.sum(rhat, 1, keepdims=True)))
-        vbParam.rhat = np.vstack((vbParam.rhat, rhat_temp))
-
-        maha = np.delete(maha, kb, 1)
-        maha = np.delete(maha, kb, 0)
-
-        diff = vbParam.muhat[:, :, 0] - local_vbParam.muhat[:, :, 0]
-
-        prec = local_vbParam.Vhat[..., 0] * local_vbParam.nuhat[0]
-        maha[ka] = np.squeeze(
-            np.matmul(
-                diff.T[:, np.newaxis, :],
-                np.matmul(prec[:, :, 0],
-                          diff.T[..., np.newaxis])))
-
-        prec = np.transpose(vbParam.Vhat[..., 0] * vbParam.nuhat,
-                            [2, 0, 1])
-        maha[:, ka] = np.squeeze(
-            np.matmul(diff.T[:, np.newaxis, :],
-                      np.matmul(prec, diff.T[..., np.newaxis])))
-
-        maha[ka, ka] = np.inf
-
-    if not merged:
-        maha[ka, kb] = maha[kb, ka] = np.inf
+        columns[ka] = (indices, np.sum(rhat, 1))
 
-    return vbParam, maha
+    return bool(merged)
 
 
 def global_cluster_info(vbParam, main_channel,
@@ -1,14 +1,16 @@
 import numpy as np
 import logging
+from multiprocess.pool import ThreadPool
 
 from yass.deconvolute.util import upsample_templates, \
-    make_spt_list, get_longer_spt_list
+    make_spt_index, get_channels_spt, get_longer_spt_list, \
+    independent_template_sets, subtract_spikes
 from yass.deconvolute.match import make_tf_tensors, template_match
 
 
 def deconvolve(recording, idx_local, idx, templates, spike_index,
                spike_size, n_explore, n_rf, upsample_factor,
-               threshold_a, threshold_dd):
+               threshold_a, threshold_dd, threads=1, residual_path=None):
     """
     run greedy deconvolution algorithm
 
@@ -42,6 +44,18 @@ def deconvolve(recording, idx_local, idx, templates, spike_index,
         threshold on decrease in l2 norm of recording after
         subtracting a template (check make_tf_tensors)
 
+    threads: int, optional
+        Number of threads, templates whose channels do not overlap are
+        matched and subtracted at the same time. Only useful if templates
+        are zero outside their neighborhood, if all templates share
+        channels they are deconvolved one at a time. Defaults to 1
+
+    residual_path: str, optional
+        Binary file (with the same shape and dtype as the recording) where
+        the recording after subtracting the deconvolved spikes is written,
+        every batch writes the observations outside the buffer at their
+        location. Not written if None
+
     Returns
     -------
     spike_train: numpy.ndarray (n_spikes_recovered, 2)
@@ -89,18 +103,15 @@ def deconvolve(recording, idx_local, idx, templates, spike_index,
                                           threshold_a,
                                           threshold_dd)
 
-    # change the format of spike index for easier access
-    spt_list = make_spt_list(spike_index, n_channels)
+    # index spike times by channel for easier access
+    spike_times, spike_offsets = make_spt_index(spike_index, n_channels)
 
-    # do template matching in a greedy way from biggest template
-    # to the smallest
-    spike_train = np.zeros((0, 2), 'int32')
-    for j in range(n_templates):
-        logger.debug("Deconvolving {0} out of {1} templates.".format(
-            j+1, n_templates))
+    # channels where every template is not zero, subtracting a template
+    # only changes these channels
+    support = np.any(templates != 0, axis=1)
 
-        # cluster and its main channel
-        k = templates_order[j]
+    def deconvolve_template(k):
+        # main channel of the cluster
         mainc = principal_channels[k]
 
         # channels with big enough energy relative to energy
@@ -118,28 +129,74 @@ def deconvolve(recording, idx_local, idx, templates, spike_index,
         # localize recording
         rec_local = rec[:, channels_big]
 
-        # localize spike times
-        spt_interest = np.zeros(0, 'int32')
-        for c in range(channels_big.shape[0]):
-            spt_interest = np.concatenate((
-                spt_interest, spt_list[channels_big[c]]))
-        # for each spike time t, add t-n_explore : t+n_explore to
-        # spike times of interest too
-        spt_interest = get_longer_spt_list(spt_interest, n_explore)
+        # localize spike times, for each spike time t, add
+        # t-n_explore : t+n_explore to spike times of interest too
+        spt_interest = get_longer_spt_list(
+            get_channels_spt(spike_times, spike_offsets, channels_big),
+            n_explore)
 
         # run template match
         spt_good, ahat_good, max_idx_good = template_match(
             rec_local, spt_interest, upsampled_template_local,
             n_rf, rec_local_tf, template_local_tf, spt_tf, result)
 
-        # subtract off deconvolved spikes from the recording
-        for j in range(spt_good.shape[0]):
-            rec[spt_good[j]-R:spt_good[j]+R+1
-                ] -= ahat_good[j]*upsampled_template[max_idx_good[j]].T
+        # subtract off deconvolved spikes from the recording, only on the
+        # channels where the template is not zero so templates running
+        # at the same time never write the same channels
+        channels_support = np.where(support[:, k])[0]
+        subtract_spikes(rec, spt_good, ahat_good, max_idx_good,
+                        upsampled_template[:, channels_support],
+                        channels_support)
 
-        # collect detected spike times
+        return spt_good
+
+    # do template matching in a greedy way from biggest template
+    # to the smallest, templates in the same set do not share channels so
+    # they give the same result in any order
+    template_sets = None
+    if threads > 1:
+        template_sets = independent_template_sets(support, templates_order)
+
+        # templates that are not zero outside their neighborhood share
+        # channels with all other templates, so there is nothing to run
+        # at the same time
+        if max(template_set.shape[0] for template_set in template_sets) == 1:
+            logger.debug('All templates share channels, deconvolving them '
+                         'one at a time')
+            template_sets = None
+
+    spt_good_all = {}
+    if template_sets is None:
+        for j, k in enumerate(templates_order):
+            logger.debug("Deconvolving {0} out of {1} templates.".format(
+                j+1, n_templates))
+            spt_good_all[k] = deconvolve_template(k)
+    else:
+        pool = ThreadPool(threads)
+        for j, template_set in enumerate(template_sets):
+            logger.debug("Deconvolving {0} templates (set {1} out of {2})."
+                         .format(template_set.shape[0], j+1,
+                                 len(template_sets)))
+            spt_good_all.update(zip(template_set,
+                                    pool.map(deconvolve_template,
+                                             template_set)))
+        pool.close()
+        pool.join()
+
+    if residual_path is not None:
+        n_observations = data_end - data_start
+        residual = np.memmap(residual_path, dtype=rec.dtype, mode='r+',
+                             offset=data_start*n_channels*rec.itemsize,
+                             shape=(n_observations, n_channels))
+        residual[:] = rec[offset:(offset + n_observations)]
+        residual.flush()
+
+    # collect detected spike times
+    spike_train = np.zeros((0, 2), 'int32')
+    for k in templates_order:
         spike_train = np.vstack((spike_train, np.vstack((
-                spt_good, np.ones(spt_good.shape[0], 'int32')*k)).T))
+            spt_good_all[k],
+            np.ones(spt_good_all[k].shape[0], 'int32')*k)).T))
 
     return spike_train
 
@@ -6,11 +6,12 @@ import numpy as np
 from yass.deconvolute.deconvolve import deconvolve, fix_indexes
 from yass import read_config
 from yass.batch import BatchProcessor
+from yass.batch.util import make_metadata
 from yass.util import file_loader, file_saver
 
 
 def run(spike_index, templates, output_directory='tmp/',
-        recordings_filename='standarized.bin'):
+        recordings_filename='standarized.bin', residual_path=None):
     """Deconvolute spikes
 
     Parameters
@@ -34,6 +35,13 @@ def run(spike_index, templates, output_directory='tmp/',
         output_directory) used to draw the waveforms from, defaults to
         standarized.bin
 
+    residual_path: str, optional
+        Where to save the residual recording (the recording after
+        subtracting all deconvolved spikes), relative to
+        CONFIG.data.root_folder. Its parameters are saved in a yaml file
+        next to it so it can be used as input for detection. Not saved if
+        None
+
     Returns
     -------
     spike_train: numpy.ndarray (n_clear_spikes, 2)
@@ -62,6 +70,21 @@ def run(spike_index, templates, output_directory='tmp/',
     bp = BatchProcessor(recording_path,
                         buffer_size=templates.shape[1])
 
+    if residual_path is not None:
+        residual_path = os.path.join(CONFIG.data.root_folder, residual_path)
+        residual_folder = os.path.dirname(residual_path)
+
+        if not os.path.exists(residual_folder):
+            os.makedirs(residual_folder)
+
+        # the file is allocated once and every batch writes its residual at
+        # its own offset
+        np.memmap(residual_path, dtype=bp.reader.dtype, mode='w+',
+                  shape=bp.reader.shape).flush()
+
+        make_metadata('all', bp.reader.channels, str(bp.reader.dtype),
+                      residual_path)
+
     logging.debug('Starting deconvolution. templates.shape: {}, '
                   'spike_index.shape: {}'
                   .format(templates.shape, spike_index.shape))
@@ -76,6 +99,7 @@ def run(spike_index, templates, output_directory='tmp/',
         mode='memory',
         cleanup_function=fix_indexes,
         pass_batch_info=True,
+        processes=CONFIG.resources.processes,
         templates=templates,
         spike_index=spike_index,
         spike_size=CONFIG.spike_size,
@@ -83,7 +107,9 @@ def run(spike_index, templates, output_directory='tmp/',
         n_rf=n_rf,
         upsample_factor=CONFIG.deconvolution.upsample_factor,
         threshold_a=CONFIG.deconvolution.threshold_a,
-        threshold_dd=CONFIG.deconvolution.threshold_dd)
+        threshold_dd=CONFIG.deconvolution.threshold_dd,
+        threads=CONFIG.deconvolution.threads,
+        residual_path=residual_path)
 
     spike_train = np.concatenate([element for element in res], axis=0)
 
@@ -99,4 +125,7 @@ def run(spike_index, templates, output_directory='tmp/',
     logger.info('Spike train saved in %s', path_to_spike_train)
     file_saver(spike_train, path_to_spike_train)
 
+    if residual_path is not None:
+        logger.info('Residual recording saved in %s', residual_path)
+
     return spike_train
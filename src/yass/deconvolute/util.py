@@ -42,10 +42,11 @@ def upsample_templates(template, n_shifts=5):
     return shifted_templates
 
 
-def make_spt_list(spike_index, n_channels):
+def make_spt_index(spike_index, n_channels):
     """
-    Change a data structure of spike_index from an array of two
-    columns to a list
+    Index spike times by channel, in the same layout as a CSR matrix:
+    spike times are sorted by channel (and time) and offsets mark where
+    each channel starts
 
     Parameters
     ----------
@@ -55,21 +56,51 @@ def make_spt_list(spike_index, n_channels):
        where the first column is spike time and the second is channel.
 
     n_channels: int
-       the number of channels in recording (or length of output list)
+       the number of channels in recording
 
     Returns
     -------
-    spike_index_list: list (n_channels)
-        A list such that spike_index_list[c] cointains all spike times
-        whose channel is c
+    spike_times: numpy.ndarray (n_spikes)
+        Spike times sorted by channel, spike times whose channel is c are
+        spike_times[offsets[c]:offsets[c+1]]
+
+    offsets: numpy.ndarray (n_channels + 1)
+        Where the spike times of every channel start
+    """
+    order = np.lexsort((spike_index[:, 0], spike_index[:, 1]))
+    spike_times = spike_index[order, 0]
+    offsets = np.searchsorted(spike_index[order, 1], np.arange(n_channels+1))
+
+    return spike_times, offsets
+
+
+def get_channels_spt(spike_times, offsets, channels):
     """
+    Spike times whose channel is any of channels, without looping over
+    channels
+
+    Parameters
+    ----------
+
+    spike_times, offsets: numpy.ndarray
+        Output of make_spt_index
 
-    spike_index_list = [None]*n_channels
+    channels: numpy.ndarray
+        Channels to get spike times from
 
-    for c in range(n_channels):
-        spike_index_list[c] = spike_index[spike_index[:, 1] == c, 0]
+    Returns
+    -------
+    spt: numpy.ndarray
+        Spike times, grouped by channel
+    """
+    starts = offsets[channels]
+    sizes = offsets[channels + 1] - starts
 
-    return spike_index_list
+    # position of every spike time in spike_times
+    idx = (np.repeat(starts - np.cumsum(sizes) + sizes, sizes)
+           + np.arange(np.sum(sizes)))
+
+    return spike_times[idx]
 
 
 def get_longer_spt_list(spt, n_explore):
@@ -89,18 +120,103 @@ def get_longer_spt_list(spt, n_explore):
     Returns
     -------
     spt_long: numpy.ndarray
-        A new list containing additions spike times
+        A new list containing additions spike times, sorted and without
+        duplicates
+    """
+
+    # add -n_explore to n_explore points around each spike time and remove
+    # duplicates (np.unique returns them sorted)
+    return np.unique(np.add(spt[:, np.newaxis],
+                            np.arange(-n_explore, n_explore+1)[np.newaxis, :]))
+
+
+def subtract_spikes(rec, spt, ahat, max_idx, upsampled_template, channels):
+    """
+    Subtract scaled templates at the given spike times from a recording,
+    in place
+
+    Templates are transposed once to the recording layout and every spike
+    is subtracted from a slice of rec (a contiguous block of memory when
+    channels is a range), spikes are subtracted in order so overlapping
+    waveforms give the same result as subtracting them one by one
+
+    Parameters
+    ----------
+
+    rec: numpy.ndarray (T, n_channels)
+        Recording
+
+    spt: numpy.ndarray (n_spikes)
+        Spike times (center of the waveforms)
+
+    ahat: numpy.ndarray (n_spikes)
+        Scale of every spike
+
+    max_idx: numpy.ndarray (n_spikes)
+        Shifted template used for every spike
+
+    upsampled_template: numpy.ndarray (n_shifts, n_local_channels,
+        waveform_size)
+        Shifted templates
+
+    channels: numpy.ndarray (n_local_channels)
+        Channels in rec where templates are subtracted, sorted
+    """
+    waveform_size = upsampled_template.shape[2]
+    R = int((waveform_size - 1)/2)
+
+    # (n_shifts, waveform_size, n_local_channels)
+    templates_t = np.ascontiguousarray(
+        upsampled_template.transpose(0, 2, 1))
+
+    # a slice of channels avoids copying with fancy indexing
+    if (channels.shape[0] and
+            channels[-1] - channels[0] + 1 == channels.shape[0]):
+        channels = slice(channels[0], channels[-1] + 1)
+
+    start = spt - R
+    end = spt + R + 1
+
+    for j in range(spt.shape[0]):
+        rec[start[j]:end[j], channels] -= ahat[j]*templates_t[max_idx[j]]
+
+
+def independent_template_sets(support, templates_order):
+    """
+    Group templates in sets that can be deconvolved at the same time
+
+    Two templates conflict if they share any channel. Every template goes
+    to the set after the last set with a template that conflicts with it
+    and comes earlier in templates_order, so templates in a set do not
+    conflict and running the sets one after another gives the same result
+    as running the templates in templates_order
+
+    Parameters
+    ----------
+
+    support: numpy.ndarray (n_channels, n_templates)
+        Boolean array, True for the channels where a template is not zero
+
+    templates_order: numpy.ndarray (n_templates)
+        Order in which templates are deconvolved
+
+    Returns
+    -------
+    template_sets: list
+        Arrays with the templates in every set, in templates_order
     """
+    support = support.astype('int32')
+    conflict = np.matmul(support.T, support) > 0
 
-    # sort spike time
-    spt = np.sort(spt)
+    level = np.zeros(support.shape[1], 'int32')
+    for j, k in enumerate(templates_order):
+        earlier = templates_order[:j]
+        earlier = earlier[conflict[k, earlier]]
 
-    # add -n_explore to n_explore points around each spike time
-    all_spikes = np.reshape(np.add(spt[:, np.newaxis],
-                                   np.arange(-n_explore, n_explore+1)
-                                   [np.newaxis, :]), -1)
+        if earlier.shape[0]:
+            level[k] = np.max(level[earlier]) + 1
 
-    # if there are any duplicate remove it
-    spt_long = np.sort(np.unique(all_spikes))
+    level_ordered = level[templates_order]
 
-    return spt_long
+    return [templates_order[level_ordered == i]
+            for i in range(np.max(level_ordered) + 1)]
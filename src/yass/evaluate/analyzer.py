@@ -1,13 +1,22 @@
+import copy
 import numpy as np
 import os
 import yaml
 
+try:
+    # py3
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import multiprocess
+
 from yass.evaluate.stability import (MeanWaveCalculator,
                                      RecordingAugmentation,
-                                     RecordingBatchIterator,
+                                     RecordingBatchProcessor,
                                      SpikeSortingEvaluation)
 from yass.evaluate.visualization import ChristmasPlot, WaveFormTrace
-from yass.evaluate.util import temp_snr
+from yass.evaluate.util import temp_snr, artifact_key
 from yass.pipeline import run
 
 
@@ -32,7 +41,7 @@ class Analyzer(object):
         if isinstance(self.config, str):
             self.config_file = config
             self.load_config()
-        elif not isinstance(self.config, map):
+        elif not isinstance(self.config, Mapping):
             raise ValueError("config should either of type map or str.")
         self.gold_std_spike_train = gold_std_spike_train
         # Directories that contain necessary metrics, intermediate files.
@@ -71,17 +80,22 @@ class Analyzer(object):
     def run_stability(self, n_batches=6):
         """Runs stability metric computation for the given config file.
 
+        Intermediate outputs (spike trains, templates and the augmented
+        recording) are saved in folders named after a hash of everything
+        they depend on (see artifact_key), so calling this again only
+        recomputes the outputs whose inputs changed. yass runs in a separate
+        process while the gold standard templates are computed.
+
         Parameters
         ----------
         n_batchs: int
             Break down the processing of the dataset in these many batches.
         """
-        # Check whether this analysis is not done already.
-        if os.path.isfile(self.stability_file):
-            return
         sampling_rate = self.config['recordings']['sampling_rate']
         n_chan = self.config['recordings']['n_channels']
         dtype = self.config['recordings']['dtype']
+        data_order = self.config['recordings']['order']
+        processes = self.config.get('resources', {}).get('processes', 1)
         spike_length = self.config['recordings']['spike_size_ms']
         # Extracting window around spikes.
         window_radius = int(spike_length * sampling_rate / 1e3)
@@ -91,85 +105,107 @@ class Analyzer(object):
                 self.root_dir, self.config['data']['recordings'])
         geom_file = os.path.join(
                 self.root_dir, self.config['data']['geometry'])
-        # Check whether spike sorting has already been completed.
-        if not os.path.isfile(self.yass_spike_train_file):
-            spike_train = run(config=self.config)
-        else:
-            spike_train = np.load(self.yass_spike_train_file)
         # Data augmentation setup.
-        os.path.getsize(bin_file)
         file_size_bytes = os.path.getsize(bin_file)
         tot_samples = file_size_bytes / (np.dtype(dtype).itemsize * n_chan)
         radius = 70
         n_batch_samples = int(tot_samples / n_batches)
 
-        bin_extension = os.path.splitext(bin_file)[1]
-        aug_file_name = 'augmented_recording{}'.format(bin_extension)
-        aug_bin_file = os.path.join(self.tmp_dir, aug_file_name)
-
-        # Check whether data augmentation has been done before or not.
-        is_file_aug_bin = os.path.isfile(aug_bin_file)
-        is_file_aug_spt = os.path.isfile(self.aug_spike_train_file)
-        is_file_yass_temp = os.path.isfile(self.yass_templates_file)
-        if is_file_aug_bin and is_file_aug_spt and is_file_yass_temp:
-            aug_gold_spt = np.load(self.aug_spike_train_file)
-        else:
-            batch_reader = RecordingBatchIterator(
-                bin_file, geom_file, sample_rate=sampling_rate,
+        def recording(path, **kwargs):
+            return RecordingBatchProcessor(
+                path, geom_file, sample_rate=sampling_rate,
                 batch_time_samples=n_batch_samples, n_batches=n_batches,
-                n_chan=n_chan, radius=radius, whiten=False)
-            mean_wave = MeanWaveCalculator(
-                    batch_reader, spike_train, window=window)
+                n_chan=n_chan, radius=radius, whiten=False,
+                processes=processes, **kwargs)
+
+        # Run yass on the original recording, while the gold standard
+        # templates are computed.
+        sort_key = artifact_key(self.config)
+        self.yass_spike_train_file = self._artifact(
+            sort_key, 'tmp', 'spike_train.npy')
+        sort = self._start_sort(self.config, sort_key)
+
+        batch_reader = recording(
+            bin_file, dtype=dtype, data_order=data_order,
+            output_path=os.path.join(self.tmp_dir, 'filtered.bin'))
+        recording_key = artifact_key(self.config['data'],
+                                     self.config['recordings'], n_batches)
+
+        def templates(batch_reader, spike_train):
+            mean_wave = MeanWaveCalculator(batch_reader, spike_train,
+                                           window=window)
             mean_wave.compute_templates(n_batches=n_batches)
-            np.save(self.yass_templates_file, mean_wave.templates)
-            # Compute gold standard mean waveforms too.
-            gold_standard_mean_wave = MeanWaveCalculator(
-                    batch_reader, self.gold_std_spike_train, window=window)
-            gold_standard_mean_wave.compute_templates(n_batches=n_batches)
-            np.save(self.gold_templates_file,
-                    gold_standard_mean_wave.templates)
-            # Augment with new spikes.
+            return mean_wave
+
+        if self.gold_std_spike_train is not None:
+            gold_templates = self._cached(
+                artifact_key(recording_key, self.gold_std_spike_train),
+                'gold_templates.npy',
+                lambda: templates(batch_reader,
+                                  self.gold_std_spike_train).templates)
+            np.save(self.gold_templates_file, gold_templates)
+
+        self._join_sort(sort)
+        spike_train = np.load(self.yass_spike_train_file)
+
+        # Augment with new spikes, from the yass templates.
+        templates_key = artifact_key(recording_key, sort_key)
+        aug_key = artifact_key(templates_key, 0.25, 0.2)
+        aug_file_name = 'augmented_recording{}'.format(
+            os.path.splitext(bin_file)[1])
+        aug_bin_file = self._artifact(aug_key, aug_file_name)
+        aug_spike_train_file = self._artifact(aug_key,
+                                              'augmented_spike_train.npy')
+        yass_templates_file = self._artifact(templates_key,
+                                             'yass_templates.npy')
+
+        if not (os.path.isfile(aug_bin_file) and
+                os.path.isfile(aug_spike_train_file) and
+                os.path.isfile(yass_templates_file)):
+            mean_wave = templates(batch_reader, spike_train)
+            np.save(yass_templates_file, mean_wave.templates)
             stab = RecordingAugmentation(
                     mean_wave, augment_rate=0.25, move_rate=0.2)
             aug_gold_spt, status = stab.save_augment_recording(
                     aug_bin_file, n_batches)
-            np.save(self.aug_spike_train_file, aug_gold_spt)
-            np.save(os.path.join(self.tmp_dir, 'geom.npy'),
+            np.save(aug_spike_train_file, aug_gold_spt)
+            np.save(self._artifact(aug_key, 'geom.npy'),
                     batch_reader.geometry)
 
-        # Setting up config file for yass to run on augmented data.
-        self.config['data']['root_folder'] = self.tmp_dir
-        self.config['data']['recordings'] = aug_file_name
-        self.config['data']['geometry'] = 'geom.npy'
-        # Check whether spike sorting has already been completed.
-        if not os.path.isfile(self.yass_aug_spike_train_file):
-            yass_aug_spike_train = run(config=self.config)
-        else:
-            yass_aug_spike_train = np.load(self.yass_aug_spike_train_file)
-        # Evaluate stability of yass.
-        # Check whether the mean wave of the yass spike train on the augmented
-        # data has been computed before or not.
-        is_file_temp_yass = os.path.isfile(self.yass_aug_templates_file)
-        is_file_temp_gold = os.path.isfile(self.gold_aug_templates_file)
-        if is_file_temp_gold and is_file_temp_yass:
-            gold_aug_templates = np.load(self.gold_aug_templates_file)
-            yass_aug_templates = np.load(self.yass_aug_templates_file)
-        else:
-            batch_reader = RecordingBatchIterator(
-                aug_bin_file, geom_file, sample_rate=sampling_rate,
-                batch_time_samples=n_batch_samples, n_batches=n_batches,
-                n_chan=n_chan, radius=radius, filter_std=False, whiten=False)
-            aug_gold_standard_mean_wave = MeanWaveCalculator(
-                batch_reader, aug_gold_spt, window=window)
-            aug_gold_standard_mean_wave.compute_templates(n_batches=n_batches)
-            gold_aug_templates = aug_gold_standard_mean_wave.templates
-            aug_yass_mean_wave = MeanWaveCalculator(
-                batch_reader, yass_aug_spike_train, window=window)
-            aug_yass_mean_wave.compute_templates(n_batches=n_batches)
-            yass_aug_templates = aug_yass_mean_wave.templates
-            batch_reader.close_iterator()
-            np.save(self.gold_aug_templates_file, gold_aug_templates)
-            np.save(self.yass_aug_templates_file, yass_aug_templates)
+        batch_reader.close_iterator()
+        aug_gold_spt = np.load(aug_spike_train_file)
+        np.save(self.yass_templates_file, np.load(yass_templates_file))
+        np.save(self.aug_spike_train_file, aug_gold_spt)
+        np.save(os.path.join(self.tmp_dir, 'geom.npy'),
+                np.load(self._artifact(aug_key, 'geom.npy')))
+
+        # Run yass on the augmented data, while the gold standard templates
+        # on the augmented data are computed.
+        aug_config = copy.deepcopy(self.config)
+        aug_config['data']['root_folder'] = self.tmp_dir
+        aug_config['data']['recordings'] = os.path.join(aug_key,
+                                                        aug_file_name)
+        aug_config['data']['geometry'] = os.path.join(aug_key, 'geom.npy')
+        aug_sort_key = artifact_key(aug_config)
+        self.yass_aug_spike_train_file = self._artifact(
+            aug_sort_key, 'tmp', 'spike_train.npy')
+        sort = self._start_sort(aug_config, aug_sort_key)
+
+        batch_reader = recording(aug_bin_file, filter_std=False)
+        gold_aug_templates = self._cached(
+            artifact_key(aug_key, n_batches), 'aug_templates.npy',
+            lambda: templates(batch_reader, aug_gold_spt).templates)
+
+        self._join_sort(sort)
+        yass_aug_spike_train = np.load(self.yass_aug_spike_train_file)
+        yass_aug_templates = self._cached(
+            artifact_key(aug_key, aug_sort_key, n_batches),
+            'yass_aug_templates.npy',
+            lambda: templates(batch_reader, yass_aug_spike_train).templates)
+
+        np.save(self.gold_aug_templates_file, gold_aug_templates)
+        np.save(self.yass_aug_templates_file, yass_aug_templates)
+
         # Finally, instantiate a spike train evaluation object for comparisons.
         stability_eval = SpikeSortingEvaluation(
             aug_gold_spt, yass_aug_spike_train, gold_aug_templates,
@@ -186,23 +222,70 @@ class Analyzer(object):
         This can be performed only if there is a gold standard
         spike train and run_stability has been called before.
         """
-        # Check whether this analysis is not done already.
         if self.gold_std_spike_train is None:
             print("Can not run accuracy if there is no gold standard.")
-        if os.path.isfile(self.accuracy_file):
             return
-        # Evaluate accuracy of yass.
+        # Evaluate accuracy of yass, skipped if it was already evaluated
+        # with the same inputs.
         spike_train = np.load(self.yass_spike_train_file)
         gold_templates = np.load(self.gold_templates_file)
         templates = np.load(self.yass_templates_file)
-        accuracy_eval = SpikeSortingEvaluation(
-            self.gold_std_spike_train, spike_train, gold_templates, templates)
-        # Saving results of evaluation for accuracy.
-        accuracy_results = np.array(
+
+        def accuracy():
+            accuracy_eval = SpikeSortingEvaluation(
+                self.gold_std_spike_train, spike_train, gold_templates,
+                templates)
+            return np.array(
                 [accuracy_eval.true_positive, accuracy_eval.false_positive,
                     accuracy_eval.unit_cluster_map])
+
+        accuracy_results = self._cached(
+            artifact_key(self.gold_std_spike_train, spike_train,
+                         gold_templates, templates),
+            'accuracy.npy', accuracy)
+        # Saving results of evaluation for accuracy.
         np.save(self.accuracy_file, accuracy_results)
 
+    def _artifact(self, key, *path):
+        """Path to an intermediate output in the folder for key"""
+        folder = os.path.join(self.tmp_dir, key, *path[:-1])
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        return os.path.join(folder, path[-1])
+
+    def _cached(self, key, name, compute):
+        """Loads the intermediate output name saved in the folder for key,
+        computes and saves it if it does not exist
+        """
+        path = self._artifact(key, name)
+        if not os.path.isfile(path):
+            np.save(path, compute())
+        return np.load(path)
+
+    def _start_sort(self, config, key):
+        """Runs yass in a separate process, output is saved in the folder
+        for key. Returns None if the spike train already exists
+        """
+        path_to_spike_train = self._artifact(key, 'tmp', 'spike_train.npy')
+        if os.path.isfile(path_to_spike_train):
+            return None
+
+        output_dir = os.path.relpath(os.path.dirname(path_to_spike_train),
+                                     config['data']['root_folder'])
+        sort = multiprocess.Process(target=run, kwargs=dict(
+            config=config, output_dir=output_dir))
+        sort.start()
+        return sort
+
+    def _join_sort(self, sort):
+        """Waits for a process started by _start_sort"""
+        if sort is None:
+            return
+        sort.join()
+        if sort.exitcode != 0:
+            raise RuntimeError('yass exited with code {}'
+                               .format(sort.exitcode))
+
     def run_analyses(self, n_batches=6):
         """Runs the analyses on the dataset indicated in config.
 
@@ -5,33 +5,75 @@ Original source:
 https://github.com/hooshmandshr/yass_visualization/blob/master/src/stability/stability_evaluation.py
 """
 
-import numpy as np
+import os
+from functools import partial
 
+import multiprocess
+import numpy as np
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
 from scipy.spatial.distance import pdist, squareform, cdist
 from tqdm import tqdm
 
+from yass.batch import BatchProcessor, RecordingsReader
+from yass.batch.util import make_metadata
 from yass.geometry import find_channel_neighbors, parse
 from yass.evaluate.stability_filters import butterworth, whitening
+from yass.preprocess.filter import fix_indexes
 
 
 def clean_spike_train(spt):
-    units = np.unique(spt[:, 1])
-    spt[:, 1] += len(units)
-    units += len(units)
-    for i, u in enumerate(units):
-        u_idx = spt[:, 1] == u
-        spt[u_idx, 1] = i
+    """Relabels (in place) the units of a spike train to 0, ..., N-1,
+    keeping their order. Spike trains that are already clean are returned
+    without relabeling, so this can be called on the same spike train by
+    every object that uses it
+    """
+    labels = spt[:, 1]
+    if (np.issubdtype(labels.dtype, np.integer) and labels.size and
+            labels.min() >= 0 and np.all(np.bincount(labels))):
+        return spt
+    _, spt[:, 1] = np.unique(labels, return_inverse=True)
     return spt
 
 
-# TODO: remove this and use new yass Reader
-class RecordingBatchIterator(object):
+def count_spikes(spt, n_units=None):
+    """Number of spikes per unit of a clean spike train
+    """
+    counts = np.bincount(spt[:, 1].astype('int64'), minlength=n_units or 0)
+    return counts.astype('float64')
+
+
+def group_spike_times(spt, n_units):
+    """Groups the spike times of a clean spike train by unit
+
+    Returns
+    -------
+    times: numpy.ndarray
+        Spike times sorted by unit and then by time
+    offsets: numpy.ndarray
+        Shape [n_units + 1], spike times of unit u are
+        times[offsets[u]:offsets[u + 1]]
+    """
+    order = np.lexsort((spt[:, 0], spt[:, 1]))
+    offsets = np.append(0, np.cumsum(count_spikes(spt, n_units))).astype(
+        'int64')
+    return spt[order, 0], offsets
+
+
+class RecordingBatchProcessor(object):
 
     def __init__(self, rec_file, geom_file, sample_rate,
                  n_batches, batch_time_samples, n_chan,
-                 radius, scale=1e2, filter_std=True, whiten=True):
-        """Sets up the object for reading from a binary file.
+                 radius, scale=1e2, filter_std=True, whiten=True,
+                 dtype='int16', data_order='samples', buffer_size=200,
+                 output_path=None, processes=1):
+        """Sets up batch processing of a binary recording file.
+
+        The recording is read with a yass BatchProcessor. If filter_std is
+        True, the first n_batches batches are filtered (and optionally
+        whitened) once, in parallel and with a buffer around every batch, and
+        saved to a binary file that is then used by the mean wave
+        calculations.
 
         Parameters
         ----------
@@ -49,14 +91,28 @@ class RecordingBatchIterator(object):
         batch_time_samples: int
             Number of time samples per each batch to be used.
         filter_std: bool
-            The iterator both filters and standardizes the recording (dividing
-            by standard deviation.
+            Both filter and standardize the recording (dividing by standard
+            deviation).
         whiten: bool
             Spatially whiten the recording.
         scale: float
             In case filter and whitening is not needed and the binary data is
             scaled up.
+        dtype: str
+            Recording dtype.
+        data_order: str
+            Recording order, one of ('channels', 'samples').
+        buffer_size: int
+            Number of samples added at both sides of every batch before
+            filtering.
+        output_path: str
+            Where to save the filtered recording, defaults to the recording
+            file name with a .filtered.bin extension.
+        processes: str or int
+            Number of processes to use for filtering and writing augmented
+            recordings, if 'max', it uses all cores in the machine.
         """
+        self.rec_file = rec_file
         self.s_rate = sample_rate
         self.batch_time_samples = batch_time_samples
         self.n_batches = n_batches
@@ -68,30 +124,150 @@ class RecordingBatchIterator(object):
         self.filter_std = filter_std
         self.whiten = whiten
         self.scale = scale
-        self.file = open(rec_file, 'r')
-
-    def next_batch(self):
-        """Gets the next temporal batch of recording."""
-        ts = np.fromfile(
-            self.file,
-            count=self.n_chan * self.batch_time_samples,
-            dtype=np.int16)
-        ts = np.reshape(ts, [self.batch_time_samples, self.n_chan])
+        self.dtype = dtype
+        self.data_order = data_order
+        self.buffer_size = buffer_size
+        self.processes = (multiprocess.cpu_count() if processes == 'max'
+                          else processes)
+
+        if output_path is None:
+            output_path = '{}.filtered.bin'.format(
+                os.path.splitext(rec_file)[0])
+        self.output_path = output_path
+        self._filtered = False
+
+        # the recording is divided by this number before being used
+        self.denominator = 1 if filter_std else scale
+
+    @property
+    def max_memory(self):
+        """Memory needed to load one batch, in bytes"""
+        return (self.batch_time_samples * self.n_chan *
+                np.dtype(self.dtype).itemsize)
+
+    @property
+    def n_observations(self):
+        """Number of time samples in the first n_batches batches"""
+        n_observations = RecordingsReader(self.rec_file, self.dtype,
+                                          self.n_chan,
+                                          self.data_order).observations
+        return min(n_observations, self.n_batches * self.batch_time_samples)
+
+    def batch_processor(self, buffer_size=0):
+        """BatchProcessor over the recording, filtered and standardized if
+        filter_std is True
+
+        Parameters
+        ----------
+        buffer_size: int
+            Buffer added to every batch.
+        """
         if not self.filter_std:
-            return ts / self.scale
-        ts = butterworth(ts, 300, 0.1, 3, self.s_rate)
-        ts = ts / np.std(ts)
-        if not self.whiten:
-            return ts
-        ts = whitening(ts, self.neighbs, 40)
+            return BatchProcessor(self.rec_file, self.dtype, self.n_chan,
+                                  self.data_order, self.max_memory,
+                                  buffer_size=buffer_size,
+                                  show_progress_bar=False)
+
+        if not self._filtered:
+            self.filter()
+
+        return BatchProcessor(self.output_path, 'float32', self.n_chan,
+                              'samples', self.batch_time_samples *
+                              self.n_chan * np.dtype('float32').itemsize,
+                              buffer_size=buffer_size,
+                              show_progress_bar=False)
+
+    def filter(self):
+        """Filters (and whitens) the first n_batches of the recording in
+        parallel and saves the result to output_path
+        """
+        bp = BatchProcessor(self.rec_file, self.dtype, self.n_chan,
+                            self.data_order, self.max_memory,
+                            buffer_size=self.buffer_size)
+
+        bp.multi_channel_apply(_filter_standarize, mode='disk',
+                               cleanup_function=fix_indexes,
+                               output_path=self.output_path,
+                               to_time=self.n_observations,
+                               cast_dtype='float32',
+                               processes=self.processes,
+                               sampling_frequency=self.s_rate,
+                               neighbors=self.neighbs,
+                               whiten=self.whiten)
+        self._filtered = True
+
+    def close_iterator(self):
+        """Removes the filtered recording (if any)"""
+        if self._filtered:
+            os.remove(self.output_path)
+            os.remove(self.output_path.replace('.bin', '.yaml'))
+            self._filtered = False
+
+
+def _filter_standarize(ts, sampling_frequency, neighbors, whiten):
+    """Filters, standardizes and (optionally) whitens a batch
+    """
+    ts = butterworth(ts, 300, 0.1, 3, sampling_frequency)
+    ts = ts / np.std(ts)
+    if not whiten:
         return ts
+    return whitening(ts, neighbors, 40)
 
-    def reset_cursor(self):
-        """Resets the cursor of the open file to the beginning."""
-        self.file.seek(0)
 
-    def close_iterator(self):
-        self.file.close()
+def _spikes_in_batch(spike_train, start, stop, offset, window,
+                     n_observations):
+    """Spikes of a time-sorted spike train with times in [start, stop)
+
+    Returns
+    -------
+    spike_train: numpy.ndarray
+        Spikes in [start, stop) whose window is inside the recording
+    positions: numpy.ndarray
+        Shape [n_spikes, len(window)], position of the window of every spike
+        in a batch whose first sample is at time offset
+    n_outside: int
+        Number of spikes in [start, stop) whose window is outside the
+        recording
+    """
+    lo, hi = np.searchsorted(spike_train[:, 0], [start, stop])
+    spike_train = spike_train[lo:hi]
+
+    times = spike_train[:, 0, np.newaxis] + np.asarray(window)
+    inside = np.all((times >= 0) & (times < n_observations), axis=1)
+
+    return spike_train[inside], times[inside] - offset, np.sum(~inside)
+
+
+def _accumulate_templates(ts, idx_local, idx, spike_train, window,
+                          n_units, n_observations, denominator,
+                          previous_batch):
+    """Adds the waveforms of the spikes in a batch to the running sums of
+    every unit, a (window, channels, units) array
+    """
+    if previous_batch is None:
+        previous_batch = (np.zeros((len(window), ts.shape[1], n_units)),
+                          np.zeros(n_units), 0)
+
+    sums, counts, boundary_violation = previous_batch
+
+    start, stop = idx[0].start or 0, idx[0].stop
+    spike_train, positions, n_outside = _spikes_in_batch(
+        spike_train, start, stop, start - idx_local[0].start, window,
+        n_observations)
+    n_spikes = spike_train.shape[0]
+
+    # waveforms are summed per unit with a sparse (units x spikes) product,
+    # one window sample at a time so only a (spikes x channels) slice of
+    # the recording is gathered at once
+    units = coo_matrix((np.ones(n_spikes), (spike_train[:, 1],
+                                            np.arange(n_spikes))),
+                       shape=(n_units, n_spikes)).tocsr()
+    for w in range(positions.shape[1]):
+        sums[w] += units.dot(ts[positions[:, w]]).T / denominator
+
+    counts = counts + np.bincount(spike_train[:, 1], minlength=n_units)
+
+    return sums, counts, boundary_violation + n_outside
 
 
 class MeanWaveCalculator(object):
@@ -101,6 +277,8 @@ class MeanWaveCalculator(object):
 
         Parameters
         ----------
+        batch_reader: RecordingBatchProcessor
+            Recording to compute the mean waves from.
         spt: numpy.ndarray
             Shape [N, 2] where N is the total number of events. First column
             indicates the spike times in time sample and second is cluster
@@ -108,12 +286,6 @@ class MeanWaveCalculator(object):
         window: list
             List of consecuitive integers. Indicating the window around spike
             times that indicate an event.
-
-        Returns
-        -------
-        int
-            The number of boundary violations in batch processing part of the
-            mean wave calculation.
         """
         self.batch_reader = batch_reader
         self.spike_train = spike_train
@@ -121,36 +293,51 @@ class MeanWaveCalculator(object):
         self.spike_train = clean_spike_train(
             self.spike_train)
         self.n_units = max(self.spike_train[:, 1] + 1)
+        self.spike_count = count_spikes(self.spike_train, self.n_units)
+        # spike times of unit u are
+        # unit_times[unit_offsets[u]:unit_offsets[u + 1]]
+        self.unit_times, self.unit_offsets = group_spike_times(
+            self.spike_train, self.n_units)
         self.templates = np.zeros(
             [len(self.window), batch_reader.n_chan, self.n_units])
 
+    def spike_times(self, unit):
+        """Sorted spike times of a unit"""
+        return self.unit_times[self.unit_offsets[unit]:
+                               self.unit_offsets[unit + 1]]
+
     def compute_templates(self, n_batches):
-        """Computes the templates from a given number of batches."""
-        self.batch_reader.reset_cursor()
-        counts = np.zeros(self.n_units)
-        boundary_violation = 0
-        n_samples = self.batch_reader.batch_time_samples
-        for i in tqdm(range(n_batches)):
-            batch_idx = np.logical_and(
-                self.spike_train[:, 0] > i * n_samples,
-                self.spike_train[:, 0] < (i + 1) * n_samples)
-            spt = self.spike_train[batch_idx, :]
-            spt[:, 0] -= n_samples * i
-            ts = self.batch_reader.next_batch()
-            for j in range(spt.shape[0]):
-                try:
-                    self.templates[:, :, spt[j, 1]] += (ts[spt[j, 0] +
-                                                        self.window, :])
-                    counts[spt[j, 1]] += 1
-                except Exception:
-                    boundary_violation += 1
-        for u in range(self.n_units):
-            if counts[u]:
-                self.templates[:, :, u] /= counts[u]
+        """Computes the templates from a given number of batches.
+
+        Returns
+        -------
+        int
+            The number of spikes whose window is outside of the recording.
+        """
+        reader = self.batch_reader
+        buffer_size = int(np.max(np.abs(self.window))) + 1
+        bp = reader.batch_processor(buffer_size=buffer_size)
+        n_observations = min(bp.reader.observations,
+                             n_batches * reader.batch_time_samples)
+
+        order = np.argsort(self.spike_train[:, 0], kind='mergesort')
+        spike_train = self.spike_train[order, :2]
+
+        sums, counts, boundary_violation = bp.multi_channel_apply(
+            _accumulate_templates, mode='memory', to_time=n_observations,
+            pass_batch_info=True, pass_batch_results=True,
+            spike_train=spike_train, window=self.window,
+            n_units=self.n_units, n_observations=n_observations,
+            denominator=reader.denominator)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.templates = sums / counts
+        self.templates[:, :, counts == 0] = 0
+
         return boundary_violation
 
     def close_reader(self):
-        self.batch_reader.close()
+        self.batch_reader.close_iterator()
 
 
 class RecordingAugmentation(object):
@@ -335,23 +522,29 @@ class RecordingAugmentation(object):
             standard devation of the log-normal and the total count of spikes
             for units.
         """
-        self.stat_summary = np.zeros(
-            [self.template_comp.n_units, 3])
-        spt = self.template_comp.spike_train
-        for u in range(self.template_comp.n_units):
-            # spike train of unit u
-            spt_u = np.sort(spt[spt[:, 1] == u, 0])
-            if len(spt > 2):
-                # We estimate the difference between
-                # consecutive firing times of the same unit
-                u_firing_diff = spt_u[1:] - spt_u[:-1]
-                # Getting rid of duplicates.
-                # TODO: do this more sensibly.
-                u_firing_diff[u_firing_diff == 0] = 1
-                u_firing_diff = np.log(u_firing_diff)
-                u_mean = np.mean(u_firing_diff)
-                u_std = np.std(u_firing_diff)
-                self.stat_summary[u, :] = u_mean, u_std, len(spt_u)
+        n_units = self.template_comp.n_units
+        times = self.template_comp.unit_times
+        offsets = self.template_comp.unit_offsets
+        # We estimate the difference between
+        # consecutive firing times of the same unit
+        unit = np.repeat(np.arange(n_units), np.diff(offsets))
+        same_unit = unit[1:] == unit[:-1]
+        unit = unit[1:][same_unit]
+        firing_diff = (times[1:] - times[:-1])[same_unit]
+        # Getting rid of duplicates.
+        # TODO: do this more sensibly.
+        firing_diff[firing_diff == 0] = 1
+        firing_diff = np.log(firing_diff)
+
+        # units with less than two spikes get nan mean and std
+        n_diff = np.bincount(unit, minlength=n_units)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            u_mean = np.bincount(unit, firing_diff, n_units) / n_diff
+            u_std = np.sqrt(np.bincount(
+                unit, np.square(firing_diff - u_mean[unit]), n_units) / n_diff)
+
+        self.stat_summary = np.stack(
+            [u_mean, u_std, self.template_comp.spike_count], axis=1)
         return self.stat_summary
 
     def make_fake_spike_train(self, augment_rate):
@@ -363,7 +556,6 @@ class RecordingAugmentation(object):
             Between 0 and 1. Augmented spikes per unit (percentage of total
             spikes per unit).
         """
-        spt = self.template_comp.spike_train
         # We sample a new set of spike times per cluster.
         times = []
         cid = []
@@ -373,7 +565,7 @@ class RecordingAugmentation(object):
                np.isnan(self.stat_summary[u, 1])):
                 continue
 
-            spt_u = np.sort(spt[spt[:, 1] == u, 0])
+            spt_u = self.template_comp.spike_times(u)
             new_spike_count = int(
                 self.stat_summary[u, 2] * augment_rate)
             diffs = np.exp(np.random.normal(
@@ -390,11 +582,19 @@ class RecordingAugmentation(object):
             new_spikes = self.correct_spike_time(spt_u, new_spikes)
             times += list(new_spikes)
             cid += [u] * new_spike_count
-        return np.array([times, cid]).T
+        return np.array([times, cid], dtype='int64').T
 
     def save_augment_recording(self, out_file_name, length, scale=1e2):
         """Augments recording and saves it to file.
 
+        Batches are synthesised in parallel (see RecordingBatchProcessor
+        processes) in float32 and written as int16 at their own offset in the
+        output file. All random choices (moved units, augmented spike times)
+        are drawn before, so the output does not depend on the number of
+        processes. Every unit in the moved units is moved and relabeled, and
+        augmented spikes are added wherever they are in the recording, also
+        on batch boundaries or when their waveform crosses one.
+
         Parameters
         ----------
         out_file_name: str
@@ -402,9 +602,9 @@ class RecordingAugmentation(object):
         length: int
             Length of augmented recording in batch size of the originial batch
             iterator object which is in the mean wave calculatro object.
-        move_rate: float
-            Between 0 and 1. Percentage of units whose augmented spike wave
-            form is spatially moved.
+        scale: float
+            The augmented recording is multiplied by this number before
+            being saved as int16.
 
         Returns
         -------
@@ -414,9 +614,8 @@ class RecordingAugmentation(object):
             which is a list of string, each is an error regarding
             boundary violation for batch processing.
         """
-        status = []
         reader = self.template_comp.batch_reader
-        reader.reset_cursor()
+        window = self.template_comp.window
         # Determine which clusters are spatially moved.
         orig_templates = self.template_comp.templates
         n_units = self.template_comp.n_units
@@ -425,57 +624,60 @@ class RecordingAugmentation(object):
             np.random.choice(range(n_units),
                              int(self.move_rate * n_units),
                              replace=False))
-        temp_shape = self.template_comp.templates.shape
-        moved_templates = np.zeros(
-            [temp_shape[0], temp_shape[1], len(moved_units)])
-        # An array size of n_units where 0 indicates no movement
-        # otherwise the index of the moved template in the move_templates
-        # np.ndarray.
-        moved = np.zeros(n_units)
-        for i, u in enumerate(moved_units):
-            moved[u] = i
+        # Templates added for every unit, spatially moved for moved units.
+        aug_templates = np.copy(orig_templates)
+        for u in moved_units:
             # Spatial distance is drawn from a poisson distribution.
-            moved_templates[:, :, i] = self.move_spatial_trace(
+            aug_templates[:, :, u] = self.move_spatial_trace(
                 orig_templates[:, :, u])
         # Create augmented spike train.
         aug_spt = self.make_fake_spike_train(self.move_rate)
-        reader = self.template_comp.batch_reader
-        boundary_violation = 0
-        n_samples = reader.batch_time_samples
-        f = open(out_file_name, 'w')
-        # TODO: for debugging, remove later.
-        moved = moved.astype('int')
-        for i in tqdm(range(length)):
-            batch_idx = np.logical_and(
-                aug_spt[:, 0] > i * n_samples,
-                aug_spt[:, 0] < (i + 1) * n_samples)
-            spt = aug_spt[batch_idx, :]
-            spt[:, 0] -= n_samples * i
-            ts = reader.next_batch()
-            for j in range(spt.shape[0]):
-                cid = spt[j, 1]
-                try:
-                    # Time window around spike
-                    spike_win = spt[j, 0] + self.template_comp.window
-                    if moved[cid]:
-                        sup_signal = moved_templates[:, :, moved[cid]]
-                        ts[spike_win, :] += sup_signal
-                    else:
-                        sup_signal = orig_templates[:, :, cid]
-                        ts[spike_win, :] += sup_signal
-                except Exception as e:
-                    status.append('warning:{}'.format(str(e)))
-                    boundary_violation += 1
-            ts *= scale
-            ts = ts.astype('int16')
-            ts.tofile(f)
+        aug_spt = aug_spt[np.argsort(aug_spt[:, 0], kind='mergesort')]
+
+        bp = reader.batch_processor()
+        n_observations = min(bp.reader.observations,
+                             length * reader.batch_time_samples)
+
+        times = aug_spt[:, 0, np.newaxis] + np.asarray(window)
+        outside = (np.any((times < 0) | (times >= n_observations), axis=1) &
+                   (aug_spt[:, 0] < n_observations))
+        status = ['warning: spike at {} is outside the recording'.format(t)
+                  for t in aug_spt[outside, 0]]
+
+        # the output file is allocated once and every batch is written at
+        # its own offset, so batches are synthesised independently
+        np.memmap(out_file_name, dtype='int16', mode='w+',
+                  shape=(n_observations, reader.n_chan)).flush()
+
+        augment_batch = partial(_augment_batch,
+                                path_to_recordings=bp.path_to_recordings,
+                                dtype=bp.dtype, n_channels=bp.n_channels,
+                                data_order=bp.data_order,
+                                out_file_name=out_file_name,
+                                n_observations=n_observations,
+                                spike_train=aug_spt, window=window,
+                                templates=aug_templates,
+                                denominator=reader.denominator, scale=scale)
+
+        batches = [idx[0] for idx in
+                   bp.indexer.multi_channel(to_time=n_observations)]
+
+        if reader.processes == 1:
+            for batch in tqdm(batches):
+                augment_batch(batch)
+        else:
+            p = multiprocess.Pool(reader.processes)
+            p.map(augment_batch, batches)
+            p.close()
+            p.join()
+
+        if out_file_name.endswith('.bin'):
+            make_metadata('all', reader.n_chan, 'int16', out_file_name)
+
         # Reassign spikes from moved clusters to new units.
-        new_unit_id = self.template_comp.n_units
-        for u in range(self.template_comp.n_units):
-            if moved[u]:
-                aug_spt[aug_spt[:, 1] == u, 1] = new_unit_id
-                new_unit_id += 1
-        f.close()
+        new_unit_id = np.arange(n_units)
+        new_unit_id[moved_units] = n_units + np.arange(len(moved_units))
+        aug_spt[:, 1] = new_unit_id[aug_spt[:, 1]]
         orig_count = self.template_comp.spike_train.shape[0]
         aug_count = aug_spt.shape[0]
         # Appends the new synthetic spike train to the base spike train.
@@ -493,10 +695,51 @@ class RecordingAugmentation(object):
         return new_aug_spike_train, status
 
 
+def _augment_batch(batch, path_to_recordings, dtype, n_channels, data_order,
+                   out_file_name, n_observations, spike_train, window,
+                   templates, denominator, scale):
+    """Adds the templates of the spikes in a batch to the recording, scales
+    it and writes it (as int16) to its location in out_file_name
+
+    Parameters
+    ----------
+    batch: slice
+        Time samples in the batch
+    """
+    reader = RecordingsReader(path_to_recordings, dtype, n_channels,
+                              data_order)
+    ts = reader[batch].astype('float32') / denominator
+    window = np.asarray(window)
+
+    # every spike whose window overlaps the batch is added
+    start = batch.start - window.max()
+    stop = batch.stop - window.min()
+    spike_train, positions, _ = _spikes_in_batch(
+        spike_train, start, stop, batch.start, window, n_observations)
+
+    # spikes at the same time are added in separate layers, within a layer
+    # positions for the same window sample are unique so fancy indexing can
+    # be used for every window sample
+    times = spike_train[:, 0]
+    layer = np.arange(times.shape[0]) - np.searchsorted(times, times)
+
+    for spikes in (layer == k for k in range(np.max(layer, initial=-1) + 1)):
+        units = spike_train[spikes, 1]
+        for w in range(positions.shape[1]):
+            position = positions[spikes, w]
+            inside = (position >= 0) & (position < ts.shape[0])
+            ts[position[inside]] += templates[w][:, units[inside]].T
+
+    out = np.memmap(out_file_name, dtype='int16', mode='r+',
+                    shape=(n_observations, n_channels))
+    out[batch] = (ts * scale).astype('int16')
+    out.flush()
+
+
 class SpikeSortingEvaluation(object):
 
     def __init__(self, spt_base, spt, tmp_base=None, tmp=None,
-                 method='hungarian'):
+                 method='hungarian', admissible_proximity=60):
         """Sets up the evaluation object with two spike trains.
 
         Parameters
@@ -514,12 +757,17 @@ class SpikeSortingEvaluation(object):
             the hungarian algorithm is used for matching.
         method: str, 'greedy' or 'hungarian'
             Method for matching clusters/units.
+        admissible_proximity: int
+            Maximum distance (in time samples, exclusive) between two spikes
+            to be considered the same event.
         """
         if tmp_base is None or tmp is None:
             method = 'hungarian'
-        # clean the spike train before calling this function.
+        # spike trains that are already clean (e.g. the ones used by a
+        # MeanWaveCalculator) are not relabeled again.
         self.tmp_base = tmp_base
         self.tmp = tmp
+        self.admissible_proximity = admissible_proximity
         spt_base = clean_spike_train(spt_base)
         spt = clean_spike_train(spt)
         self.n_units = np.max(spt_base[:, 1]) + 1
@@ -545,29 +793,62 @@ class SpikeSortingEvaluation(object):
         spt: numpy.ndarray
             Shape [N, 2]. Clean spike train where cluster ids are 0, ..., N-1.
         """
-        n_cluster = np.max(spt[:, 1]) + 1
-        counts = np.zeros(n_cluster)
-        for u in range(n_cluster):
-            counts[u] = np.sum(spt[:, 1] == u)
-        return counts
+        return count_spikes(spt)
 
     def compute_confusion_matrix(self):
         """Calculates the confusion matrix of two spike trains.
 
         The first spike train is the instances original spike train.
         The second one is given as an argument.
+
+        All coincidences (base spike, cluster spike closer than
+        admissible_proximity) are found at once by sorting the second spike
+        train and using np.searchsorted. For a (unit, cluster) pair where
+        every spike has at most one coincidence the number of matches is the
+        number of coincidences, the remaining pairs are counted with
+        count_matches.
         """
-        confusion_matrix = np.zeros(
-            [self.n_units, self.n_clusters])
-        for unit in tqdm(range(self.n_units)):
-            idx = self.spt_base[:, 1] == unit
-            spike_times_base = np.sort(self.spt_base[idx, 0])
-            for cluster in range(self.n_clusters):
-                idx = self.spt[:, 1] == cluster
-                spike_times_cluster = np.sort(self.spt[idx, 0])
-                confusion_matrix[unit, cluster] = self.count_matches(
-                    spike_times_base, spike_times_cluster)
-        self.confusion_matrix = confusion_matrix
+        spt_base = self.spt_base
+        order = np.argsort(self.spt[:, 0], kind='mergesort')
+        times = self.spt[order, 0]
+        clusters = self.spt[order, 1]
+
+        # coincidences (i, j): spt_base[i] and spike j in the sorted spt
+        lo = np.searchsorted(times, spt_base[:, 0] - self.admissible_proximity,
+                             side='right')
+        hi = np.searchsorted(times, spt_base[:, 0] + self.admissible_proximity,
+                             side='left')
+        n_coincidences = hi - lo
+        i = np.repeat(np.arange(spt_base.shape[0]), n_coincidences)
+        j = (np.arange(i.shape[0]) -
+             np.repeat(np.cumsum(n_coincidences) - n_coincidences,
+                       n_coincidences) + lo[i])
+
+        # (unit, cluster) pair of every coincidence
+        pair = (spt_base[i, 1] * self.n_clusters +
+                clusters[j]).astype('int64')
+        n_pairs = self.n_units * self.n_clusters
+        confusion_matrix = np.bincount(pair, minlength=n_pairs).astype(
+            'float64')
+
+        # pairs where a spike has more than one coincidence
+        ambiguous = np.zeros(n_pairs, 'bool')
+        for spike in (i, j):
+            order = np.lexsort((spike, pair))
+            spike, pair_sorted = spike[order], pair[order]
+            repeated = ((spike[1:] == spike[:-1]) &
+                        (pair_sorted[1:] == pair_sorted[:-1]))
+            ambiguous[pair_sorted[1:][repeated]] = True
+
+        for p in np.where(ambiguous)[0]:
+            unit, cluster = divmod(p, self.n_clusters)
+            spike_times_base = np.sort(spt_base[spt_base[:, 1] == unit, 0])
+            spike_times_cluster = times[clusters == cluster]
+            confusion_matrix[p] = self.count_matches(spike_times_base,
+                                                     spike_times_cluster)
+
+        self.confusion_matrix = confusion_matrix.reshape(self.n_units,
+                                                         self.n_clusters)
 
     def count_matches(self, array1, array2):
         """Finds the matches between two count process.
@@ -579,7 +860,6 @@ class SpikeSortingEvaluation(object):
             array2.
         """
         # In time samples
-        self.admissible_proximity = 60
         m, n = len(array1), len(array2)
         i, j = 0, 0
         count = 0
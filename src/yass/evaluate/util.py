@@ -3,6 +3,9 @@
 This includes finding main channel and signal to noise ration for templates.
 """
 
+import hashlib
+import json
+
 import numpy as np
 
 
@@ -35,3 +38,31 @@ def temp_snr(templates):
     for unit, c in enumerate(main_channels(templates)[:, -1]):
         res[unit] = np.linalg.norm(templates[:, c, unit], np.inf)
     return res
+
+
+def artifact_key(*inputs):
+    """Computes a key that identifies an intermediate output from the
+    inputs used to compute it.
+
+    Parameters
+    ----------
+    *inputs
+        numpy.ndarray (hashed by content) or any object that can be
+        serialized to json such as a config mapping or other keys.
+
+    Returns
+    -------
+    str
+        Hexadecimal hash of the inputs.
+    """
+    sha1 = hashlib.sha1()
+    for value in inputs:
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            sha1.update(json.dumps([str(value.dtype),
+                                    value.shape]).encode('utf-8'))
+            sha1.update(value.tobytes())
+        else:
+            sha1.update(json.dumps(value, sort_keys=True,
+                                   default=str).encode('utf-8'))
+    return sha1.hexdigest()[:16]
@@ -202,15 +202,30 @@ class vbPar:
 
             maskedData: maskData object
         """
+        self.update_local_meanY(maskedData.meanY)
+
+    def update_local_meanY(self, meanY):
+        """
+            Updates the local parameter rhat for VB inference from the
+            group means only. With a mask of ones and one group per spike
+            meanY is the score itself, so this skips building a maskData
+            object (and its second order statistics)
+
+            Parameters:
+            -----------
+
+            meanY: np.array
+                Ngroup x nfeature x nchannel numpy array, see maskData
+        """
 
         pik = dirichlet(self.ahat.ravel())
         Khat = self.ahat.size
-        Ngroup = maskedData.meanY.shape[0]
-        # nchannel = maskedData.meanY.shape[2]
+        Ngroup = meanY.shape[0]
+        # nchannel = meanY.shape[2]
         log_rho = np.zeros([Ngroup, Khat])
         for k in range(Khat):
             mvn = multivariate_normal_logpdf(
-                maskedData.meanY, self.muhat[:, k, :],
+                meanY, self.muhat[:, k, :],
                 self.Vhat[:, :, k, :] * self.nuhat[k])
             log_rho[:, k] = log_rho[:, k] + mvn
             log_rho[:, k] = log_rho[:, k] + np.log(pik[k])
@@ -968,21 +983,53 @@ def check_merge(maskedData, vbParam, suffStat, ka, kb, param, L, ELBO):
         return vbParamTemp, suffStatTemp, merged, L, ELBO_amerge
 
 
-def spikesort(score, mask, group, param):
-    maskedData = maskData(score, mask, group)
+def spikesort(score, mask, group, param, prior_vbParam=None):
+    stochastic = param.cluster.stochastic
+    n_groups = np.max(group) + 1
 
-    vbParam = split_merge(maskedData, param)
-
-    n_data = score.shape[0]
-    rhat_full = np.zeros((n_data, vbParam.rhat.shape[1]))
-    for j in range(n_data):
-        rhat_full[j] = vbParam.rhat[group[j]]
+    if stochastic.enabled and n_groups > stochastic.batch_size:
+        vbParam = split_merge_stochastic(score, mask, group, param,
+                                         prior_vbParam)
+    else:
+        maskedData = maskData(score, mask, group)
+        vbParam = split_merge_start(maskedData, param, prior_vbParam)
 
-    vbParam.rhat = rhat_full
+    # rhat is computed per group, broadcast it back to every spike
+    vbParam.rhat = vbParam.rhat[group]
 
     return vbParam
 
 
+def split_merge_start(maskedData, param, prior_vbParam=None):
+    """
+        Runs split_merge_warm if there are previous clusters that match the
+        feature and channel dimensions of maskedData, split_merge otherwise
+
+        Parameters:
+        -----------
+        maskedData: maskData object
+
+        param: Config object (see config.py)
+
+        prior_vbParam: vbPar object or None
+            Previous global parameters for this channel
+
+        Returns:
+        --------
+        vbParam: vbPar object
+    """
+    if (prior_vbParam is not None and
+            prior_vbParam.muhat.shape[1] > 0 and
+            prior_vbParam.muhat[:, 0].shape == maskedData.sumY.shape[1:]):
+        return split_merge_warm(maskedData, prior_vbParam, param)
+
+    if prior_vbParam is not None:
+        logger.info('Previous clusters do not match the data, '
+                    'clustering from scratch')
+
+    return split_merge(maskedData, param)
+
+
 def split_merge(maskedData, param):
     vbParam, suffStat = init_param(maskedData, 1, param)
     iter = 0
@@ -1010,6 +1057,205 @@ def split_merge(maskedData, param):
     return vbParam
 
 
+def split_merge_warm(maskedData, prior_vbParam, param, n_iter=3):
+    """
+        Version of split_merge that starts from the clusters of a previous
+        sort (e.g. an earlier session from the same implant) instead of a
+        single cluster. The previous clusters are refined with n_iter local
+        and global updates (clusters that get no data are dropped), then
+        one birth move looks for new units and merge moves remove the
+        redundant ones.
+
+        Parameters:
+        -----------
+        maskedData: maskData object
+
+        prior_vbParam: vbPar object
+            Previous global parameters (muhat, Vhat, invVhat, lambdahat,
+            nuhat, ahat) for this channel, feature and channel dimensions
+            must match maskedData
+
+        param: Config object (see config.py)
+
+        n_iter: int
+            Number of refinement iterations
+
+        Returns:
+        --------
+        vbParam: vbPar object
+    """
+    vbParam = vbPar(None)
+    vbParam.muhat = np.copy(prior_vbParam.muhat)
+    vbParam.Vhat = np.copy(prior_vbParam.Vhat)
+    vbParam.invVhat = np.copy(prior_vbParam.invVhat)
+    vbParam.lambdahat = np.copy(prior_vbParam.lambdahat)
+    vbParam.nuhat = np.copy(prior_vbParam.nuhat)
+    vbParam.ahat = np.copy(prior_vbParam.ahat)
+
+    for iter in range(n_iter):
+        vbParam.update_local(maskedData)
+
+        # drop clusters that are no longer in the data
+        Nhat = np.sum(vbParam.rhat * maskedData.weight[:, np.newaxis], 0)
+        keep = Nhat > 1
+        if not np.any(keep):
+            return split_merge(maskedData, param)
+
+        if not np.all(keep):
+            vbParam.muhat = vbParam.muhat[:, keep]
+            vbParam.Vhat = vbParam.Vhat[:, :, keep]
+            vbParam.invVhat = vbParam.invVhat[:, :, keep]
+            vbParam.lambdahat = vbParam.lambdahat[keep]
+            vbParam.nuhat = vbParam.nuhat[keep]
+            vbParam.ahat = vbParam.ahat[keep]
+            vbParam.update_local(maskedData)
+
+        suffStat = suffStatistics(maskedData, vbParam)
+        vbParam.update_global(suffStat, param)
+
+    L = np.ones(vbParam.rhat.shape[1])
+    vbParam, suffStat, L = birth_move(maskedData, vbParam, suffStat, param,
+                                      L)
+    vbParam, suffStat, L = merge_move(maskedData, vbParam, suffStat, param, L,
+                                      1)
+
+    return vbParam
+
+
+def split_merge_stochastic(score, mask, group, param, prior_vbParam=None):
+    """
+        Stochastic variational version of split_merge for channels with
+        many coreset groups. Only one mini-batch of groups is turned into a
+        maskData object at any time, so memory is bounded by
+        param.cluster.stochastic.batch_size instead of the number of spikes.
+
+        The number of clusters is found by running split_merge (or
+        split_merge_warm if prior_vbParam is given) on a first mini-batch.
+        The global parameters are then refined with
+        param.cluster.stochastic.n_iter mini-batch updates: sufficient
+        statistics of each mini-batch are rescaled to the size of the data
+        and blended with the running estimate using a step size
+        (t + delay)^(-forget_rate). Since the global parameters are linear
+        in the sufficient statistics, this is a step on the natural
+        parameters. Finally, rhat is computed for every group, one
+        mini-batch at a time.
+
+        Parameters:
+        -----------
+        score: np.array
+            N x nfeature x nchannel numpy array
+
+        mask: np.array
+            N x nchannel numpy array
+
+        group: np.array
+            N x 1 numpy array, coreset group ids (0, ..., Ngroup - 1)
+
+        param: Config object (see config.py)
+
+        prior_vbParam: vbPar object, optional
+            Previous global parameters for this channel, used as starting
+            point if they match the data (see split_merge_start)
+
+        Returns:
+        --------
+        vbParam: vbPar object
+            rhat is Ngroup x K
+    """
+    stochastic = param.cluster.stochastic
+    batch_size = stochastic.batch_size
+    n_data = score.shape[0]
+    n_groups = np.max(group) + 1
+
+    def make_batch(groups_batch):
+        in_batch = np.zeros(n_groups, 'bool')
+        in_batch[groups_batch] = True
+        idx = np.where(in_batch[group])[0]
+        # relabel groups so they go from 0 to len(groups_batch) - 1, since
+        # groups_batch is sorted, local group j is groups_batch[j]
+        _, group_batch = np.unique(group[idx], return_inverse=True)
+        maskedData = maskData(score[idx], mask[idx], group_batch)
+        scale = n_data / np.sum(maskedData.weight)
+        return maskedData, scale
+
+    def sample_batch():
+        return np.sort(np.random.choice(n_groups, batch_size, replace=False))
+
+    # learn the clusters on a first mini-batch
+    maskedData, scale = make_batch(sample_batch())
+    vbParam = split_merge_start(maskedData, param, prior_vbParam)
+    suffStat = suffStatistics(maskedData, vbParam)
+    scale_suffstat(suffStat, scale)
+    vbParam.update_global(suffStat, param)
+
+    # refine global parameters
+    for t in range(stochastic.n_iter):
+        maskedData, scale = make_batch(sample_batch())
+        vbParam.update_local(maskedData)
+        suffStatBatch = suffStatistics(maskedData, vbParam)
+        scale_suffstat(suffStatBatch, scale)
+
+        rho = (t + 1 + stochastic.delay) ** (-stochastic.forget_rate)
+        blend_suffstat(suffStat, suffStatBatch, rho)
+        vbParam.update_global(suffStat, param)
+
+    # local step for all groups
+    rhat = np.zeros((n_groups, vbParam.ahat.size))
+    for start in range(0, n_groups, batch_size):
+        groups_batch = np.arange(start, min(start + batch_size, n_groups))
+        maskedData, _ = make_batch(groups_batch)
+        vbParam.update_local(maskedData)
+        rhat[groups_batch] = vbParam.rhat
+    vbParam.rhat = rhat
+
+    return vbParam
+
+
+def scale_suffstat(suffStat, scale):
+    """
+        Rescales (in place) the sufficient statistics computed on a
+        mini-batch so they estimate the ones of the whole data
+
+        Parameters:
+        -----------
+        suffStat: suffStatistics object
+
+        scale: float
+            Total weight of the data divided by the weight of the mini-batch
+    """
+    suffStat.Nhat *= scale
+    suffStat.sumY *= scale
+    suffStat.sumYSq *= scale
+    suffStat.sumYSq1 *= scale
+    suffStat.sumYSq2 *= scale
+
+
+def blend_suffstat(suffStat, suffStatBatch, rho):
+    """
+        Updates (in place) suffStat to (1 - rho) * suffStat +
+        rho * suffStatBatch
+
+        Parameters:
+        -----------
+        suffStat: suffStatistics object
+            Running estimate
+
+        suffStatBatch: suffStatistics object
+            Rescaled sufficient statistics from a mini-batch
+
+        rho: float
+            Step size
+    """
+    suffStat.Nhat = (1 - rho) * suffStat.Nhat + rho * suffStatBatch.Nhat
+    suffStat.sumY = (1 - rho) * suffStat.sumY + rho * suffStatBatch.sumY
+    suffStat.sumYSq = (1 - rho) * suffStat.sumYSq + \
+        rho * suffStatBatch.sumYSq
+    suffStat.sumYSq1 = (1 - rho) * suffStat.sumYSq1 + \
+        rho * suffStatBatch.sumYSq1
+    suffStat.sumYSq2 = (1 - rho) * suffStat.sumYSq2 + \
+        rho * suffStatBatch.sumYSq2
+
+
 def cluster_triage(vbParam, score, threshold):
 
     maha = calc_mahalonobis(vbParam, score)
@@ -1020,42 +1266,92 @@ def cluster_triage(vbParam, score, threshold):
     return cluster_id
 
 
-def get_core_data(vbParam, score, n_max, threshold):
+def get_core_data(vbParam, score, n_max, threshold, batch_size=100000):
+    """
+        Entries of the soft assignment whose spike is within threshold
+        (mahalanobis distance) of the assigned cluster
 
-    n_data = vbParam.rhat.shape[0]
-    n_units = int(np.max(vbParam.rhat[:, 1]) + 1)
+        Entries are grouped by cluster once, distances are computed
+        batch_size entries at a time using the Cholesky factor of the
+        cluster precision
 
-    idx_keep = np.zeros(n_data, 'bool')
-    for k in range(n_units):
-        idx_data = np.where(vbParam.rhat[:, 1] == k)[0]
+        Parameters:
+        -----------
 
-        score_k = score[vbParam.rhat[idx_data, 0].astype('int32')]
+        vbParam: vbPar object
+            rhat must be a scipy.sparse.coo_matrix (n_data x K), see
+            cluster.util.calculate_sparse_rhat
 
-        # prec = vbParam.Vhat[:, :, k]*vbParam.nuhat[k]
-        # mu = vbParam.muhat[:, k][np.newaxis]
-        # score_mu = score_k - mu
-        # maha = np.sqrt(np.sum(np.matmul(score_mu, prec)*score_mu, 1))
+        score: np.array
+            n_data x nfeature x nchannel
 
-        prec = np.transpose(
-            vbParam.Vhat[:, :, [k]] * vbParam.nuhat[
-                np.newaxis, np.newaxis, [k], np.newaxis],
-            axes=[2, 3, 0, 1])
-        scoremhat = np.transpose(
-            score_k[:, :, np.newaxis, :] -
-            vbParam.muhat[:, [k]], axes=[0, 2, 3, 1])
-        maha = np.sqrt(
-            np.sum(
-                np.matmul(
-                    np.matmul(scoremhat[:, :, :, np.newaxis, :], prec),
-                    scoremhat[:, :, :, :, np.newaxis]),
-                axis=(3, 4),
-                keepdims=False))
-        idx_data = idx_data[np.all(maha < threshold, axis=(1, 2))]
+        n_max: int
+            maximum number of entries to keep per cluster
+
+        threshold: float
+            maximum mahalanobis distance
 
-        if idx_data.shape[0] > n_max:
-            idx_data = np.random.choice(idx_data, n_max, replace=False)
+        batch_size: int
+            maximum number of entries processed at a time, memory is
+            O(batch_size x nfeature x nchannel)
 
-        idx_keep[idx_data] = 1
+        Returns:
+        --------
+
+        idx_keep: np.array
+            boolean array, one per non zero entry in rhat (rhat.row,
+            rhat.col, rhat.data)
+    """
+    row = vbParam.rhat.row
+    unit = vbParam.rhat.col
+
+    n_data = row.shape[0]
+    n_units = vbParam.rhat.shape[1]
+
+    # precision per cluster and channel (K x nchannel x nfeature x nfeature)
+    # and its lower triangular factor, (x - mu)' prec (x - mu) is the
+    # squared norm of (x - mu)' chol
+    prec = np.transpose(
+        vbParam.Vhat * vbParam.nuhat[np.newaxis, np.newaxis, :, np.newaxis],
+        axes=[2, 3, 0, 1])
+    try:
+        chol = np.linalg.cholesky(prec)
+    except np.linalg.LinAlgError:
+        chol = None
+    # K x nchannel x nfeature
+    muhat = np.transpose(vbParam.muhat, [1, 2, 0])
+
+    # group entries by cluster
+    order = np.argsort(unit, kind='mergesort')
+    bounds = np.append(0, np.cumsum(np.bincount(unit, minlength=n_units)))
+
+    idx_keep = np.zeros(n_data, 'bool')
+    for k in range(n_units):
+        for start in range(bounds[k], bounds[k + 1], batch_size):
+            idx_data = order[start:min(start + batch_size, bounds[k + 1])]
+
+            score_k = score[row[idx_data]]
+
+            keep = np.ones(idx_data.shape[0], 'bool')
+            for c in range(score_k.shape[2]):
+                scoremhat = score_k[:, :, c] - muhat[k, c]
+                if chol is not None:
+                    maha = np.sum(np.square(np.dot(scoremhat, chol[k, c])),
+                                  1)
+                else:
+                    maha = np.sum(np.dot(scoremhat, prec[k, c]) * scoremhat,
+                                  1)
+                keep &= np.sqrt(maha) < threshold
+
+            idx_keep[idx_data] = keep
+
+        n_keep = np.sum(idx_keep[order[bounds[k]:bounds[k + 1]]])
+        if n_keep > n_max:
+            idx_data = np.sort(order[bounds[k]:bounds[k + 1]])
+            idx_data = idx_data[idx_keep[idx_data]]
+            idx_keep[idx_data] = 0
+            idx_keep[np.random.choice(idx_data, int(n_max),
+                                      replace=False)] = 1
 
     return idx_keep
 
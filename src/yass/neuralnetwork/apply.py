@@ -1,7 +1,6 @@
 import numpy as np
-from collections import defaultdict
-
-from yass.templates.util import strongly_connected_components_iterative
+from scipy import sparse
+from scipy.sparse import csgraph
 
 
 def run_detect_triage_featurize(recordings, sess, x_tf, output_tf,
@@ -60,56 +59,72 @@ def run_detect_triage_featurize(recordings, sess, x_tf, output_tf,
 
 
 def deduplicate(spike_index, energy, neighbors, w=5):
+    """Keep one spike from every group of duplicated detections
+
+    Two spikes are connected if they are at most w time samples apart and
+    their channels are neighbors, only the spike with the largest energy
+    in every connected component survives
+
+    Parameters
+    ----------
+    spike_index: numpy.ndarray (n_data, 2)
+        Spike times and main channels
+
+    energy: numpy.ndarray (n_data)
+        Energy of every spike
+
+    neighbors: numpy.ndarray (n_channels, n_channels)
+        Neighboring channels
 
+    w: int, optional
+        Maximum distance (in time samples) between duplicated spikes
+
+    Returns
+    -------
+    idx_survive: numpy.ndarray (n_data)
+        Boolean array, True for the spikes that are kept
+    """
     # number of data points
     n_data = spike_index.shape[0]
-
-    # separate time and channel info
-    TT = spike_index[:, 0]
-    CC = spike_index[:, 1]
-
-    # Index counting
-    # indices in index_counter[t-1]+1 to index_counter[t] have time t
-    T_max = np.max(TT)
-    T_min = np.min(TT)
-    index_counter = np.zeros(T_max + w + 1, 'int32')
-    t_now = T_min
-    for j in range(n_data):
-        if TT[j] > t_now:
-            index_counter[t_now:TT[j]] = j - 1
-            t_now = TT[j]
-    index_counter[T_max:] = n_data - 1
-
-    # connecting edges
-    j_now = 0
-    edges = defaultdict(list)
-    for t in range(T_min, T_max + 1):
-
-        # time of j_now to index_counter[t] is t
-        # j_now to index_counter[t+w] has all index from t to t+w
-        max_index = index_counter[t+w]
-        cc_temporal_neighs = CC[j_now:max_index+1]
-
-        for j in range(index_counter[t]-j_now+1):
-            # check if channels are also neighboring
-            idx_neighs = np.where(
-                neighbors[cc_temporal_neighs[j],
-                          cc_temporal_neighs[j+1:]])[0] + j + 1 + j_now
-
-            # connect edges to neighboring spikes
-            for j2 in idx_neighs:
-                edges[j2].append(j+j_now)
-                edges[j+j_now].append(j2)
-
-        # update j_now
-        j_now = index_counter[t]+1
-
-    # Using scc, build connected components from the graph
     idx_survive = np.zeros(n_data, 'bool')
-    for scc in strongly_connected_components_iterative(np.arange(n_data),
-                                                       edges):
-        idx = list(scc)
-        idx_survive[idx[np.argmax(energy[idx])]] = 1
+
+    if n_data == 0:
+        return idx_survive
+
+    # separate time and channel info, sorted by time
+    order = np.argsort(spike_index[:, 0], kind='mergesort')
+    TT = spike_index[order, 0]
+    CC = spike_index[order, 1]
+
+    # every spike j is paired with the spikes after it and at most w time
+    # samples apart, spikes j + 1 to end[j] - 1
+    end = np.searchsorted(TT, TT + w, side='right')
+    n_pairs = end - np.arange(n_data) - 1
+    first = np.repeat(np.arange(n_data), n_pairs)
+    second = (first + 1 + np.arange(np.sum(n_pairs))
+              - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs))
+
+    # connect edges to neighboring spikes
+    connected = np.asarray(neighbors)[CC[first], CC[second]].astype('bool')
+    edges = sparse.coo_matrix(
+        (np.ones(np.sum(connected), 'bool'),
+         (first[connected], second[connected])), shape=(n_data, n_data))
+
+    n_components, labels = csgraph.connected_components(edges,
+                                                        directed=False)
+
+    # maximum energy of every component
+    energy = energy[order]
+    component_order = np.argsort(labels, kind='mergesort')
+    starts = np.searchsorted(labels[component_order], np.arange(n_components))
+    max_energy = np.maximum.reduceat(energy[component_order], starts)
+
+    # first spike with the maximum energy in every component
+    candidates = component_order[energy[component_order] ==
+                                 max_energy[labels[component_order]]]
+    _, first_candidate = np.unique(labels[candidates], return_index=True)
+
+    idx_survive[order[candidates[first_candidate]]] = 1
 
     return idx_survive
 
@@ -26,7 +26,7 @@ from yass import templates as get_templates
 from yass import read_config
 
 from yass.util import (load_yaml, save_metadata, load_logging_config_file,
-                       human_readable_time)
+                       human_readable_time, file_saver)
 from yass.explore import RecordingExplorer
 from yass.threshold import dimensionality_reduction as dim_red
 
@@ -150,12 +150,83 @@ def run(config, logger_level='INFO', clean=False, output_dir='tmp/',
         save_results=CONFIG.templates.save_results)
     time_templates = time.time() - start
 
-    # run deconvolution
+    # run deconvolution, the residual is saved if there are more iterations
+    n_iterations = CONFIG.deconvolution.n_iterations
+
     start = time.time()
-    spike_train = deconvolute.run(spike_index_all, templates,
-                                  output_directory=output_dir)
+    spike_train = deconvolute.run(
+        spike_index_all, templates, output_directory=output_dir,
+        residual_path=_residual_path(output_dir, 1, n_iterations))
     time_deconvolution = time.time() - start
 
+    # detect, cluster, get templates and deconvolute again on the residual
+    # to find units that were missed in previous iterations, every
+    # iteration has its own output directory
+    for i in range(1, n_iterations):
+        iteration_dir = _iteration_directory(output_dir, i)
+        residual_path = path.join(ROOT_FOLDER,
+                                  _residual_path(output_dir, i,
+                                                 n_iterations))
+
+        logger.info('Iteration %i, running on the residual recording', i)
+
+        start = time.time()
+        (score, spike_index_clear,
+         spike_index_all) = detect.run(
+            residual_path,
+            residual_path.replace('.bin', '.yaml'),
+            channel_index,
+            whiten_filter,
+            output_directory=iteration_dir,
+            if_file_exists=CONFIG.detect.if_file_exists,
+            save_results=CONFIG.detect.save_results)
+        time_detect += time.time() - start
+
+        start = time.time()
+        spike_train_clear, tmp_loc, vbParam = cluster.run(
+            score,
+            spike_index_clear,
+            output_directory=iteration_dir,
+            if_file_exists=CONFIG.cluster.if_file_exists,
+            save_results=CONFIG.cluster.save_results)
+        time_cluster += time.time() - start
+
+        start = time.time()
+        templates_iteration, _, _, _ = get_templates.run(
+            spike_train_clear, tmp_loc,
+            output_directory=iteration_dir,
+            if_file_exists=CONFIG.templates.if_file_exists,
+            save_results=CONFIG.templates.save_results)
+        time_templates += time.time() - start
+
+        start = time.time()
+        spike_train_iteration = deconvolute.run(
+            spike_index_all, templates_iteration,
+            output_directory=iteration_dir,
+            residual_path=_residual_path(output_dir, i + 1, n_iterations))
+        time_deconvolution += time.time() - start
+
+        # new units get ids after the ones found before
+        spike_train_iteration[:, 1] += templates.shape[2]
+        templates = np.concatenate((templates, templates_iteration), axis=2)
+        spike_train = np.concatenate((spike_train, spike_train_iteration))
+
+    # save the spike train and templates from all iterations, replacing
+    # the ones from the first iteration
+    if n_iterations > 1:
+        spike_train = spike_train[np.argsort(spike_train[:, 0],
+                                             kind='mergesort')]
+
+        path_to_spike_train = path.join(TMP_FOLDER, 'spike_train.npy')
+        file_saver(spike_train, path_to_spike_train)
+        logger.info('Spike train from all iterations saved in %s',
+                    path_to_spike_train)
+
+        path_to_templates = path.join(TMP_FOLDER, 'templates.npy')
+        file_saver(templates, path_to_templates)
+        logger.info('Templates from all iterations saved in %s',
+                    path_to_templates)
+
     # save metadata in tmp
     path_to_metadata = path.join(TMP_FOLDER, 'metadata.yaml')
     logging.info('Saving metadata in {}'.format(path_to_metadata))
@@ -251,3 +322,23 @@ def run(config, logger_level='INFO', clean=False, output_dir='tmp/',
                 time_deconvolution/total*100)
 
     return spike_train
+
+
+def _iteration_directory(output_dir, i):
+    """Output directory for the i-th iteration (the first one is 0, which
+    uses output_dir)
+    """
+    return path.join(output_dir, 'iteration_{}'.format(i))
+
+
+def _residual_path(output_dir, i, n_iterations):
+    """Where the residual used in the i-th iteration is saved (relative to
+    CONFIG.data.root_folder), None if there is no such iteration. Residuals
+    are saved as the standarized recordings of the iteration so the
+    templates step reads them
+    """
+    if i >= n_iterations:
+        return None
+
+    return path.join(_iteration_directory(output_dir, i), 'preprocess',
+                     'standarized.bin')
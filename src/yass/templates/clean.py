@@ -55,39 +55,50 @@ def clean_up_templates(templates, weights, spike_train,
     energy = np.ptp(templates, axis=1)
     mainc = np.argmax(energy, axis=0)
 
-    # check for overly spread template first
+    # check for overly spread template first, spread is the largest
+    # eigenvalue of the energy weighted covariance of the geometry of the
+    # channels with at least half of the maximum energy, computed for all
+    # templates at once (np.cov with aweights)
+    idx_c = energy > np.max(energy, axis=0) * 0.5
+    w = energy * idx_c
+    v1 = np.sum(w, axis=0)
+    v2 = np.sum(np.square(w), axis=0)
+    has_spread = np.sum(idx_c, axis=0) > 1
+
+    w, v1, v2 = w[:, has_spread], v1[has_spread], v2[has_spread]
+    mean = np.matmul(w.T, geometry) / v1[:, np.newaxis]
+    diff = geometry[:, np.newaxis] - mean[np.newaxis]
+    cov = np.einsum('ck,cki,ckj->kij', w, diff, diff)
+    cov /= (v1 - v2 / v1)[:, np.newaxis, np.newaxis]
+
     too_spread = np.zeros(n_templates, 'bool')
-    uncentered = np.zeros(n_templates, 'bool')
-    too_small = np.zeros(n_templates, 'bool')
-    for k in range(n_templates):
-
-        # checking for spread
-        idx_c = energy[:, k] > np.max(energy[:, k]) * 0.5
-        if np.sum(idx_c) > 1:
-            lam, V = np.linalg.eig(
-                np.cov(geometry[idx_c].T, aweights=energy[idx_c, k]))
-            lam[lam < 0] = 0
-            if np.sqrt(np.max(lam)) > spread_threshold:
-                too_spread[k] = 1
-
-        # checking for uncentered
-        ch_idx = np.where(neighbors[mainc[k]])[0]
-        if not np.any(tmp_loc[k] == ch_idx):
-            uncentered[k] = 1
-
-        # checking for small templates
-        if energy[mainc[k], k] < snr_threshold:
-            too_small[k] = 1
+    if cov.shape[0]:
+        lam = np.maximum(np.linalg.eigvalsh(cov), 0)
+        too_spread[has_spread] = np.sqrt(np.max(lam, axis=1)) > \
+            spread_threshold
+
+    # checking for uncentered
+    uncentered = ~neighbors[mainc, tmp_loc.astype('int32')].astype('bool')
+
+    # checking for small templates
+    too_small = energy[mainc, np.arange(n_templates)] < snr_threshold
 
     idx_good_templates = np.where(~np.logical_or(
         np.logical_or(too_spread, uncentered), too_small))[0]
 
-    spike_train2 = np.zeros((0, 3), 'int32')
-    for j, k in enumerate(idx_good_templates):
-        idx_k = np.where(spike_train[:, 1] == k)[0]
-        temp = np.copy(spike_train[idx_k])
-        temp[:, 1] = j
-        spike_train2 = np.vstack((spike_train2, temp))
+    # lookup table from old to new ids, -1 for removed templates
+    units = spike_train[:, 1].astype('int32')
+    n_ids = max(n_templates, np.max(units) + 1 if units.size else 0)
+    new_id = np.full(n_ids, -1, 'int32')
+    new_id[idx_good_templates] = np.arange(idx_good_templates.shape[0])
+
+    # keep spikes from good templates, grouped by new id
+    units = new_id[units]
+    idx_keep = np.where(units >= 0)[0]
+    idx_keep = idx_keep[np.argsort(units[idx_keep], kind='mergesort')]
+
+    spike_train2 = spike_train[idx_keep]
+    spike_train2[:, 1] = units[idx_keep]
 
     templates = templates[:, :, idx_good_templates]
     weights = weights[idx_good_templates]
@@ -3,6 +3,7 @@
 """
 import numpy as np
 from scipy import sparse
+from scipy.sparse import csgraph
 import logging
 
 from yass.batch import BatchProcessor
@@ -20,6 +21,10 @@ def get_templates(spike_train, path_to_recordings,
     n_templates = int(np.max(spike_train[:, 1]) + 1)
     spike_train_small = random_sample_spike_train(spike_train, n_max)
 
+    # sort by time once, every batch finds its spikes with searchsorted
+    spike_train_small = spike_train_small[
+        np.argsort(spike_train_small[:, 0], kind='mergesort')]
+
     # read recording
     bp = BatchProcessor(
         path_to_recordings, max_memory=max_memory, buffer_size=spike_size)
@@ -45,7 +50,9 @@ def get_templates(spike_train, path_to_recordings,
 
 def compute_weighted_templates(recording, idx_local, idx, previous_batch,
                                spike_train, spike_size, n_templates):
-
+    """Adds the weighted waveforms of the spikes in a batch to the weighted
+    sums of every template, spike_train must be sorted by time
+    """
     n_channels = recording.shape[1]
 
     # batch info
@@ -55,30 +62,28 @@ def compute_weighted_templates(recording, idx_local, idx, previous_batch,
     # get offset that will be applied
     offset = idx_local[0].start
 
-    # shift location of spikes according to the batch info
-    spike_time = spike_train[:, 0]
-    spike_train = spike_train[np.logical_and(spike_time >= data_start,
-                                             spike_time < data_end)]
-    spike_train[:, 0] = spike_train[:, 0] - data_start + offset
+    # spikes in the batch and their location in the batch
+    start, end = np.searchsorted(spike_train[:, 0], [data_start, data_end])
+    spike_train = spike_train[start:end]
+    spike_time = spike_train[:, 0].astype('int32') - data_start + offset
+    units = spike_train[:, 1].astype('int32')
+    n_spikes = spike_train.shape[0]
+
+    # (n_templates x n_spikes) matrix with the weight of every spike, one
+    # product per time sample in the window gives the weighted sums
+    weight_matrix = sparse.coo_matrix(
+        (spike_train[:, 2], (units, np.arange(n_spikes))),
+        shape=(n_templates, n_spikes)).tocsr()
 
-    # calculate weight templates
     weighted_templates = np.zeros(
-        (n_templates, 2 * spike_size + 1, n_channels), dtype=np.float32)
-    weights = np.zeros(n_templates)
-
-    for k in range(n_templates):
-        spt = spike_train[spike_train[:, 1] == k]
-        n_spikes = spt.shape[0]
-        if n_spikes > 0:
-            weighted_templates[k] = np.average(
-                recording[spt[:, [0]].astype('int32')
-                          + np.arange(-spike_size, spike_size + 1)],
-                axis=0,
-                weights=spt[:, 2])
-            weights[k] = np.sum(spt[:, 2])
-            weighted_templates[k] *= weights[k]
-
-    weighted_templates = np.transpose(weighted_templates, (2, 1, 0))
+        (n_channels, 2 * spike_size + 1, n_templates), dtype=np.float32)
+
+    for i, shift in enumerate(range(-spike_size, spike_size + 1)):
+        weighted_templates[:, i] = weight_matrix.dot(
+            recording[spike_time + shift]).T
+
+    weights = np.bincount(units, weights=spike_train[:, 2],
+                          minlength=n_templates)
 
     if previous_batch is not None:
         weighted_templates += previous_batch[0]
@@ -88,27 +93,77 @@ def compute_weighted_templates(recording, idx_local, idx, previous_batch,
 
 
 def random_sample_spike_train(spike_train, n_max):
-
+    """Keeps at most n_max random spikes per template, spikes keep their
+    order
+    """
     n_templates = int(np.max(spike_train[:, 1]) + 1)
 
-    idx_keep = np.zeros(spike_train.shape[0], 'bool')
-    for k in range(n_templates):
-        idx_data = np.where(spike_train[:, 1] == k)[0]
-        n_data = idx_data.shape[0]
-
-        if n_data > n_max:
-            idx_sample = np.random.choice(n_data,
-                                          n_max,
-                                          replace=False)
-            idx_keep[idx_data[idx_sample]] = 1
-        else:
-            idx_keep[idx_data] = 1
+    # spikes grouped by template (stable, so in their original order)
+    order = np.argsort(spike_train[:, 1], kind='mergesort')
+    n_data = np.bincount(spike_train[:, 1].astype('int32'),
+                         minlength=n_templates)
+    offsets = np.append(0, np.cumsum(n_data))
+
+    idx_keep = np.ones(spike_train.shape[0], 'bool')
+    for k in np.where(n_data > n_max)[0]:
+        idx_data = order[offsets[k]:offsets[k + 1]]
+        idx_sample = np.random.choice(n_data[k],
+                                      n_max,
+                                      replace=False)
+        idx_keep[idx_data] = 0
+        idx_keep[idx_data[idx_sample]] = 1
 
     spike_train_small = spike_train[idx_keep]
 
     return spike_train_small
 
 
+def cross_correlation(reference, templates, normalize=False):
+    """
+    Correlation between a reference and a bank of templates at every shift,
+    computed for all templates and shifts at once with the FFT
+
+    Parameters
+    ----------
+    reference: numpy.ndarray (n_channels, n_samples)
+        Reference waveform
+
+    templates: numpy.ndarray (n_templates, n_channels, n_samples + n_shifts
+    - 1)
+        Templates, shift j compares the reference with
+        templates[:, :, j:(j + n_samples)]
+
+    normalize: bool, optional
+        If True, returns the cosine similarity (the correlation divided by
+        the norm of the reference and of every shifted template)
+
+    Returns
+    -------
+    numpy.ndarray (n_templates, n_shifts)
+        Correlation (or cosine similarity) at every shift
+    """
+    n_samples = reference.shape[1]
+    n_shifts = templates.shape[2] - n_samples + 1
+
+    # correlation summed over channels, no circular wrapping for the shifts
+    # used since n_fft is at least the length of the templates
+    n_fft = int(2**np.ceil(np.log2(templates.shape[2])))
+    fft_reference = np.conj(np.fft.rfft(reference, n_fft))
+    fft_templates = np.fft.rfft(templates, n_fft)
+    corr = np.fft.irfft(np.einsum('cf,kcf->kf', fft_reference,
+                                  fft_templates), n_fft)[:, :n_shifts]
+
+    if normalize:
+        # energy of every shifted template, difference of a cumulative sum
+        energy = np.cumsum(np.sum(np.square(templates), axis=1), axis=1)
+        energy = np.hstack([np.zeros((templates.shape[0], 1)), energy])
+        energy = energy[:, n_samples:] - energy[:, :n_shifts]
+
+        corr = corr/np.sqrt(np.sum(np.square(reference)) * energy)
+
+    return corr
+
+
 def align_templates(templates, max_shift):
     C, R, K = templates.shape
     spike_size = int((R-1)/2 - max_shift)
@@ -118,43 +173,61 @@ def align_templates(templates, max_shift):
         np.max(templates[:, max_shift:(
             max_shift+2*spike_size+1)], axis=1), axis=0)
 
-    # get templates on their main channel only
-    templates_mainc = np.zeros((R, K))
-    for k in range(K):
-        templates_mainc[:, k] = templates[mainc[k], :, k]
+    # get templates on their main channel only (n_templates, R)
+    templates_mainc = templates[mainc, :, np.arange(K)]
 
     # reference template
-    biggest_template_k = np.argmax(np.max(templates_mainc, axis=0))
+    biggest_template_k = np.argmax(np.max(templates_mainc, axis=1))
     biggest_template = templates_mainc[
-        max_shift:(max_shift + 2*spike_size+1), biggest_template_k]
+        biggest_template_k, max_shift:(max_shift + 2*spike_size+1)]
 
     # find best shift
-    fit_per_shift = np.zeros((2*max_shift+1, K))
-    for s in range(2*max_shift+1):
-        fit_per_shift[s] = np.matmul(
-            biggest_template[
-                np.newaxis, :], templates_mainc[s:(s+2*spike_size+1)])
-    best_shift = np.argmax(fit_per_shift, axis=0)
-
-    templates_final = np.zeros((C, 2*spike_size+1, K))
-    for k in range(K):
-        s = best_shift[k]
-        templates_final[:, :, k] = templates[:, s:(s+2*spike_size+1), k]
+    fit_per_shift = cross_correlation(biggest_template[np.newaxis],
+                                      templates_mainc[:, np.newaxis])
+    best_shift = np.argmax(fit_per_shift, axis=1)
+
+    idx_time = best_shift + np.arange(2*spike_size+1)[:, np.newaxis]
+    templates_final = templates[:, idx_time, np.arange(K)]
 
     return templates_final
 
 
-# TODO: documentation
-# TODO: comment code, it's not clear what it does
 def merge_templates(templates, weights, spike_train, neighbors,
                     template_max_shift, t_merge_th):
-    """[Description]
+    """Merge similar templates whose main channels are neighbors
 
     Parameters
     ----------
+    templates: numpy.ndarray (n_channels, waveform_length, n_templates)
+        Templates
+
+    weights: numpy.ndarray (n_templates)
+        Weight of every template
+
+    spike_train: numpy.ndarray (n_data, 2 or 3)
+        Spike times and template ids
+
+    neighbors: numpy.ndarray (n_channels, n_channels)
+        Neighboring channels
+
+    template_max_shift: int
+        Maximum shift when comparing templates
+
+    t_merge_th: list
+        Cosine similarity and scale thresholds, two templates are similar
+        if their cosine similarity is above t_merge_th[0] and their scale
+        is between t_merge_th[1] and 2 - t_merge_th[1]
 
     Returns
     -------
+    templatesNew: numpy.ndarray (n_channels, waveform_length, n_groups)
+        Templates after merging
+
+    spike_train_merged: numpy.ndarray (n_data, 2)
+        Spike train relabeled with the merged ids, without duplicates
+
+    groups: list (n_groups)
+        Templates merged in every group
     """
     C, R, K = templates.shape
     th = t_merge_th
@@ -164,29 +237,32 @@ def merge_templates(templates, weights, spike_train, neighbors,
     visible_channels = energy > 0.5
     main_channels = np.argmax(energy, 0)
 
-    sparseConnection = sparse.lil_matrix((K, K), dtype='bool')
-    for k1 in range(K):
-        for k2 in range(k1, K):
-            if neighbors[main_channels[k1], main_channels[k2]]:
-                ch_idx = np.logical_or(visible_channels[:, k1],
-                                       visible_channels[:, k2])
-                t1 = templates[ch_idx, :, k1]
-                t2 = templates[ch_idx, :, k2]
-                if TemplatesSimilarity(t1, t2, th, W):
-                    sparseConnection[k1, k2] = 1
-                    sparseConnection[k2, k1] = 1
-
-    edges = {x: sparse.find(sparseConnection[x])[1] for x in range(K)}
-
-    groups = list()
-    for scc in strongly_connected_components_iterative(np.arange(K), edges):
-        groups.append(np.array(list(scc)))
-
-    Knew = len(groups)
+    # candidate pairs are templates whose main channels are neighbors,
+    # (templates x channels) one hot matrix times the neighbors matrix
+    # gives them without comparing all pairs
+    in_channel = sparse.csr_matrix(
+        (np.ones(K, 'int32'), (np.arange(K), main_channels)),
+        shape=(K, C))
+    candidates = sparse.triu(
+        in_channel.dot(sparse.csr_matrix(neighbors, dtype='int32')).dot(
+            in_channel.T), k=1).tocoo()
+    pairs = np.stack([candidates.row, candidates.col], 1)
+
+    cos, scale = templates_similarity(templates, pairs, visible_channels, W)
+    similar = (cos > th[0]) & (scale > th[1]) & (scale < 2 - th[1])
+
+    connection = sparse.coo_matrix(
+        (np.ones(np.sum(similar), 'bool'),
+         (pairs[similar, 0], pairs[similar, 1])), shape=(K, K))
+    Knew, labels = csgraph.connected_components(connection, directed=False)
+
+    # templates in every group, in ascending order
+    order = np.argsort(labels, kind='mergesort')
+    groups = np.split(order, np.cumsum(np.bincount(labels,
+                                                   minlength=Knew))[:-1])
+
     templatesNew = np.zeros((C, R, Knew))
     weightNew = np.zeros(Knew)
-    spt_new = np.zeros(spike_train.shape[0], 'int32')
-    id_new = np.zeros(spike_train.shape[0], 'int32')
     for k in range(Knew):
         temp = groups[k]
         templatesNew_temp = np.zeros((C, R, temp.shape[0]))
@@ -194,7 +270,7 @@ def merge_templates(templates, weights, spike_train, neighbors,
         if temp.shape[0] > 1:
             ch_idx = np.unique(main_channels[temp])
             shift_temp = determine_shift(
-                templates[[ch_idx]][:, :, temp], W)
+                templates[ch_idx][:, :, temp], W)
             for j2 in range(temp.shape[0]):
                 weight_temp[j2] = weights[temp[j2]]
                 s = shift_temp[j2]
@@ -207,10 +283,6 @@ def merge_templates(templates, weights, spike_train, neighbors,
                 elif s == 0:
                     templatesNew_temp[:, :, j2] = templates[:, :, temp[j2]]
 
-                idx_old_id = spike_train[:, 1] == temp[j2]
-                spt_new[idx_old_id] = spike_train[idx_old_id, 0]
-                id_new[idx_old_id] = k
-
             weightNew[k] = np.sum(weight_temp)
             templatesNew[:, :, k] = np.average(
                 templatesNew_temp, axis=2, weights=weight_temp)
@@ -219,12 +291,11 @@ def merge_templates(templates, weights, spike_train, neighbors,
             weightNew[k] = weights[temp[0]]
             templatesNew[:, :, k] = templates[:, :, temp[0]]
 
-            idx_old_id = spike_train[:, 1] == temp[0]
-            spt_new[idx_old_id] = spike_train[idx_old_id, 0]
-            id_new[idx_old_id] = k
-
+    # relabel spikes with the id of their group
     spike_train_merged = np.hstack((
-        spt_new[:, np.newaxis], id_new[:, np.newaxis]))
+        spike_train[:, [0]].astype('int32'),
+        labels[spike_train[:, 1].astype('int32')][:, np.newaxis].astype(
+            'int32')))
 
     spike_train_merged = remove_duplicates(spike_train_merged)
 
@@ -244,18 +315,12 @@ def determine_shift(tt, W):
     """
     C, RW, K = tt.shape
     R = RW - 2*W
-    t1 = tt[:, W:(W+R), 0]
-    norm1 = np.linalg.norm(t1)
-
-    shift = np.zeros(K, 'int16')
-    for k in range(1, K):
-        cos = np.zeros(2*W+1)
-        for j in range(2*W+1):
-            t2 = tt[:, j:(j+R), k]
-            norm2 = np.linalg.norm(t2)
-            cos[j] = np.sum(t1*t2)/norm1/norm2
-        ii = np.argmax(cos)
-        shift[k] = ii - W
+
+    # cosine similarity of every template with the first one at every shift
+    cos = cross_correlation(tt[:, W:(W+R), 0], tt.transpose(2, 0, 1),
+                            normalize=True)
+    shift = (np.argmax(cos, axis=1) - W).astype('int16')
+    shift[0] = 0
 
     amps = np.max(np.abs(tt), axis=(0, 1))
     k_max = np.argmax(amps)
@@ -264,102 +329,117 @@ def determine_shift(tt, W):
     return shift
 
 
-# TODO: documentation
-# TODO: comment code, it's not clear what it does
-def strongly_connected_components_iterative(vertices, edges):
-    """[Description]
+def templates_similarity(templates, pairs, visible_channels, W,
+                         batch_size=1024):
+    """
+    Shifted cosine similarity between pairs of templates
+
+    The first template of every pair is fixed (without its W samples on each
+    side) and the second one is shifted from 0 to 2W samples, only channels
+    visible in any of them are compared. Pairs are processed in batches,
+    every (pair, visible channel) entry is correlated with one product per
+    shift and entries are summed per pair
 
     Parameters
     ----------
+    templates: numpy.ndarray (n_channels, waveform_length + 2W, n_templates)
+        Templates
 
-    Returns
-    -------
-    """
-    identified = set()
-    stack = []
-    index = {}
-    boundaries = []
-
-    for v in vertices:
-        if v not in index:
-            to_do = [('VISIT', v)]
-            while to_do:
-                operation_type, v = to_do.pop()
-                if operation_type == 'VISIT':
-                    index[v] = len(stack)
-                    stack.append(v)
-                    boundaries.append(index[v])
-                    to_do.append(('POSTVISIT', v))
-                    # We reverse to keep the search order identical to that of
-                    # the recursive code;  the reversal is not necessary for
-                    # correctness, and can be omitted.
-                    to_do.extend(
-                        reversed([('VISITEDGE', w) for w in edges[v]]))
-                elif operation_type == 'VISITEDGE':
-                    if v not in index:
-                        to_do.append(('VISIT', v))
-                    elif v not in identified:
-                        while index[v] < boundaries[-1]:
-                            boundaries.pop()
-                else:
-                    # operation_type == 'POSTVISIT'
-                    if boundaries[-1] == index[v]:
-                        boundaries.pop()
-                        scc = set(stack[index[v]:])
-                        del stack[index[v]:]
-                        identified.update(scc)
-                        yield scc
+    pairs: numpy.ndarray (n_pairs, 2)
+        Index of the templates to compare
 
+    visible_channels: numpy.ndarray (n_channels, n_templates)
+        Boolean array, True for the channels where every template is visible
 
-# TODO: documentation
-# TODO: comment code, it's not clear what it does
-def TemplatesSimilarity(t1, t2, th, W):
-    """[Description]
+    W: int
+        Maximum shift
 
-    Parameters
-    ----------
+    batch_size: int, optional
+        Number of pairs compared at once
 
     Returns
     -------
+    cos: numpy.ndarray (n_pairs)
+        Highest cosine similarity over all shifts
+
+    scale: numpy.ndarray (n_pairs)
+        Scale of the second template relative to the first one, at the best
+        shift
     """
-    C, RW = t1.shape
+    C, RW, K = templates.shape
     R = RW - 2*W
 
-    t1 = np.reshape(t1[:, W:(W+R)], R*C)
-    t2_shifted = np.zeros((2*W+1, R*C))
-    for j in range(2*W+1):
-        t2_shifted[j] = np.reshape(t2[:, j:(j+R)], R*C)
+    # (n_templates, n_channels, waveform_length + 2W)
+    templates = templates.transpose(2, 0, 1)
+
+    # energy per channel of every shifted template, shifts are the
+    # difference of a cumulative sum
+    energy = np.cumsum(np.square(templates), axis=2)
+    energy = np.concatenate([np.zeros((K, C, 1)), energy], axis=2)
+    energy_shifted = energy[:, :, R:] - energy[:, :, :(2*W+1)]
+    energy_center = energy_shifted[:, :, W]
+
+    n_pairs = pairs.shape[0]
+    cos = np.zeros(n_pairs)
+    scale = np.zeros(n_pairs)
 
-    norm1 = np.sqrt(np.sum(np.square(t1), axis=0))
-    norm2 = np.sqrt(np.sum(np.square(t2_shifted), axis=1))
-    cos = np.matmul(t2_shifted, t1)/(norm1*norm2)
+    for start in range(0, n_pairs, batch_size):
+        k1 = pairs[start:(start + batch_size), 0]
+        k2 = pairs[start:(start + batch_size), 1]
+        n_batch = k1.shape[0]
 
-    ii = np.argmax(cos)
-    cos = cos[ii]
+        # (pair, channel) entries to compare, sorted by pair
+        pair, channel = np.nonzero(np.logical_or(
+            visible_channels[:, k1], visible_channels[:, k2]).T)
+        counts = np.bincount(pair, minlength=n_batch)
+        starts = (np.cumsum(counts) - counts)[counts > 0]
 
-    similar = 0
-    if cos > th[0]:
-        t1 = np.reshape(t1, [C, R])
-        t2 = np.reshape(t2_shifted[ii], [C, R])
+        t1 = templates[k1[pair], channel, W:(W+R)]
+        t2 = templates[k2[pair], channel]
 
-        scale = np.sum(t1*t2)/np.sum(np.square(t1))
-        if scale > th[1] and scale < 2 - th[1]:
-            similar = 1
+        # sums over the channels of every pair
+        dot = np.zeros((n_batch, 2*W+1))
+        norm1 = np.zeros(n_batch)
+        norm2 = np.zeros((n_batch, 2*W+1))
 
-    return similar
+        if pair.shape[0]:
+            dot[counts > 0] = np.add.reduceat(np.stack(
+                [np.einsum('er,er->e', t1, t2[:, j:(j+R)])
+                 for j in range(2*W+1)], axis=1), starts)
+            norm1[counts > 0] = np.add.reduceat(
+                energy_center[k1[pair], channel], starts)
+            norm2[counts > 0] = np.add.reduceat(
+                energy_shifted[k2[pair], channel], starts)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cos_batch = dot/np.sqrt(norm1[:, np.newaxis]*norm2)
+            best = np.argmax(cos_batch, axis=1)
+            idx = np.arange(n_batch)
+
+            cos[start:(start + batch_size)] = cos_batch[idx, best]
+            scale[start:(start + batch_size)] = dot[idx, best]/norm1
+
+    return cos, scale
 
 
 def remove_duplicates(spike_train):
-    K = int(np.max(spike_train[:, 1])) + 1
-    spike_train2 = np.zeros((0, 2), 'int32')
-    for k in range(K):
-        idx_k = np.where(spike_train[:, 1] == k)[0]
-        tt = np.unique(spike_train[idx_k, 0])
-        temp = np.hstack((tt[:, np.newaxis], k * np.ones(
-            (tt.shape[0], 1), 'int32')))
-        spike_train2 = np.vstack((spike_train2, temp))
-
-    idx_sort = np.argsort(spike_train2[:, 0])
-    spike_train2 = spike_train2[idx_sort]
-
-    return spike_train2
+    """Remove repeated (time, unit) pairs from a spike train
+
+    Parameters
+    ----------
+    spike_train: numpy.ndarray (n_data, 2)
+        Spike times and unit ids
+
+    Returns
+    -------
+    numpy.ndarray (n_unique, 2)
+        Unique spikes sorted by time (and unit for spikes at the same time)
+    """
+    order = np.lexsort((spike_train[:, 1], spike_train[:, 0]))
+    spike_train = spike_train[order]
+
+    # spikes equal to the previous one are duplicates
+    keep = np.ones(spike_train.shape[0], 'bool')
+    keep[1:] = np.any(spike_train[1:] != spike_train[:-1], axis=1)
+
+    return spike_train[keep]
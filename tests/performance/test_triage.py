@@ -0,0 +1,58 @@
+"""
+Benchmark for the triage kNN engines, compares runtime and which spikes are
+triaged against the cKDTree engine
+"""
+import time
+import logging
+
+import numpy as np
+import pytest
+
+from yass.cluster.triage import triage
+
+
+def make_scores(n_spikes, n_features, n_neigh, n_channels, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = 5 * rng.randn(n_channels, 4, n_features, n_neigh)
+    channel = rng.randint(0, n_channels, n_spikes)
+    unit = rng.randint(0, 4, n_spikes)
+    scores = (centers[channel, unit] +
+              rng.randn(n_spikes, n_features, n_neigh))
+    spike_index = np.stack([np.arange(n_spikes), channel], axis=1)
+    return scores, spike_index
+
+
+@pytest.mark.parametrize('n_features, location_feature', [(3, False),
+                                                          (10, False),
+                                                          (5, True)])
+def test_triage_engines_agree_with_kdtree(n_features, location_feature):
+    logger = logging.getLogger(__name__)
+
+    scores, spike_index = make_scores(10000, n_features, 7, 4)
+
+    results = dict()
+
+    for method in ['kdtree', 'brute', 'approx']:
+        start = time.time()
+        _, spike_index_kept, _ = triage(scores, spike_index, 20, 0.1,
+                                        location_feature, method=method,
+                                        processes=2)
+        logger.info('%s: %.2f seconds', method, time.time() - start)
+        results[method] = spike_index_kept[:, 0]
+
+    kept = results['kdtree']
+    triaged = np.setdiff1d(spike_index[:, 0], kept)
+
+    # brute force is exact
+    np.testing.assert_array_equal(results['brute'], kept)
+
+    # approximate neighbors should triage mostly the same spikes
+    agreement = (np.intersect1d(results['approx'], kept).shape[0] /
+                 float(kept.shape[0]))
+    recall = (np.setdiff1d(triaged, results['approx']).shape[0] /
+              float(triaged.shape[0]))
+    logger.info('approx: %.3f of kept spikes and %.3f of triaged spikes '
+                'agree with kdtree', agreement, recall)
+
+    assert agreement > 0.95
+    assert recall > 0.5
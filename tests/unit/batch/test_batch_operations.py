@@ -43,3 +43,17 @@ def test_can_pass_information_between_batches(path_to_data):
                                  pass_batch_results=True)
 
     assert res[0] == 4950 and res[1] == 4950
+
+
+def test_parallel_memory_mode_returns_results_in_order(path_to_data):
+    bp = BatchProcessor(path_to_data, dtype='int64', n_channels=2,
+                        data_order='samples', max_memory='160B')
+
+    def col_sums(data):
+        return np.sum(data, axis=0)
+
+    serial = bp.multi_channel_apply(col_sums, mode='memory')
+    parallel = bp.multi_channel_apply(col_sums, mode='memory', processes=2)
+
+    assert len(parallel) == len(serial) == 10
+    np.testing.assert_array_equal(parallel, serial)
@@ -6,7 +6,7 @@ import yaml
 
 from yass.evaluate.stability import (MeanWaveCalculator,
                                      RecordingAugmentation,
-                                     RecordingBatchIterator,
+                                     RecordingBatchProcessor,
                                      SpikeSortingEvaluation)
 from yass.pipeline import run
 
@@ -199,10 +199,10 @@ def main(n_batches=6):
         tot_samples = file_size_bytes / (np.dtype(dtype).itemsize * n_chan)
         radius = 70
         n_batch_samples = int(tot_samples / n_batches)
-        batch_reader = RecordingBatchIterator(
+        batch_reader = RecordingBatchProcessor(
             bin_file, geom_file, sample_rate=sampling_rate,
             batch_time_samples=n_batch_samples, n_batches=n_batches,
-            n_chan=n_chan, radius=radius, whiten=False)
+            n_chan=n_chan, radius=radius, whiten=False, dtype=dtype)
         mean_wave = MeanWaveCalculator(
                 batch_reader, spike_train, window=window)
         mean_wave.compute_templates(n_batches=n_batches)
@@ -237,7 +237,7 @@ def main(n_batches=6):
         batch_reader.close_iterator()
 
         # Evaluate stability of yass.
-        batch_reader = RecordingBatchIterator(
+        batch_reader = RecordingBatchProcessor(
             aug_bin_file, geom_file, sample_rate=sampling_rate,
             batch_time_samples=n_batch_samples, n_batches=n_batches,
             n_chan=n_chan, radius=radius, whiten=False)
@@ -6,12 +6,21 @@ from os import path
 
 import numpy as np
 import pytest
+from scipy.stats import chi2
+from scipy.sparse import coo_matrix
 
 import yass
 from yass import preprocess
 from yass import detect
 from yass import cluster
 from yass import reset_config
+from yass import mfm
+from yass.config import FrozenJSON
+from yass.cluster.coreset import coreset_alg
+from yass.cluster.mask import getmask
+from yass.cluster.partition import ChannelPartition
+from yass.cluster.util import (calculate_sparse_rhat, global_cluster_info,
+                               merge_clusters)
 
 from util import clean_tmp
 from util import ReferenceTesting
@@ -117,6 +126,235 @@ def test_cluster_runs_if_overwrite_is_on(path_to_threshold_config):
     pass
 
 
+def test_stochastic_spikesort_finds_separated_clusters():
+    np.random.seed(0)
+
+    centers = np.random.randn(3, 5) * 10
+    score = np.concatenate([c + np.random.randn(1000, 5) for c in centers])
+    score = score[:, :, np.newaxis]
+    mask = np.ones((score.shape[0], 1))
+    group = np.arange(score.shape[0])
+
+    param = FrozenJSON(dict(cluster=dict(
+        n_split=5,
+        prior=dict(beta=1, a=1, lambda0=0.01, nu=5, V=2),
+        stochastic=dict(enabled=True, batch_size=500, n_iter=5, delay=1.0,
+                        forget_rate=0.7))))
+
+    vbParam = mfm.spikesort(score, mask, group, param)
+
+    assert vbParam.rhat.shape == (3000, 3)
+    np.testing.assert_allclose(vbParam.rhat.sum(axis=1), 1)
+
+    # every cluster is found and no spike is assigned to another one
+    labels = np.argmax(vbParam.rhat, axis=1).reshape(3, 1000)
+    assert np.all(labels == labels[:, :1])
+    assert len(np.unique(labels[:, 0])) == 3
+
+
+def test_stochastic_spikesort_warm_start_from_previous_clusters(
+        monkeypatch):
+    np.random.seed(0)
+
+    centers = np.random.randn(3, 5) * 10
+    score = np.concatenate([c + np.random.randn(1000, 5) for c in centers])
+    score = score[:, :, np.newaxis]
+    mask = np.ones((score.shape[0], 1))
+    group = np.arange(score.shape[0])
+
+    param = FrozenJSON(dict(cluster=dict(
+        n_split=5,
+        prior=dict(beta=1, a=1, lambda0=0.01, nu=5, V=2),
+        stochastic=dict(enabled=True, batch_size=500, n_iter=5, delay=1.0,
+                        forget_rate=0.7))))
+
+    prior_vbParam = mfm.spikesort(score, mask, group, param)
+
+    # previous clusters are used instead of clustering from scratch
+    def split_merge(maskedData, param):
+        raise AssertionError('previous clusters were ignored')
+
+    monkeypatch.setattr(mfm, 'split_merge', split_merge)
+
+    vbParam = mfm.spikesort(score, mask, group, param, prior_vbParam)
+
+    labels = np.argmax(vbParam.rhat, axis=1).reshape(3, 1000)
+    assert vbParam.rhat.shape == (3000, 3)
+    assert np.all(labels == labels[:, :1])
+    assert len(np.unique(labels[:, 0])) == 3
+
+
+def test_spikesort_warm_start_from_previous_clusters():
+    np.random.seed(0)
+
+    centers = np.random.randn(3, 5) * 10
+    score = np.concatenate([c + np.random.randn(500, 5) for c in centers])
+    score = score[:, :, np.newaxis]
+    mask = np.ones((score.shape[0], 1))
+    group = np.arange(score.shape[0])
+
+    param = FrozenJSON(dict(cluster=dict(
+        n_split=5,
+        prior=dict(beta=1, a=1, lambda0=0.01, nu=5, V=2),
+        stochastic=dict(enabled=False))))
+
+    prior_vbParam = mfm.spikesort(score, mask, group, param)
+
+    vbParam = mfm.spikesort(score, mask, group, param, prior_vbParam)
+    assert vbParam.rhat.shape == (1500, 3)
+
+    # previous clusters with a different number of features are ignored
+    vbParam = mfm.spikesort(score[:, :3], mask, group, param, prior_vbParam)
+    assert vbParam.rhat.shape == (1500, 3)
+
+
+def test_calculate_sparse_rhat_returns_soft_assignments():
+    np.random.seed(0)
+
+    centers = np.random.randn(2, 5) * 10
+    score = np.concatenate([c + np.random.randn(500, 5) for c in centers])
+    score = score[:, :, np.newaxis]
+    spike_index = np.stack([np.arange(1000), np.zeros(1000, 'int32')], 1)
+
+    param = FrozenJSON(dict(cluster=dict(
+        n_split=5,
+        prior=dict(beta=1, a=1, lambda0=0.01, nu=5, V=2),
+        stochastic=dict(enabled=False))))
+    vbParam = mfm.spikesort(score, np.ones((1000, 1)), np.arange(1000),
+                            param)
+    tmp_loc = np.zeros(vbParam.muhat.shape[1], 'int32')
+
+    rhat = calculate_sparse_rhat(vbParam, tmp_loc, score, spike_index, None)
+
+    assert rhat.shape == (1000, tmp_loc.shape[0])
+    np.testing.assert_allclose(np.asarray(rhat.sum(1)).ravel(), 1)
+    assert np.all(rhat.data >= 0.1)
+
+
+def test_get_core_data_keeps_spikes_close_to_their_cluster():
+    np.random.seed(0)
+
+    n_features, n_units, n_channels = 3, 4, 2
+    vbParam = mfm.vbPar(None)
+    vbParam.muhat = np.random.randn(n_features, n_units, n_channels)
+    vbParam.Vhat = np.tile(np.eye(n_features)[:, :, np.newaxis, np.newaxis],
+                           (1, 1, n_units, n_channels))
+    vbParam.nuhat = np.ones(n_units)
+
+    score = np.random.randn(1000, n_features, n_channels) * 2
+    unit = np.random.randint(0, n_units, 1000)
+    vbParam.rhat = coo_matrix((np.ones(1000), (np.arange(1000), unit)),
+                              shape=(1000, n_units))
+
+    idx_keep = mfm.get_core_data(vbParam, score, np.inf, 2, batch_size=100)
+
+    dist = np.linalg.norm(score - vbParam.muhat[:, unit].transpose(1, 0, 2),
+                          axis=1)
+    np.testing.assert_array_equal(idx_keep, np.all(dist < 2, axis=1))
+
+    idx_keep = mfm.get_core_data(vbParam, score, 10, 2)
+    assert np.all(np.bincount(unit[idx_keep]) <= 10)
+
+
+def test_merge_clusters_merges_same_unit_in_neighboring_channels():
+    np.random.seed(0)
+
+    param = FrozenJSON(dict(cluster=dict(
+        n_split=5,
+        prior=dict(beta=1, a=1, lambda0=0.01, nu=5, V=2),
+        stochastic=dict(enabled=False))))
+
+    # the same unit is found in channels 0 and 1, and a different one in
+    # channel 2, which is not a neighbor of the others
+    center = np.random.randn(5) * 10
+    means = [center, center, center + 50]
+    neighbors = np.array([[1, 1, 0], [1, 1, 0], [0, 0, 1]], 'bool')
+
+    vbParam, tmp_loc, score, spike_index = None, None, None, None
+    for channel, mean in enumerate(means):
+        score_channel = (mean + np.random.randn(300, 5))[:, :, np.newaxis]
+        spike_index_channel = np.stack([np.arange(300),
+                                        np.ones(300, 'int32')*channel], 1)
+        vbParam_channel = mfm.spikesort(score_channel, np.ones((300, 1)),
+                                        np.arange(300), param)
+        (vbParam, tmp_loc,
+         score, spike_index) = global_cluster_info(
+            vbParam_channel, channel, score_channel, spike_index_channel,
+            vbParam, tmp_loc, score, spike_index)
+
+    assert tmp_loc.tolist() == [0, 1, 2]
+
+    vbParam.rhat = calculate_sparse_rhat(vbParam, tmp_loc, score,
+                                         spike_index, neighbors)
+    vbParam, tmp_loc = merge_clusters(vbParam, tmp_loc, score, neighbors,
+                                      param)
+
+    assert tmp_loc.tolist() == [0, 2]
+    assert vbParam.muhat.shape[1] == 2
+    assert vbParam.rhat.shape == (900, 2)
+    np.testing.assert_allclose(np.asarray(vbParam.rhat.sum(1)).ravel(), 1)
+
+
+def test_coreset_alg_respects_threshold_and_depth():
+    np.random.seed(0)
+
+    data = np.random.randn(5000, 4) * 5
+    th = 2.0
+
+    label = coreset_alg(data, th, K=5, max_depth=20)
+    assert label.min() == 1
+    assert np.array_equal(np.unique(label), np.arange(1, label.max() + 1))
+
+    for k in np.unique(label):
+        group = data[label == k]
+        assert np.max(np.linalg.norm(group - group.mean(0), axis=1)) <= 2*th
+
+    label = coreset_alg(data, th, K=5, max_depth=2)
+    assert label.max() <= 5**2
+
+
+def test_getmask_is_constant_within_groups():
+    np.random.seed(0)
+
+    scores = np.random.randn(1000, 3, 7) * 5
+    spike_index = np.stack([np.arange(1000),
+                            np.random.randint(0, 4, 1000)], axis=1)
+    groups = [np.random.randint(0, 10, np.sum(spike_index[:, 1] == c))
+              for c in range(4)]
+
+    masks = getmask(scores, spike_index, groups, [0.9, 0.5])
+
+    for c in range(4):
+        score_channel = scores[spike_index[:, 1] == c]
+        assert masks[c].shape == (score_channel.shape[0], 7)
+
+        for k in range(10):
+            mask_group = masks[c][groups[c] == k]
+            energy = np.sum(np.square(
+                score_channel[groups[c] == k].mean(0)), 0)
+            assert np.all(mask_group == mask_group[0])
+            assert np.all(mask_group[0][energy > 1.5*chi2.ppf(0.9, 1)*3] == 1)
+
+
+def test_channel_partition_matches_where():
+    np.random.seed(0)
+
+    channels = np.random.randint(0, 10, 1000)
+    channels[channels == 3] = 4
+    partition = ChannelPartition(channels)
+
+    for channel, idx_data in partition:
+        np.testing.assert_array_equal(idx_data,
+                                      np.where(channels == channel)[0])
+
+    keep = np.random.rand(1000) > 0.3
+    selected = partition.select(keep)
+    expected = ChannelPartition(channels[keep], n_channels=10)
+
+    np.testing.assert_array_equal(selected.order, expected.order)
+    np.testing.assert_array_equal(selected.offsets, expected.offsets)
+
+
 def test_new_process_shows_error_if_empty_config():
     with pytest.raises(ValueError):
         cluster.run(None, None)
@@ -1,8 +1,14 @@
 import pytest
 from os import path
 import numpy as np
+import yaml
 import yass
 from yass import preprocess, detect, cluster, templates, deconvolute
+from yass.deconvolute import deconvolve
+from yass.deconvolute.util import (independent_template_sets,
+                                   make_spt_index, get_channels_spt,
+                                   get_longer_spt_list, subtract_spikes)
+from yass.batch import RecordingsReader
 from util import clean_tmp, ReferenceTesting
 
 
@@ -33,6 +39,82 @@ def test_decovnolution(path_to_threshold_config):
     clean_tmp()
 
 
+def test_deconvolution_saves_residual(path_to_threshold_config):
+    yass.set_config('tests/config_nnet.yaml')
+
+    (standarized_path,
+     standarized_params,
+     channel_index,
+     whiten_filter) = preprocess.run()
+
+    (score,
+     spike_index_clear,
+     spike_index_all) = detect.run(standarized_path,
+                                   standarized_params,
+                                   channel_index,
+                                   whiten_filter)
+
+    spike_train_clear, tmp_loc, vbParam = cluster.run(
+        score, spike_index_clear)
+
+    (templates_, spike_train,
+     groups, idx_good_templates) = templates.run(
+        spike_train_clear, tmp_loc)
+
+    deconvolute.run(spike_index_all, templates_,
+                    residual_path=path.join('tmp', 'residual.bin'))
+
+    CONFIG = yass.read_config()
+    residual = RecordingsReader(path.join(CONFIG.data.root_folder, 'tmp',
+                                          'residual.bin'),
+                                loader='array')
+    standarized = RecordingsReader(standarized_path, loader='array')
+
+    assert residual.shape == standarized.shape
+    assert residual.dtype == standarized.dtype
+
+    clean_tmp()
+
+
+def test_deconvolution_in_parallel_matches_serial():
+    with open('tests/config_nnet.yaml') as f:
+        cfg = yaml.load(f)
+
+    yass.set_config(cfg)
+
+    # the neural network detector leaves a tensorflow session in this
+    # process before deconvolution starts the workers
+    (standarized_path,
+     standarized_params,
+     channel_index,
+     whiten_filter) = preprocess.run()
+
+    (score,
+     spike_index_clear,
+     spike_index_all) = detect.run(standarized_path,
+                                   standarized_params,
+                                   channel_index,
+                                   whiten_filter)
+
+    spike_train_clear, tmp_loc, vbParam = cluster.run(
+        score, spike_index_clear)
+
+    (templates_, spike_train,
+     groups, idx_good_templates) = templates.run(
+        spike_train_clear, tmp_loc)
+
+    spike_train_serial = deconvolute.run(spike_index_all, templates_)
+
+    cfg['resources']['processes'] = 2
+    yass.set_config(cfg)
+
+    spike_train_parallel = deconvolute.run(spike_index_all, templates_)
+
+    np.testing.assert_array_equal(spike_train_parallel, spike_train_serial)
+
+    clean_tmp()
+
+
 @pytest.mark.xfail
 def test_deconvolution_returns_expected_results(path_to_threshold_config,
                                                 path_to_data_folder):
@@ -63,3 +145,97 @@ def test_deconvolution_returns_expected_results(path_to_threshold_config,
     ReferenceTesting.assert_array_equal(spike_train, path_to_spike_train)
 
     clean_tmp()
+
+
+def test_independent_template_sets_keep_order_of_conflicting_templates():
+    np.random.seed(0)
+
+    support = np.random.rand(20, 30) > 0.9
+    templates_order = np.random.permutation(30)
+
+    template_sets = independent_template_sets(support, templates_order)
+
+    assert sorted(np.concatenate(template_sets)) == list(range(30))
+
+    position = np.argsort(templates_order)
+    set_id = np.zeros(30, 'int32')
+    for i, template_set in enumerate(template_sets):
+        set_id[template_set] = i
+        # templates in a set do not share channels
+        assert np.all(np.sum(support[:, template_set], axis=1) <= 1)
+
+    # conflicting templates are in sets following templates_order
+    for k1 in range(30):
+        for k2 in range(30):
+            if (k1 != k2 and np.any(support[:, k1] & support[:, k2])
+                    and position[k1] < position[k2]):
+                assert set_id[k1] < set_id[k2]
+
+
+def test_deconvolve_runs_serially_if_all_templates_share_channels(
+        monkeypatch):
+    np.random.seed(0)
+
+    def thread_pool(threads):
+        raise AssertionError('templates that share channels were '
+                             'deconvolved in threads')
+
+    monkeypatch.setattr(deconvolve, 'ThreadPool', thread_pool)
+
+    recording = np.random.randn(1000, 5).astype('float32')
+    templates_ = np.random.randn(5, 21, 3).astype('float32')
+    spike_index = np.stack([np.random.randint(0, 1000, 50),
+                            np.random.randint(0, 5, 50)], 1)
+    idx = (slice(0, 1000), slice(None))
+
+    kwargs = dict(spike_size=7, n_explore=2, n_rf=1, upsample_factor=5,
+                  threshold_a=0.3, threshold_dd=0)
+
+    spike_train_threads = deconvolve.deconvolve(
+        recording, idx, idx, templates_, spike_index.copy(), threads=2,
+        **kwargs)
+    spike_train = deconvolve.deconvolve(
+        recording, idx, idx, templates_, spike_index.copy(), **kwargs)
+
+    np.testing.assert_array_equal(spike_train_threads, spike_train)
+
+
+def test_get_channels_spt_matches_spikes_in_channels():
+    np.random.seed(0)
+
+    spike_index = np.stack([np.random.randint(0, 1000, 500),
+                            np.random.randint(0, 10, 500)], 1)
+    spike_times, offsets = make_spt_index(spike_index, 10)
+
+    channels = np.array([7, 2, 3])
+    spt = get_channels_spt(spike_times, offsets, channels)
+
+    expected = spike_index[np.in1d(spike_index[:, 1], channels), 0]
+    np.testing.assert_array_equal(np.sort(spt), np.sort(expected))
+
+    spt_long = get_longer_spt_list(spt, 2)
+    expected_long = np.unique((expected[:, np.newaxis]
+                               + np.arange(-2, 3)).ravel())
+    np.testing.assert_array_equal(spt_long, expected_long)
+
+
+def test_subtract_spikes_matches_subtracting_one_by_one():
+    np.random.seed(0)
+
+    upsampled_template = np.random.randn(5, 3, 11)
+    spt = np.sort(np.random.choice(np.arange(5, 995), 100, replace=False))
+    ahat = np.random.rand(100)
+    max_idx = np.random.randint(0, 5, 100)
+
+    rec = np.random.randn(1000, 6).astype('float32')
+    expected = np.copy(rec)
+
+    for channels in [np.array([1, 2, 3]), np.array([0, 2, 5])]:
+        subtract_spikes(rec, spt, ahat, max_idx, upsampled_template,
+                        channels)
+
+        for j in range(100):
+            expected[spt[j]-5:spt[j]+6, channels] -= (
+                ahat[j]*upsampled_template[max_idx[j]].T)
+
+        np.testing.assert_array_equal(rec, expected)
@@ -2,7 +2,9 @@
 Testing default pipeline
 """
 from os import path
+import numpy as np
 import pytest
+import yaml
 from yass import pipeline
 from util import clean_tmp, ReferenceTesting
 
@@ -33,3 +35,23 @@ def test_threshold_pipeline_returns_expected_results(path_to_threshold_config,
     ReferenceTesting.assert_array_equal(spike_train, path_to_reference)
 
     clean_tmp()
+
+
+def test_pipeline_saves_spike_train_from_all_iterations(
+        path_to_threshold_config, path_to_data_folder):
+
+    with open(path_to_threshold_config) as f:
+        cfg = yaml.load(f)
+
+    cfg['deconvolution']['n_iterations'] = 2
+
+    spike_train = pipeline.run(cfg, clean=True)
+
+    saved = np.load(path.join(path_to_data_folder, 'tmp', 'spike_train.npy'))
+    templates = np.load(path.join(path_to_data_folder, 'tmp',
+                                  'templates.npy'))
+
+    np.testing.assert_array_equal(saved, spike_train)
+    assert np.all(spike_train[:, 1] < templates.shape[2])
+
+    clean_tmp()
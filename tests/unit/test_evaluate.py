@@ -0,0 +1,231 @@
+"""
+evaluate module tests
+"""
+import sys
+from os import path
+
+import multiprocess
+import numpy as np
+import pytest
+
+from yass.evaluate.analyzer import Analyzer
+from yass.evaluate.stability import (MeanWaveCalculator,
+                                     RecordingAugmentation,
+                                     RecordingBatchProcessor,
+                                     SpikeSortingEvaluation,
+                                     clean_spike_train, count_spikes,
+                                     group_spike_times)
+from yass.evaluate.util import artifact_key
+
+
+def test_confusion_matrix_matches_count_matches_per_pair():
+    np.random.seed(0)
+
+    # some (unit, cluster) pairs have spikes with several coincidences
+    spt_base = np.stack([np.sort(np.random.randint(0, 20000, 400)),
+                         np.random.randint(0, 4, 400)], 1)
+    spt = np.stack([np.random.randint(0, 20000, 500),
+                    np.random.randint(0, 5, 500)], 1)
+
+    # coincidences exactly at admissible_proximity are not matches
+    spt = np.concatenate([spt, np.stack([spt_base[:50, 0] + 10,
+                                         spt_base[:50, 1]], 1)])
+
+    ev = SpikeSortingEvaluation(spt_base, spt, admissible_proximity=10)
+
+    expected = np.zeros((4, 5))
+    for unit in range(4):
+        for cluster in range(5):
+            expected[unit, cluster] = ev.count_matches(
+                np.sort(spt_base[spt_base[:, 1] == unit, 0]),
+                np.sort(spt[spt[:, 1] == cluster, 0]))
+
+    np.testing.assert_array_equal(ev.confusion_matrix, expected)
+
+    # every base spike matches the spike admissible_proximity - 1 later
+    spt_shifted = spt_base.copy()
+    spt_shifted[:, 0] += 9
+    ev = SpikeSortingEvaluation(spt_base, spt_shifted,
+                                admissible_proximity=10)
+    np.testing.assert_array_equal(np.diag(ev.confusion_matrix),
+                                  np.bincount(spt_base[:, 1]))
+
+
+def test_artifact_key_depends_on_contents_only():
+    config = dict(data=dict(root_folder='a', recordings='b'), seed=0)
+    config_reordered = dict(seed=0, data=dict(recordings='b',
+                                              root_folder='a'))
+    arr = np.arange(10)
+
+    assert artifact_key(config, arr) == artifact_key(config_reordered,
+                                                     arr.copy())
+
+    changed = arr.copy()
+    changed[3] = 0
+    assert artifact_key(config, arr) != artifact_key(config, changed)
+    assert artifact_key(config, arr) != artifact_key(config,
+                                                     arr.astype('float64'))
+
+
+def test_analyzer_cached_computes_once(tmpdir):
+    analyzer = Analyzer(dict(data=dict(root_folder=str(tmpdir))))
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return np.arange(5)
+
+    first = analyzer._cached('key', 'output.npy', compute)
+    second = analyzer._cached('key', 'output.npy', compute)
+
+    assert len(calls) == 1
+    np.testing.assert_array_equal(first, second)
+
+    analyzer._cached('other_key', 'output.npy', compute)
+    assert len(calls) == 2
+
+
+def test_analyzer_join_sort_raises_if_sort_fails(tmpdir):
+    analyzer = Analyzer(dict(data=dict(root_folder=str(tmpdir))))
+
+    sort = multiprocess.Process(target=sys.exit, args=(1, ))
+    sort.start()
+
+    with pytest.raises(RuntimeError):
+        analyzer._join_sort(sort)
+
+    sort = multiprocess.Process(target=sys.exit, args=(0, ))
+    sort.start()
+    analyzer._join_sort(sort)
+
+
+def make_batch_reader(path_to_tests, **kwargs):
+    return RecordingBatchProcessor(
+        path.join(path_to_tests, 'data/neuropixel.bin'),
+        path.join(path_to_tests, 'data/neuropixel_channels.npy'),
+        sample_rate=30000, n_batches=4, batch_time_samples=2500,
+        n_chan=10, radius=70, filter_std=False, **kwargs)
+
+
+def test_clean_spike_train_relabels_in_order():
+    np.random.seed(0)
+
+    labels = np.array([3, 7, 10, 42])
+    spt = np.stack([np.arange(100), np.random.choice(labels, 100)], 1)
+    expected = spt.copy()
+    for i, u in enumerate(labels):
+        expected[spt[:, 1] == u, 1] = i
+
+    np.testing.assert_array_equal(clean_spike_train(spt), expected)
+
+    # clean spike trains are returned as they are
+    clean = expected.copy()
+    assert clean_spike_train(clean) is clean
+    np.testing.assert_array_equal(clean, expected)
+
+
+def test_count_spikes_and_group_spike_times_match_loop():
+    np.random.seed(0)
+
+    spt = np.stack([np.random.randint(0, 10000, 500),
+                    np.random.randint(0, 6, 500)], 1)
+
+    counts = count_spikes(spt, 8)
+    times, offsets = group_spike_times(spt, 8)
+
+    assert counts.shape == (8, )
+    assert offsets.shape == (9, )
+
+    for u in range(8):
+        spike_times = np.sort(spt[spt[:, 1] == u, 0])
+        assert counts[u] == spike_times.shape[0]
+        np.testing.assert_array_equal(times[offsets[u]:offsets[u + 1]],
+                                      spike_times)
+
+
+def test_augmentation_firing_statistics_match_loop(path_to_tests):
+    np.random.seed(0)
+
+    # unit 3 has a single spike, unit 1 has repeated spike times
+    spt = np.stack([np.random.randint(0, 10000, 300),
+                    np.random.randint(0, 3, 300)], 1)
+    spt = np.concatenate([spt, [[500, 3], [700, 1], [700, 1]]])
+
+    mean_wave = MeanWaveCalculator(make_batch_reader(path_to_tests), spt)
+    augmentation = RecordingAugmentation(mean_wave, move_rate=0.2,
+                                         augment_rate=0.25)
+
+    for u in range(4):
+        spt_u = mean_wave.spike_times(u)
+        np.testing.assert_array_equal(spt_u, np.sort(spt[spt[:, 1] == u, 0]))
+
+        firing_diff = np.diff(spt_u)
+        firing_diff[firing_diff == 0] = 1
+        firing_diff = np.log(firing_diff)
+
+        summary = augmentation.stat_summary[u]
+        assert summary[2] == spt_u.shape[0]
+
+        if spt_u.shape[0] < 2:
+            assert np.all(np.isnan(summary[:2]))
+        else:
+            np.testing.assert_allclose(summary[:2], [np.mean(firing_diff),
+                                                     np.std(firing_diff)])
+
+
+def test_compute_templates_matches_mean_of_waveforms(path_to_tests):
+    np.random.seed(0)
+
+    window = range(-10, 30)
+    spt = np.stack([np.random.randint(0, 10000, 300),
+                    np.random.randint(0, 4, 300)], 1)
+    # spikes at the edges, only the ones whose window is inside the
+    # recording are used
+    edges = np.array([[0, 0], [9, 1], [10, 2], [9970, 3], [9971, 0],
+                      [9999, 1]])
+    spt = np.concatenate([spt, edges])
+
+    mean_wave = MeanWaveCalculator(make_batch_reader(path_to_tests),
+                                   spt.copy(), window=window)
+    boundary_violation = mean_wave.compute_templates(n_batches=4)
+
+    inside = (spt[:, 0] >= 10) & (spt[:, 0] + 29 < 10000)
+    assert boundary_violation == np.sum(~inside)
+
+    recording = np.fromfile(path.join(path_to_tests, 'data/neuropixel.bin'),
+                            'int16').reshape(10000, 10) / 1e2
+    expected = np.zeros((len(window), 10, 4))
+    for u in range(4):
+        times = spt[inside & (spt[:, 1] == u), 0]
+        waveforms = recording[times[:, np.newaxis] + np.asarray(window)]
+        expected[:, :, u] = waveforms.mean(axis=0)
+
+    np.testing.assert_allclose(mean_wave.templates, expected, atol=1e-12)
+
+
+def test_save_augment_recording_does_not_depend_on_processes(path_to_tests,
+                                                             tmpdir):
+    spt = np.stack([np.random.RandomState(0).randint(0, 10000, 300),
+                    np.random.RandomState(1).randint(0, 4, 300)], 1)
+
+    outputs = []
+
+    for processes in (1, 2):
+        mean_wave = MeanWaveCalculator(
+            make_batch_reader(path_to_tests, processes=processes),
+            spt.copy())
+        mean_wave.compute_templates(n_batches=4)
+
+        np.random.seed(0)
+        augmentation = RecordingAugmentation(mean_wave, move_rate=0.5,
+                                             augment_rate=0.25)
+        path_to_output = str(tmpdir.join('augmented_{}.bin'
+                                         .format(processes)))
+        spike_train, _ = augmentation.save_augment_recording(path_to_output,
+                                                             4)
+
+        with open(path_to_output, 'rb') as f:
+            outputs.append((f.read(), spike_train))
+
+    assert outputs[0][0] == outputs[1][0]
+    np.testing.assert_array_equal(outputs[0][1], outputs[1][1])
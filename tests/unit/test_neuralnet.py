@@ -11,6 +11,7 @@ import yass
 from yass.batch import RecordingsReader, BatchProcessor
 from yass import neuralnetwork
 from yass.geometry import make_channel_index, n_steps_neigh_channels
+from yass.neuralnetwork.apply import deduplicate
 
 
 def test_can_use_neural_network_detector(path_to_tests):
@@ -136,3 +137,27 @@ def test_splitting_in_batches_does_not_affect_result(path_to_tests):
     np.testing.assert_array_equal(clear_batch, clear)
     np.testing.assert_array_equal(collision_batch, collision)
     np.testing.assert_array_equal(scores_batch, scores)
+
+
+def test_deduplicate_keeps_largest_spike_of_connected_detections():
+    neighbors = np.array([[1, 1, 0], [1, 1, 0], [0, 0, 1]], 'bool')
+
+    # spikes 0, 1 and 2 are chained (0-1 and 1-2 are within w), spike 3 is
+    # close in time but in a channel that is not a neighbor and spike 4 is
+    # far in time
+    spike_index = np.array([[100, 0], [104, 1], [108, 0], [105, 2],
+                            [200, 0]])
+    energy = np.array([1.0, 3.0, 2.0, 0.5, 0.1])
+
+    idx_survive = deduplicate(spike_index, energy, neighbors, w=5)
+
+    np.testing.assert_array_equal(idx_survive,
+                                  [False, True, False, True, True])
+
+    # order of the detections does not matter
+    order = np.array([4, 2, 0, 3, 1])
+    idx_survive = deduplicate(spike_index[order], energy[order], neighbors,
+                              w=5)
+
+    np.testing.assert_array_equal(idx_survive,
+                                  [True, False, False, True, True])
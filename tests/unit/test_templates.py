@@ -13,6 +13,10 @@ from yass import detect
 from yass import cluster
 from yass import templates
 from yass import reset_config
+from yass.templates.util import (compute_weighted_templates,
+                                 random_sample_spike_train, merge_templates,
+                                 cross_correlation, remove_duplicates)
+from yass.templates.clean import clean_up_templates
 
 from util import clean_tmp, ReferenceTesting
 
@@ -121,6 +125,133 @@ def test_templates_returns_expected_results(path_to_threshold_config,
     clean_tmp()
 
 
+def test_compute_weighted_templates_matches_weighted_sum():
+    np.random.seed(0)
+
+    n_observations, n_channels, n_templates, spike_size = 1000, 5, 4, 3
+    recording = np.random.randn(n_observations + 2*spike_size,
+                                n_channels).astype('float32')
+    spike_train = np.stack([np.random.randint(200, 1600, 500),
+                            np.random.randint(0, n_templates, 500),
+                            np.random.rand(500)], 1)
+    spike_train = spike_train[np.argsort(spike_train[:, 0])]
+
+    idx = (slice(100, 100 + n_observations), slice(None))
+    idx_local = (slice(spike_size, spike_size + n_observations),
+                 slice(None))
+
+    weighted_templates, weights = compute_weighted_templates(
+        recording, idx_local, idx, None, spike_train, spike_size,
+        n_templates)
+
+    expected = np.zeros((n_templates, 2*spike_size + 1, n_channels))
+    expected_weights = np.zeros(n_templates)
+    for t, k, w in spike_train:
+        if 100 <= t < 100 + n_observations:
+            start = int(t) - 100
+            expected[int(k)] += w*recording[start:start + 2*spike_size + 1]
+            expected_weights[int(k)] += w
+
+    np.testing.assert_allclose(weighted_templates,
+                               expected.transpose(2, 1, 0), rtol=1e-5,
+                               atol=1e-5)
+    np.testing.assert_allclose(weights, expected_weights)
+
+
+def test_random_sample_spike_train_keeps_at_most_n_max():
+    np.random.seed(0)
+
+    spike_train = np.stack([np.arange(1000),
+                            np.random.randint(0, 3, 1000)], 1)
+    spike_train[spike_train[:, 1] == 2, 1] = 1
+    spike_train[:10, 1] = 2
+
+    small = random_sample_spike_train(spike_train, 50)
+
+    assert np.bincount(small[:, 1]).tolist() == [50, 50, 10]
+    assert np.all(np.diff(small[:, 0]) > 0)
+
+
+def test_merge_templates_merges_shifted_copies_in_neighbor_channels():
+    np.random.seed(0)
+
+    n_channels, max_shift, waveform_length = 4, 2, 21
+    neighbors = np.array([[1, 1, 0, 0], [1, 1, 0, 0],
+                          [0, 0, 1, 1], [0, 0, 1, 1]], 'bool')
+
+    # template 1 is a shifted copy of template 0, template 2 is the same
+    # waveform on channels that are not neighbors of theirs
+    waveform = np.zeros((n_channels, waveform_length + 2*max_shift))
+    waveform[0] = np.sin(np.linspace(0, 3*np.pi, waveform.shape[1]))*5
+    waveform[1] = waveform[0]*0.6
+    templates = np.stack([waveform, np.roll(waveform, 1, axis=1),
+                          np.roll(waveform, 2, axis=0)], 2)
+
+    spike_train = np.array([[10, 0], [10, 1], [20, 1], [30, 2]])
+
+    merged, spike_train_merged, groups = merge_templates(
+        templates, np.ones(3), spike_train, neighbors, max_shift,
+        [0.9, 0.8])
+
+    assert merged.shape == (n_channels, waveform_length + 2*max_shift, 2)
+    assert [group.tolist() for group in groups] == [[0, 1], [2]]
+    np.testing.assert_array_equal(spike_train_merged,
+                                  [[10, 0], [20, 0], [30, 1]])
+
+
+def test_cross_correlation_matches_correlation_at_every_shift():
+    np.random.seed(0)
+
+    reference = np.random.randn(3, 10)
+    templates = np.random.randn(5, 3, 16)
+
+    corr = cross_correlation(reference, templates)
+    cos = cross_correlation(reference, templates, normalize=True)
+
+    for j in range(7):
+        shifted = templates[:, :, j:(j + 10)]
+        expected = np.sum(reference * shifted, axis=(1, 2))
+        np.testing.assert_allclose(corr[:, j], expected, atol=1e-10)
+        np.testing.assert_allclose(
+            cos[:, j], expected / np.linalg.norm(reference)
+            / np.linalg.norm(shifted, axis=(1, 2)), atol=1e-10)
+
+
+def test_remove_duplicates_keeps_unique_spikes_sorted_by_time():
+    spike_train = np.array([[30, 1], [10, 0], [30, 1], [10, 1], [10, 0]])
+
+    np.testing.assert_array_equal(remove_duplicates(spike_train),
+                                  [[10, 0], [10, 1], [30, 1]])
+
+
+def test_clean_up_templates_relabels_good_templates():
+    geometry = np.array([[0, 0], [0, 20], [0, 500]])
+    neighbors = np.array([[1, 1, 0], [1, 1, 0], [0, 0, 1]], 'bool')
+
+    templates = np.zeros((3, 5, 4))
+    # good template
+    templates[0, 2, 0] = 10
+    # too small
+    templates[1, 2, 1] = 1
+    # too spread
+    templates[[0, 2], 2, 2] = 10
+    # good template, clustered in a neighbor channel
+    templates[1, 2, 3] = 10
+    tmp_loc = np.array([0, 1, 0, 0])
+
+    spike_train = np.array([[5, 3, 1], [6, 1, 1], [7, 0, 1], [8, 3, 1],
+                            [9, 2, 1]], 'float')
+
+    templates, weights, spike_train, idx_good_templates = clean_up_templates(
+        templates, np.ones(4), spike_train, tmp_loc, geometry, neighbors, 2,
+        100)
+
+    np.testing.assert_array_equal(idx_good_templates, [0, 3])
+    assert templates.shape == (3, 5, 2)
+    np.testing.assert_array_equal(spike_train[:, :2],
+                                  [[7, 0], [5, 1], [8, 1]])
+
+
 def test_new_process_shows_error_if_empty_config():
     with pytest.raises(ValueError):
         cluster.run(None, None)